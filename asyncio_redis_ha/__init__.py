@@ -1,4 +1,46 @@
+import importlib
+import sys
+
+from .admission import *
+from .commands import *
 from .connection import *
+from .durability import *
+from .exceptions import *
+from .group import *
 from .manager import *
+from .pipeline import *
 from .protocol import *
+from .pubsub import *
+from .replication import *
 from .replies import *
+from .scripts import *
+from .session import *
+from .stats import *
+
+# Optional features, their modules are imported on first use.
+_LAZY = {
+    'BulkLoader': 'bulk',
+    'BulkReader': 'bulk',
+    'NearCache': 'cache',
+    'HedgePolicy': 'hedging',
+    'ScanIterator': 'scan',
+    'SharedTopology': 'topology',
+}
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name not in _LAZY:
+            raise AttributeError('module %r has no attribute %r' % (__name__, name))
+        value = getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY))
+else:
+    # (No module __getattr__ before Python 3.7.)
+    from .bulk import *
+    from .cache import *
+    from .hedging import *
+    from .scan import *
+    from .topology import *
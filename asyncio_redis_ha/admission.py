@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import itertools
+
+from asyncio_redis_ha.exceptions import OverloadedError
+
+
+class AdmissionPolicy:
+    """
+    What an :class:`AdmissionController` does with a command over the limits.
+    """
+    #: Wait for a slot, in priority order (at most `max_waiting` callers, then fail).
+    WAIT = 'wait'
+    #: Raise :class:`~asyncio_redis_ha.exceptions.OverloadedError` at once.
+    FAIL_FAST = 'fail_fast'
+    #: Wait for a slot, when `max_waiting` callers already wait, fail the one
+    #: with the lowest priority (the newest of those with the same priority).
+    SHED = 'shed'
+
+
+def request_size(args, kwargs=None):
+    """ Approximate number of bytes sent for a command with these arguments. """
+    size = 0
+    for value in itertools.chain(args, (kwargs or {}).values()):
+        if isinstance(value, (bytes, bytearray, memoryview, str)):
+            size += len(value)
+        elif isinstance(value, dict):
+            size += request_size(value.keys()) + request_size(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += request_size(value)
+        else:
+            size += 8
+    return size
+
+
+class AdmissionController:
+    """
+    Bounds the commands a :class:`~asyncio_redis_ha.ConnectionManager` has in
+    flight, so that overload degrades into waiting or failing callers instead
+    of an ever growing number of pending commands and buffers.
+
+    ::
+
+        admission = AdmissionController(max_in_flight=500, max_bytes=16 * 1024 * 1024,
+                                        policy=AdmissionPolicy.SHED, max_waiting=1000)
+        manager = yield from ConnectionManager.create(..., admission=admission)
+
+        yield from manager.with_options(priority=10).get('key')
+
+    A command is admitted while fewer than `max_in_flight` commands, of less
+    than `max_bytes` arguments (see :func:`request_size`) in total, are in
+    flight. (A single command larger than `max_bytes` is admitted when nothing
+    else is in flight.) A pipeline counts as the number of commands it
+    contains, admitted at once (alone when it has more than `max_in_flight`).
+    Waiting commands are admitted by priority, then in order.
+    `max_in_flight_per_connection` is applied by the manager when it picks a
+    connection, pipelined commands included.
+
+    A controller can be shared by several managers, to bound a whole process.
+
+    :param max_in_flight: commands in flight (``None``: unbounded)
+    :param max_bytes: bytes of arguments of the commands in flight (``None``: unbounded)
+    :param max_in_flight_per_connection: commands in flight on one connection (``None``: unbounded)
+    :param policy: see :class:`AdmissionPolicy`
+    :param max_waiting: callers waiting for a slot (``None``: unbounded with ``WAIT``,
+        `max_in_flight` with ``SHED``)
+
+    :ivar admitted: commands admitted
+    :ivar rejected: commands refused with :class:`~asyncio_redis_ha.exceptions.OverloadedError`
+        (including the shed ones)
+    :ivar shed: waiting commands failed to make room for a command of higher priority
+    """
+
+    def __init__(self, max_in_flight=None, max_bytes=None, max_in_flight_per_connection=None,
+                 policy=AdmissionPolicy.WAIT, max_waiting=None, loop=None):
+        if policy not in (AdmissionPolicy.WAIT, AdmissionPolicy.FAIL_FAST, AdmissionPolicy.SHED):
+            raise ValueError('Unknown admission policy %r' % policy)
+        if max_waiting is None and policy == AdmissionPolicy.SHED:
+            max_waiting = max_in_flight or 0
+        self.max_in_flight = max_in_flight
+        self.max_bytes = max_bytes
+        self.max_in_flight_per_connection = max_in_flight_per_connection
+        self.policy = policy
+        self.max_waiting = max_waiting
+        self._loop = loop or asyncio.get_event_loop()
+
+        self._waiters = []  # heap of [-priority, sequence, size, count, future]
+        self._sequence = itertools.count()
+        self._release_waiters = []
+
+        self.in_flight = 0
+        self.bytes_in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+
+    def __repr__(self):
+        return 'AdmissionController(policy=%r, in_flight=%r, bytes_in_flight=%r, waiting=%r)' % (
+            self.policy, self.in_flight, self.bytes_in_flight, self.waiting)
+
+    @property
+    def waiting(self):
+        """ Callers waiting for a slot. """
+        return len(self._waiters)
+
+    def _fits(self, size, count=1):
+        if self.max_in_flight is not None and self.in_flight and self.in_flight + count > self.max_in_flight:
+            return False
+        if self.max_bytes is not None and self.in_flight and self.bytes_in_flight + size > self.max_bytes:
+            return False
+        return True
+
+    def _admit(self, size, count=1):
+        self.in_flight += count
+        self.bytes_in_flight += size
+        self.admitted += count
+
+    def _reject(self, message):
+        self.rejected += 1
+        return OverloadedError(message)
+
+    @asyncio.coroutine
+    def acquire(self, size=0, priority=0, count=1):
+        """
+        Wait until a command of `size` bytes can be sent, or raise
+        :class:`~asyncio_redis_ha.exceptions.OverloadedError`.
+        Every successful call must be paired with a :meth:`release`.
+
+        :param priority: commands with a higher priority are admitted first, and shed last
+        :param count: commands sent together (a pipeline), `size` being their total
+        """
+        if not self._waiters and self._fits(size, count):
+            self._admit(size, count)
+            return
+
+        if self.policy == AdmissionPolicy.FAIL_FAST:
+            raise self._reject('Overloaded: %s commands, %s bytes in flight' % (self.in_flight, self.bytes_in_flight))
+
+        entry = [-priority, next(self._sequence), size, count, None]
+        if self.max_waiting is not None and len(self._waiters) >= self.max_waiting:
+            lowest = max(self._waiters) if self._waiters else None
+            if self.policy == AdmissionPolicy.WAIT or lowest is None or entry[:2] > lowest[:2]:
+                if self.policy == AdmissionPolicy.SHED:
+                    self.shed += 1
+                raise self._reject('Overloaded: %s commands waiting' % len(self._waiters))
+            self._waiters.remove(lowest)
+            heapq.heapify(self._waiters)
+            self.shed += 1
+            lowest[4].set_exception(self._reject('Shed for a command of higher priority'))
+
+        future = entry[4] = asyncio.Future(loop=self._loop)
+        heapq.heappush(self._waiters, entry)
+        try:
+            yield from future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # admitted meanwhile
+                self.release(size, count)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._wakeup()
+            raise
+
+    def release(self, size=0, count=1):
+        """ A command admitted by :meth:`acquire` completed. """
+        self.in_flight -= count
+        self.bytes_in_flight -= size
+        self._wakeup()
+
+        waiters, self._release_waiters = self._release_waiters, []
+        for f in waiters:
+            if not f.done():
+                f.set_result(None)
+
+    def _wakeup(self):
+        while self._waiters and self._fits(*self._waiters[0][2:4]):
+            priority, sequence, size, count, future = heapq.heappop(self._waiters)
+            if future.done():
+                # cancelled, not removed yet
+                continue
+            self._admit(size, count)
+            future.set_result(None)
+
+    @asyncio.coroutine
+    def wait_release(self):
+        """ Wait until any admitted command completes. """
+        future = asyncio.Future(loop=self._loop)
+        self._release_waiters.append(future)
+        yield from future
@@ -0,0 +1,303 @@
+import asyncio
+from collections import deque
+
+from asyncio_redis import NotConnectedError
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.log import logger
+
+
+@asyncio.coroutine
+def _for_each(items, callback, loop):
+    """ Call the coroutine `callback` with every item of a sync or async iterable. """
+    if hasattr(items, '__aiter__'):
+        iterator = items.__aiter__()
+        while True:
+            try:
+                item = yield from ensure_future(iterator.__anext__(), loop=loop)
+            except StopAsyncIteration:
+                return
+            yield from callback(item)
+    else:
+        for item in items:
+            yield from callback(item)
+
+
+class BulkLoader:
+    """
+    Write a large number of keys through a :class:`~asyncio_redis_ha.ConnectionManager`.
+
+    ::
+
+        loader = manager.bulk_loader(chunk_size=1000)
+        yield from loader.load(items)     # (key, value) or (key, value, ttl) items
+        print(loader.written, loader.rate, loader.failed)
+
+    Items are grouped in batches of `chunk_size`, written as one pipeline: an
+    ``MSET`` of the items without TTL and a ``SETEX`` per item with one.
+    Batches are spread over the connections of the pool, at most
+    `max_in_flight` at a time: the source (a sync or async iterable) is not
+    read further until a batch completes.
+
+    A batch failing because its connection was lost is sent again (writes are
+    idempotent), up to `retries` times. Items which could not be written are
+    listed in :attr:`failed` with their error, an error of the ``MSET`` fails
+    all the items it contains, as does any other error of the batch (an
+    overloaded or closed pool, a protocol error...).
+
+    :param manager: ConnectionManager
+    :param chunk_size: items per batch
+    :param max_in_flight: batches written at the same time, defaults to the poolsize
+    :param retries: attempts to send a batch again after a connection error
+    :param retry_interval: delay between those attempts
+    """
+
+    def __init__(self, manager, chunk_size=1000, max_in_flight=None, retries=2, retry_interval=.1, loop=None):
+        self._manager = manager
+        self._loop = loop or manager._loop
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight or manager.poolsize
+        self.retries = retries
+        self.retry_interval = retry_interval
+
+        #: Items read from the source.
+        self.queued = 0
+        #: Items written.
+        self.written = 0
+        #: ``[(key, exception)]`` of the items which could not be written.
+        self.failed = []
+        #: Batches completed.
+        self.batches = 0
+        #: Batches being written.
+        self.in_flight = 0
+        self._started = None
+        self._finished = None
+
+    def __repr__(self):
+        return 'BulkLoader(queued=%r, written=%r, failed=%r, in_flight=%r)' % (
+            self.queued, self.written, len(self.failed), self.in_flight)
+
+    @property
+    def elapsed(self):
+        """ Seconds since the load started (until it finished). """
+        if self._started is None:
+            return 0.
+        return (self._finished or self._loop.time()) - self._started
+
+    @property
+    def rate(self):
+        """ Items written per second. """
+        elapsed = self.elapsed
+        return self.written / elapsed if elapsed else 0.
+
+    @asyncio.coroutine
+    def load(self, items):
+        """
+        Write every item of `items`, a sync or async iterable of
+        ``(key, value)`` or ``(key, value, ttl)`` tuples (`ttl` in seconds,
+        or ``None``). Returns the loader once every batch completed.
+        """
+        self._started = self._loop.time()
+        self._finished = None
+        semaphore = asyncio.Semaphore(self.max_in_flight, loop=self._loop)
+        tasks = set()
+        batch = []
+
+        def batch_done(task):
+            tasks.discard(task)
+            semaphore.release()
+
+        @asyncio.coroutine
+        def submit():
+            yield from semaphore.acquire()
+            task = ensure_future(self._write_batch(list(batch)), loop=self._loop)
+            task.add_done_callback(batch_done)
+            tasks.add(task)
+            del batch[:]
+
+        @asyncio.coroutine
+        def add(item):
+            batch.append(item)
+            self.queued += 1
+            if len(batch) >= self.chunk_size:
+                yield from submit()
+
+        try:
+            yield from _for_each(items, add, self._loop)
+            if batch:
+                yield from submit()
+            if tasks:
+                yield from asyncio.wait(list(tasks), loop=self._loop)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._finished = self._loop.time()
+        return self
+
+    @asyncio.coroutine
+    def _write_batch(self, batch):
+        self.in_flight += 1
+        try:
+            plain = [item for item in batch if len(item) < 3 or item[2] is None]
+            expiring = [item for item in batch if len(item) >= 3 and item[2] is not None]
+
+            commands = (1 if plain else 0) + len(expiring)
+
+            for attempt in range(self.retries + 1):
+                pipeline = self._manager.pipeline(max_commands=commands)
+                if plain:
+                    pipeline.mset(dict(item[:2] for item in plain))
+                for key, value, ttl in expiring:
+                    pipeline.setex(key, ttl, value)
+
+                try:
+                    results = yield from pipeline.execute(raise_on_error=False)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # (only lost connections are retried)
+                    results = [e] * commands
+                lost = [r for r in results if isinstance(r, (ConnectionError, NotConnectedError))]
+                if lost and attempt < self.retries:
+                    logger.info('bulk load batch of %s items failed, retrying: %r', len(batch), lost[0])
+                    yield from asyncio.sleep(self.retry_interval, loop=self._loop)
+                    continue
+                break
+
+            if plain:
+                result, results = results[0], results[1:]
+                self._count(plain, result)
+            for item, result in zip(expiring, results):
+                self._count([item], result)
+            self.batches += 1
+        finally:
+            self.in_flight -= 1
+
+    def _count(self, items, result):
+        if isinstance(result, Exception):
+            self.failed.extend((item[0], result) for item in items)
+        else:
+            self.written += len(items)
+
+
+class BulkReader:
+    """
+    Read the values of many keys through a :class:`~asyncio_redis_ha.ConnectionManager`
+    with concurrent ``MGET`` requests of `chunk_size` keys.
+
+    ::
+
+        values = yield from manager.bulk_get(keys, chunk_size=1000)
+
+        reader = manager.bulk_reader(keys)
+        while True:
+            chunk = yield from reader.fetchchunk()    # [(key, value), ...]
+            if chunk is None:
+                break
+
+    Up to `max_in_flight` chunks are requested ahead of the one being
+    consumed, on as many connections (replica connections when the manager
+    reads from replicas). Results are returned in the order of the keys, a
+    chunk hit by a lost connection is requested again, up to `retries` times.
+
+    :param manager: ConnectionManager
+    :param keys: the keys to read
+    :param chunk_size: keys per ``MGET``
+    :param max_in_flight: chunks requested at the same time, defaults to the poolsize
+    :param retries: attempts to request a chunk again after a connection error
+    :param retry_interval: delay between those attempts
+    """
+
+    def __init__(self, manager, keys, chunk_size=1000, max_in_flight=None, retries=2, retry_interval=.1, loop=None):
+        self._manager = manager
+        self._loop = loop or manager._loop
+        self.keys = list(keys)
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight or manager.poolsize
+        self.retries = retries
+        self.retry_interval = retry_interval
+
+        self._next = 0  # offset of the next chunk to request
+        self._pending = deque()  # (chunk keys, task), in order
+        self._current = deque()  # pairs of the chunk being consumed
+        #: Chunks read so far.
+        self.chunks = 0
+
+    def __repr__(self):
+        return 'BulkReader(keys=%r, chunks=%r, in_flight=%r)' % (len(self.keys), self.chunks, len(self._pending))
+
+    @asyncio.coroutine
+    def _read_chunk(self, keys):
+        for attempt in range(self.retries + 1):
+            try:
+                return (yield from self._manager.mget_aslist(keys))
+            except (ConnectionError, NotConnectedError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.info('bulk read of %s keys failed, retrying: %r', len(keys), e)
+                yield from asyncio.sleep(self.retry_interval, loop=self._loop)
+
+    def _request(self):
+        while len(self._pending) < self.max_in_flight and self._next < len(self.keys):
+            keys = self.keys[self._next:self._next + self.chunk_size]
+            self._next += len(keys)
+            self._pending.append((keys, ensure_future(self._read_chunk(keys), loop=self._loop)))
+
+    @asyncio.coroutine
+    def fetchchunk(self):
+        """ ``[(key, value), ...]`` of the next chunk, ``None`` after the last one. """
+        if self._current:
+            # rest of the chunk being consumed by fetchone()
+            pairs = list(self._current)
+            self._current.clear()
+            return pairs
+        self._request()
+        if not self._pending:
+            return None
+        keys, task = self._pending[0]
+        try:
+            values = yield from task
+        except:
+            self.close()
+            raise
+        self._pending.popleft()
+        self.chunks += 1
+        self._request()
+        return list(zip(keys, values))
+
+    @asyncio.coroutine
+    def fetchone(self):
+        """ The next ``(key, value)`` pair, ``None`` after the last one. """
+        if not self._current:
+            chunk = yield from self.fetchchunk()
+            if chunk is None:
+                return None
+            self._current.extend(chunk)
+        return self._current.popleft()
+
+    @asyncio.coroutine
+    def fetchall(self):
+        """ The values of the remaining keys, in order (``None`` for missing keys). """
+        values = []
+        while True:
+            chunk = yield from self.fetchchunk()
+            if chunk is None:
+                return values
+            values.extend(value for key, value in chunk)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        pair = yield from self.fetchone()
+        if pair is None:
+            raise StopAsyncIteration
+        return pair
+
+    def close(self):
+        """ Cancel the requests in flight. """
+        self._next = len(self.keys)
+        for keys, task in self._pending:
+            task.cancel()
+        self._pending.clear()
@@ -0,0 +1,282 @@
+import asyncio
+import binascii
+import copy
+import os
+import sys
+from collections import OrderedDict
+
+from asyncio_redis_ha.pubsub import MasterSubscriber
+
+
+def _copy(value):
+    """ A copy of a mutable reply, so that callers can't modify the cached one. """
+    if isinstance(value, (dict, list, set)):
+        return copy.copy(value)
+    return value
+
+
+def _sizeof(value):
+    """ Approximate memory used by a cached reply. """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+
+class _PendingRead:
+    """ A read in flight, marked stale when its key is invalidated before it completes. """
+    __slots__ = ('stale',)
+
+    def __init__(self):
+        self.stale = False
+
+
+class NearCache(MasterSubscriber):
+    """
+    Client side cache for the replies of read-only commands, in front of a
+    :class:`~asyncio_redis_ha.ConnectionManager`.
+
+    ::
+
+        cache = yield from NearCache.create(manager, max_entries=10000)
+        value = yield from cache.get('key')         # cached
+        yield from cache.set('key', 'value')        # passed through, invalidates 'key'
+
+    Entries are invalidated by keyspace notifications, received on a
+    dedicated pubsub connection to the master. The server has to publish them
+    (``notify-keyspace-events`` containing ``K`` and the classes of the cached
+    keys, ``KA`` for all of them), set `configure_server` to have the cache
+    configure it.
+    The cache is flushed when the master is rediscovered (failover) or the
+    invalidation connection is lost, and replies are not cached until it is
+    subscribed again.
+    The reads which populate the cache are sent to the master, even with
+    `read_from_replicas`: a replica may not have applied a write yet when its
+    invalidation is received.
+    ``FLUSHDB``/``FLUSHALL`` do not produce keyspace notifications, the cache
+    is only flushed when they are sent through it.
+
+    :param manager: ConnectionManager
+    :param commands: names of the read-only commands to cache. (Commands
+        returning reply objects, like ``hgetall``, can not be cached, use the
+        ``_asdict``/``_aslist`` methods instead.)
+    :param max_entries: maximum number of cached replies
+    :param max_bytes: maximum memory used by cached replies (approximately)
+    :param ttl: (optional) expire entries after this many seconds, as a safety net
+    :param configure_server: enable keyspace notifications on the master
+    :param retry_interval: delay between attempts to resubscribe
+    :param subscribe_timeout: seconds to wait for the subscription to be confirmed
+        before reconnecting
+    """
+    DEFAULT_COMMANDS = ('get', 'hget', 'hgetall_asdict')
+
+    def __init__(self, manager, commands=DEFAULT_COMMANDS, max_entries=10000, max_bytes=16 * 1024 * 1024,
+                 ttl=None, configure_server=False, retry_interval=.5, subscribe_timeout=5., loop=None):
+        registry = manager.config.protocol_class.commands
+        for name in commands:
+            info = registry.get(name)
+            if info is None or not info.is_readonly:
+                raise ValueError('%r is not a read-only command' % name)
+
+        super().__init__(manager, retry_interval=retry_interval, loop=loop)
+        self._registry = registry
+        self._commands = frozenset(commands)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.configure_server = configure_server
+        self.subscribe_timeout = subscribe_timeout
+
+        self._entries = OrderedDict()  # (name, args, kwargs) -> (value, size, expires, keys)
+        self._by_key = {}  # redis key -> set of entry keys
+        self._pending = {}  # redis key -> list of _PendingRead
+        self._prefix = '__keyspace@%s__:' % manager.config.db
+        self._probe = self._probe_channel = '__near_cache__:%s' % binascii.hexlify(os.urandom(16)).decode()
+
+        #: Approximate memory used by the cached replies.
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.flushes = 0
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, manager, **kwargs):
+        """
+        Create a near cache and subscribe it to invalidations.
+        Takes the same arguments as :class:`NearCache`.
+        """
+        self = cls(manager, **kwargs)
+        if self.configure_server:
+            yield from manager.config_set('notify-keyspace-events', 'KA')
+        yield from self._open()
+        return self
+
+    def __repr__(self):
+        return 'NearCache(entries=%r, bytes=%r, active=%r)' % (len(self._entries), self.bytes, self._active)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Invalidation
+
+    @asyncio.coroutine
+    def _subscribed(self, subscription):
+        patterns = self._encode_names([self._prefix + '*', self._probe])
+        self._probe_channel = patterns[1]
+        yield from subscription.psubscribe(patterns)
+
+        # PSUBSCRIBE is not confirmed through asyncio_redis, publish to the
+        # probe channel until the server counts this connection as a receiver.
+        deadline = self._loop.time() + self.subscribe_timeout
+        delay = .01
+        while not (yield from self._manager.publish(self._probe_channel, self._probe_channel)):
+            if self._loop.time() + delay > deadline:
+                raise ConnectionError('Subscription not confirmed within %ss' % self.subscribe_timeout)
+            yield from asyncio.sleep(delay, loop=self._loop)
+            delay = min(delay * 2, self.retry_interval)
+        self.flush()
+
+    def _dispatch(self, message):
+        if message.channel != self._probe_channel:
+            self.invalidate(message.channel[len(self._prefix):])
+
+    def _disconnected(self):
+        """ Invalidations may be missed, anything cached may be stale. """
+        self.flush()
+
+    def invalidate(self, key):
+        """ Drop the cached replies of `key`. """
+        self.invalidations += 1
+        for pending in self._pending.get(key, ()):
+            pending.stale = True
+        for entry_key in list(self._by_key.get(key, ())):
+            self._remove(entry_key)
+
+    def flush(self):
+        """ Drop every cached reply. """
+        self.flushes += 1
+        for pending_reads in self._pending.values():
+            for pending in pending_reads:
+                pending.stale = True
+        self._entries.clear()
+        self._by_key.clear()
+        self.bytes = 0
+
+    def close(self):
+        super().close()
+        self.flush()
+
+    # Storage
+
+    def _remove(self, entry_key):
+        value, size, expires, keys = self._entries.pop(entry_key)
+        self.bytes -= size
+        for key in keys:
+            entries = self._by_key[key]
+            entries.discard(entry_key)
+            if not entries:
+                del self._by_key[key]
+
+    def _store(self, entry_key, keys, value):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        if entry_key in self._entries:
+            self._remove(entry_key)
+
+        expires = self._loop.time() + self.ttl if self.ttl else None
+        self._entries[entry_key] = (value, size, expires, keys)
+        self.bytes += size
+        for key in keys:
+            self._by_key.setdefault(key, set()).add(entry_key)
+
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    # Commands
+
+    @asyncio.coroutine
+    def _cached_call(self, name, args, kwargs):
+        info = self._registry[name]
+        keys = tuple(info.keys(args, kwargs))
+        try:
+            entry_key = (name, args, tuple(sorted(kwargs.items())))
+            entry = self._entries.get(entry_key)
+        except TypeError:
+            # unhashable arguments
+            return (yield from getattr(self._manager, name)(*args, **kwargs))
+
+        if entry is not None:
+            value, size, expires, _ = entry
+            if expires is None or expires > self._loop.time():
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return _copy(value)
+            self._remove(entry_key)
+
+        self.misses += 1
+        if not self._active:
+            return (yield from getattr(self._manager, name)(*args, **kwargs))
+
+        pending = _PendingRead()
+        for key in keys:
+            self._pending.setdefault(key, []).append(pending)
+        try:
+            value = yield from self._manager._guard(name, session=self)(*args, **kwargs)
+        finally:
+            for key in keys:
+                pending_reads = self._pending[key]
+                pending_reads.remove(pending)
+                if not pending_reads:
+                    del self._pending[key]
+
+        if not pending.stale and self._active:
+            self._store(entry_key, keys, _copy(value))
+        return value
+
+    @asyncio.coroutine
+    def _send(self, name, args, kwargs, sent):
+        # Sends the reads populating the cache, through the deadlines and the
+        # admission control of the manager, to the master.
+        manager = self._manager
+        connection = yield from manager._acquire_connection()
+        sent.append(connection)
+        return (yield from manager._send_on(connection, name, args, kwargs))
+
+    @asyncio.coroutine
+    def _write_call(self, info, args, kwargs):
+        try:
+            return (yield from getattr(self._manager, info.name)(*args, **kwargs))
+        finally:
+            # Don't wait for the notification to see our own writes.
+            if info.command in ('flushdb', 'flushall'):
+                self.flush()
+            else:
+                for key in info.keys(args, kwargs):
+                    self.invalidate(key)
+
+    def __getattr__(self, name):
+        """
+        Cached commands are answered from the cache when possible, any other
+        command is passed to the manager.
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self._commands:
+            def cached(*args, **kwargs):
+                return self._cached_call(name, args, kwargs)
+            return cached
+
+        info = self._registry.get(name)
+        if info is not None and info.is_write:
+            def write(*args, **kwargs):
+                return self._write_call(info, args, kwargs)
+            return write
+
+        return getattr(self._manager, name)
@@ -0,0 +1,196 @@
+from inspect import signature
+from types import MappingProxyType
+
+from asyncio_redis.protocol import ListOf, _all_commands as _core_commands
+
+
+class CommandFlags:
+    """
+    Bitmask describing what a command does, see :attr:`CommandInfo.flags`.
+    """
+    #: Only reads data, safe to run on a replica.
+    READONLY = 1 << 0
+    #: Modifies data, has to run on the master.
+    WRITE = 1 << 1
+    #: May block the connection until data arrives (or the timeout).
+    BLOCKING = 1 << 2
+    #: Puts the connection in, or belongs to, pubsub mode.
+    PUBSUB = 1 << 3
+    #: Server administration and introspection.
+    ADMIN = 1 << 4
+
+
+#: Suffixes of the alternate methods generated for one command (e.g. ``hgetall_asdict``).
+_SUFFIXES = ('_aslist', '_asset', '_asdict', '_asrecords')
+
+#: Commands flagged ``readonly`` by Redis (``COMMAND``), including those
+#: asyncio_redis does not expose, for protocol subclasses adding them.
+#: Anything missing is treated as a write, and never sent to a replica.
+_READONLY = frozenset([
+    'get', 'getrange', 'substr', 'mget', 'strlen', 'lcs', 'getbit', 'bitcount', 'bitpos', 'bitfield_ro',
+    'exists', 'keys', 'randomkey', 'type', 'ttl', 'pttl', 'expiretime', 'pexpiretime', 'dump', 'object',
+    'touch', 'sort_ro', 'dbsize',
+    'llen', 'lrange', 'lindex', 'lpos',
+    'scard', 'sismember', 'smismember', 'smembers', 'srandmember', 'sinter', 'sintercard', 'sunion', 'sdiff',
+    'zcard', 'zcount', 'zlexcount', 'zscore', 'zmscore', 'zrank', 'zrevrank', 'zrandmember',
+    'zrange', 'zrevrange', 'zrangebyscore', 'zrevrangebyscore', 'zrangebylex', 'zrevrangebylex',
+    'zdiff', 'zinter', 'zintercard', 'zunion',
+    'hget', 'hmget', 'hexists', 'hlen', 'hstrlen', 'hkeys', 'hvals', 'hgetall', 'hrandfield',
+    'pfcount', 'geohash', 'geopos', 'geodist', 'geosearch', 'georadius_ro', 'georadiusbymember_ro',
+    'xrange', 'xrevrange', 'xlen', 'xpending', 'xinfo',
+    'eval_ro', 'evalsha_ro', 'fcall_ro',
+    'scan', 'sscan', 'hscan', 'zscan', '_scan', '_do_scan',
+    # Not flagged readonly by Redis, but harmless on a replica.
+    'echo', 'ping',
+])
+_BLOCKING = frozenset(['blpop', 'brpop', 'brpoplpush'])
+_PUBSUB = frozenset([
+    'start_subscribe', '_subscribe', '_unsubscribe', '_psubscribe', '_punsubscribe',
+    'publish', 'pubsub_channels', 'pubsub_numsub', 'pubsub_numpat',
+])
+_ADMIN = frozenset([
+    'auth', 'select', 'save', 'bgsave', 'bgrewriteaof', 'lastsave', 'shutdown', 'info', 'role',
+    'config_set', 'config_get', 'config_rewrite', 'config_resetstat',
+    'client_getname', 'client_setname', 'client_list', 'client_kill',
+    'script_exists', 'script_flush', 'script_kill',
+    'get_master_addr_by_name', 'slaves', 'sentinels',
+])
+#: Administrative commands which also modify data.
+_ADMIN_WRITE = frozenset(['flushall', 'flushdb', 'script_flush'])
+
+#: Parameter names holding keys.
+_KEY_PARAMS = frozenset(['key', 'keys', 'newkey', 'destkey', 'srckeys', 'source', 'destination'])
+#: Commands taking a ``{key: value}`` mapping, and the name of that parameter.
+_KEY_MAPPINGS = {'mset': 'values'}
+
+
+def base_command(name):
+    """ Command name without the alternate method suffix. """
+    for suffix in _SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def command_flags(command):
+    """ :class:`CommandFlags` of a command, given its base name. """
+    flags = 0
+    if command in _READONLY:
+        flags |= CommandFlags.READONLY
+    if command in _BLOCKING:
+        flags |= CommandFlags.BLOCKING
+    if command in _PUBSUB:
+        flags |= CommandFlags.PUBSUB
+    if command in _ADMIN:
+        flags |= CommandFlags.ADMIN
+    if command in _ADMIN_WRITE or not flags & (CommandFlags.READONLY | CommandFlags.PUBSUB | CommandFlags.ADMIN):
+        flags |= CommandFlags.WRITE
+    return flags
+
+
+class CommandInfo:
+    """
+    Description of a protocol command method.
+
+    :ivar name: method name, e.g. ``hgetall_asdict``
+    :ivar command: base command name, e.g. ``hgetall``
+    :ivar flags: :class:`CommandFlags` bitmask
+    """
+    __slots__ = ('name', 'command', 'flags', '_method', '_key_params')
+
+    def __init__(self, name, method):
+        self.name = name
+        self.command = base_command(name)
+        self.flags = command_flags(self.command)
+        self._method = method
+        self._key_params = None
+
+    @property
+    def is_readonly(self):
+        return bool(self.flags & CommandFlags.READONLY)
+
+    @property
+    def is_write(self):
+        return bool(self.flags & CommandFlags.WRITE)
+
+    @property
+    def is_blocking(self):
+        return bool(self.flags & CommandFlags.BLOCKING)
+
+    @property
+    def is_pubsub(self):
+        return bool(self.flags & CommandFlags.PUBSUB)
+
+    @property
+    def is_admin(self):
+        return bool(self.flags & CommandFlags.ADMIN)
+
+    @property
+    def key_params(self):
+        """
+        ``((position, name, is_list), ...)`` of the parameters holding keys,
+        positions counted after the transaction argument.
+        (Inspected on first use, so building the registry stays cheap.)
+        """
+        if self._key_params is None:
+            parameters = list(signature(self._method).parameters.values())[2:]
+            annotations = getattr(self._method, '__annotations__', {})
+            mapping = _KEY_MAPPINGS.get(self.command)
+            self._key_params = tuple(
+                (i, p.name, isinstance(annotations.get(p.name), ListOf) or p.name in ('keys', 'srckeys', mapping))
+                for i, p in enumerate(parameters) if p.name in _KEY_PARAMS or p.name == mapping)
+        return self._key_params
+
+    def keys(self, args, kwargs):
+        """ Keys referenced by a call with ``*args, **kwargs``. """
+        result = []
+        for position, name, is_list in self.key_params:
+            if position < len(args):
+                value = args[position]
+            elif name in kwargs:
+                value = kwargs[name]
+            else:
+                continue
+            if value is None:
+                continue
+            if is_list:
+                result.extend(value)
+            else:
+                result.append(value)
+        return result
+
+    def __repr__(self):
+        return 'CommandInfo(name=%r, flags=%r)' % (self.name, self.flags)
+
+
+def build_registry(cls, new_commands=()):
+    """
+    Return the frozen ``{method name: CommandInfo}`` mapping of a protocol
+    class: the registries of its bases, plus `new_commands` as
+    ``(name, method)`` pairs.
+    Bases created by asyncio_redis have no registry, their commands are
+    taken from the ones it registered.
+    """
+    registry = {}
+    for base in reversed(cls.__mro__[1:]):
+        commands = base.__dict__.get('commands')
+        if isinstance(commands, MappingProxyType):
+            registry.update(commands)
+        else:
+            registry.update(_core_registry(base))
+    for name, method in new_commands:
+        registry[name] = CommandInfo(name, method)
+    return MappingProxyType(registry)
+
+
+_core_registries = {}
+
+
+def _core_registry(cls):
+    """ Registry of the commands defined by an asyncio_redis protocol class itself. """
+    try:
+        return _core_registries[cls]
+    except KeyError:
+        names = set(_core_commands) & set(cls.__dict__)
+        registry = _core_registries[cls] = {name: CommandInfo(name, cls.__dict__[name]) for name in names}
+        return registry
@@ -3,15 +3,10 @@ import logging
 
 from asyncio_redis.connection import Connection
 
+from asyncio_redis_ha.compat import ensure_future
 from asyncio_redis_ha.protocol import ExtendedProtocol
 from .log import logger
-from .protocol import _all_commands, SentinelProtocol
-
-# In Python 3.4.4, `async` was renamed to `ensure_future`.
-try:
-    ensure_future = asyncio.ensure_future
-except AttributeError:
-    ensure_future = asyncio.async
+from .protocol import SentinelProtocol
 
 
 class RedisConnection(Connection):
@@ -138,13 +133,11 @@ class RedisConnection(Connection):
                 yield from asyncio.sleep(interval, loop=self._loop)
 
     def __getattr__(self, name):
-        try:
-            return super().__getattr__(name)
-        except AttributeError:
-            # Only proxy commands.
-            if name not in _all_commands:
-                raise AttributeError
-        return getattr(self.protocol, name)
+        # Only proxy commands.
+        protocol = self.__dict__.get('protocol')
+        if protocol is None or name not in protocol.commands:
+            raise AttributeError(name)
+        return getattr(protocol, name)
 
 
 class SentinelConnection(RedisConnection):
@@ -163,9 +156,3 @@ class SentinelConnection(RedisConnection):
                                            protocol_class=protocol_class,
                                            auto_reconnect=auto_reconnect, reconnect_cb=reconnect_cb)
 
-    def __getattr__(self, name):
-        # Only proxy commands.
-        if name not in _all_commands:
-            raise AttributeError
-
-        return getattr(self.protocol, name)
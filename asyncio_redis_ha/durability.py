@@ -0,0 +1,115 @@
+import asyncio
+from fnmatch import fnmatchcase
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.exceptions import NotReplicatedError
+
+
+class WaitPolicy:
+    """
+    Writes acknowledged only once replicated, see the `write_policy` option
+    of :class:`~asyncio_redis_ha.ConnectionManager`.
+
+    ::
+
+        policy = WaitPolicy(numreplicas=1, timeout=100, keys=['order:*'])
+        manager = yield from ConnectionManager.create(..., write_policy=policy)
+        yield from manager.set('order:42', data)   # returns once a replica has it
+
+    The selected writes are followed by ``WAIT numreplicas timeout`` on their
+    connection, once the master replied. ``WAIT`` covers every write executed
+    before it on the connection, so concurrent writes share one: the writes
+    whose replies arrive on a connection during the same iteration of the
+    loop are followed by a single ``WAIT``.
+
+    A write replicated to fewer than `numreplicas` replicas within `timeout`
+    raises :class:`~asyncio_redis_ha.exceptions.NotReplicatedError` (it was
+    executed by the master nevertheless), unless `raise_on_timeout` is False.
+
+    ``WAIT`` only covers the writes of its own connection, so it is sent on a
+    connection of the pool, and the commands pipelined behind it on that
+    connection wait for its reply: up to `timeout` when the replicas lag.
+    Keep `timeout` short; waiting forever (``WAIT n 0``) is refused, as it
+    would block the connection as long as a replica is missing.
+
+    :param numreplicas: replicas which have to acknowledge the writes
+    :param timeout: milliseconds ``WAIT`` waits for them (more than 0)
+    :param keys: (optional) glob-style patterns, only writes to a key matching one are selected
+    :param commands: (optional) names of the commands selected (e.g. ``['set', 'hset']``)
+    :param raise_on_timeout: raise when too few replicas acknowledged a write
+
+    :ivar waits: ``WAIT`` sent
+    :ivar writes: writes followed by a ``WAIT``
+    :ivar not_replicated: writes acknowledged by too few replicas
+    """
+
+    def __init__(self, numreplicas=1, timeout=100, keys=None, commands=None, raise_on_timeout=True):
+        if timeout <= 0:
+            raise ValueError('WAIT timeout must be positive, got %r' % timeout)
+        self.numreplicas = numreplicas
+        self.timeout = timeout
+        self.keys = list(keys) if keys is not None else None
+        self.commands = frozenset(commands) if commands is not None else None
+        self.raise_on_timeout = raise_on_timeout
+        self._batches = {}  # connection -> future of the WAIT not sent yet
+
+        self.waits = 0
+        self.writes = 0
+        self.not_replicated = 0
+
+    def __repr__(self):
+        return 'WaitPolicy(numreplicas=%r, timeout=%r, waits=%r, writes=%r)' % (
+            self.numreplicas, self.timeout, self.waits, self.writes)
+
+    def selects(self, info, args, kwargs):
+        """ True when the call described by the :class:`~asyncio_redis_ha.CommandInfo` `info` has to be waited for. """
+        if info is None or not info.is_write or info.is_blocking or info.command == 'wait':
+            return False
+        if self.commands is not None and info.command not in self.commands:
+            return False
+        if self.keys is None:
+            return True
+        for key in info.keys(args, kwargs):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8', 'replace')
+            if any(fnmatchcase(key, pattern) for pattern in self.keys):
+                return True
+        return False
+
+    def _wait(self, connection, loop):
+        """ Future of the number of replicas acknowledging the writes executed on `connection` so far. """
+        batch = self._batches.get(connection)
+        if batch is None:
+            batch = self._batches[connection] = asyncio.Future(loop=loop)
+            # after the other writers woken up by the same replies joined
+            loop.call_soon(self._send_wait, connection, loop)
+        return batch
+
+    def _send_wait(self, connection, loop):
+        batch = self._batches.pop(connection)
+        self.waits += 1
+
+        def done(task):
+            if batch.cancelled():
+                return
+            if task.cancelled():
+                batch.cancel()
+            elif task.exception() is not None:
+                batch.set_exception(task.exception())
+            else:
+                batch.set_result(task.result())
+
+        ensure_future(connection.wait(self.numreplicas, self.timeout), loop=loop).add_done_callback(done)
+
+    @asyncio.coroutine
+    def send(self, connection, send, loop):
+        """ Run the coroutine `send`, a write on `connection`, followed by a ``WAIT``. """
+        result = yield from send
+        self.writes += 1
+        replicas = yield from asyncio.shield(self._wait(connection, loop), loop=loop)
+        if replicas < self.numreplicas:
+            self.not_replicated += 1
+            if self.raise_on_timeout:
+                raise NotReplicatedError(
+                    'Write acknowledged by %s of %s replicas' % (replicas, self.numreplicas), replicas, result)
+        return result
@@ -0,0 +1,56 @@
+import asyncio
+
+from asyncio_redis.exceptions import Error, ScriptKilledError
+
+
+class NoScriptError(ScriptKilledError):
+    """
+    evalsha was called with a SHA the server does not know (``NOSCRIPT``),
+    e.g. on a master promoted after a failover.
+    (Subclass of :class:`~asyncio_redis.exceptions.ScriptKilledError`, which
+    asyncio_redis raises for every evalsha error.)
+    """
+
+
+class ConsumerClosedError(Error):
+    """
+    A pubsub consumer was closed, or disconnected for falling behind
+    (see :class:`~asyncio_redis_ha.OverflowPolicy`).
+    """
+
+
+class OverloadedError(Error):
+    """
+    A command was refused by the :class:`~asyncio_redis_ha.AdmissionController`
+    of the manager (see :class:`~asyncio_redis_ha.AdmissionPolicy`).
+    """
+
+
+class CommandTimeoutError(Error, asyncio.TimeoutError):
+    """
+    A command did not complete before its deadline (see
+    :meth:`ConnectionManager.with_options <asyncio_redis_ha.ConnectionManager.with_options>`
+    and `command_timeouts`). It may still have been executed by the server.
+    """
+
+
+class NotReplicatedError(Error):
+    """
+    A write was acknowledged by fewer replicas than required by the
+    :class:`~asyncio_redis_ha.WaitPolicy` of the manager. (The master executed it.)
+
+    :ivar replicas: number of replicas which acknowledged it
+    :ivar result: result of the write
+    """
+
+    def __init__(self, message, replicas=0, result=None):
+        super().__init__(message)
+        self.replicas = replicas
+        self.result = result
+
+
+class TopologyBusyError(ConnectionError):
+    """
+    The :class:`~asyncio_redis_ha.SharedTopology` was being written by another
+    process during every attempt to read it.
+    """
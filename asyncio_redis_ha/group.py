@@ -0,0 +1,419 @@
+import asyncio
+
+from asyncio_redis import Error
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.connection import SentinelConnection
+from asyncio_redis_ha.exceptions import TopologyBusyError
+from asyncio_redis_ha.log import logger
+from asyncio_redis_ha.protocol import ExtendedProtocol, SentinelProtocol, resolve_protocol_class
+
+
+class SentinelGroup:
+    """
+    Connections to a fleet of sentinels, shared by the
+    :class:`~asyncio_redis_ha.ConnectionManager` instances of every master
+    name it monitors.
+
+    ::
+
+        group = yield from SentinelGroup.create([('10.0.0.1', 26379), ('10.0.0.2', 26379)])
+        users = yield from group.manager('users', poolsize=4)
+        sessions = yield from group.manager('sessions', poolsize=2)
+
+    Concurrent lookups of the same master name share one query. With
+    `watch_events`, one more connection to a sentinel is subscribed to
+    ``+switch-master``, the managers rediscover their master as soon as
+    a failover is announced, instead of on the first failing command.
+
+    With a :class:`~asyncio_redis_ha.SharedTopology`, the worker processes of a
+    host share the discovery: the process elected publisher talks to the
+    sentinels and publishes what it finds, the others read the topology
+    without connecting to any sentinel (unless a master was never published),
+    poll its version every `poll_interval` to follow failovers, and take over
+    when the publisher exits.
+
+    :param sentinels: list of known sentinel instances as tuples ``(host, port)``
+    :param protocol_class: protocol for sentinel connections
+    :param watch_events: subscribe to the failover events of the sentinels
+    :param retry_interval: delay between attempts to resubscribe to the events
+    :param topology: (optional) :class:`~asyncio_redis_ha.SharedTopology`
+    :param poll_interval: delay between reads of the version of the shared topology
+    """
+
+    def __init__(self, sentinels, protocol_class=SentinelProtocol, watch_events=True, retry_interval=.5,
+                 topology=None, poll_interval=.1, loop=None):
+        self.sentinels = sentinels
+        self.protocol_class = resolve_protocol_class(protocol_class)
+        self.watch_events = watch_events
+        self.retry_interval = retry_interval
+        self.topology = topology
+        self.poll_interval = poll_interval
+        self._loop = loop or asyncio.get_event_loop()
+        self._connections = []
+        self._lookups = {}  # master name -> future of the address lookup
+        self._switch_listeners = {}  # master name -> list of callbacks
+
+        self._events = None
+        self._events_listener = None
+        self._events_connecting = None
+        self._topology_watcher = None
+        self._topology_version = 0
+        self._published_masters = {}  # master name -> last address read from the topology
+        self._replicas_listeners = {}  # master name -> list of callbacks
+        self._published_replicas = {}  # master name -> last replicas read from the topology
+        self._closed = False
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, sentinels, **kwargs):
+        """ Create a sentinel group and connect it. Takes the same arguments as :class:`SentinelGroup`. """
+        self = cls(sentinels, **kwargs)
+        yield from self.connect()
+        return self
+
+    def __repr__(self):
+        return 'SentinelGroup(sentinels=%r, masters=%r)' % (len(self.sentinels), sorted(self._switch_listeners))
+
+    @property
+    def sentinels_connected(self):
+        """
+        The amount of open TCP connections to sentinels (not counting the events connection).
+        """
+        return sum([1 for c in self._connections if c.protocol.is_connected])
+
+    @property
+    def is_publisher(self):
+        """ False when the topology is read from a :class:`~asyncio_redis_ha.SharedTopology` published elsewhere. """
+        return self.topology is None or self.topology.is_publisher
+
+    @asyncio.coroutine
+    def connect(self):
+        """
+        (Re)create the connections to the configured sentinels.
+        With a shared topology, they are only created when this process is
+        elected publisher.
+        """
+        if self.topology is not None:
+            if self._topology_watcher is None:
+                self._topology_version = self.topology.version
+                self._topology_watcher = ensure_future(self._watch_topology(), loop=self._loop)
+            if not self.topology.acquire_publisher():
+                return
+        yield from self._connect_sentinels()
+
+    @asyncio.coroutine
+    def _connect_sentinels(self):
+        self._close_connections()
+
+        for conf in self.sentinels:
+            try:
+                logger.info('connecting sentinel (%s, %s)', *conf)
+                connection = yield from SentinelConnection.configurable_create(
+                    *conf, loop=self._loop, protocol_class=self.protocol_class,
+                    auto_reconnect=True, ensure_connection_established=False
+                )
+                """:type connection SentinelConnection"""
+                self._connections.append(connection)
+            except ConnectionError:
+                pass
+        yield from asyncio.sleep(.1, loop=self._loop)  # make sure above coroutines run
+
+    def _close_connections(self):
+        logger.info('closing sentinel connections')
+
+        for s in self._connections:
+            s.close()
+
+        self._connections = []
+
+    @asyncio.coroutine
+    def _query(self, method, name):
+        """ Ask the connected sentinels, one after the other, until one answers. """
+        if self.sentinels_connected < 1:
+            yield from self._connect_sentinels()
+
+        for sentinel in [c for c in self._connections if c.protocol.is_connected]:
+            try:
+                return (yield from getattr(sentinel, method)(name))
+            except ConnectionError:
+                pass
+
+    @asyncio.coroutine
+    def _read_topology(self, method, *args):
+        """
+        Call `method` of the shared topology, letting the loop run while another
+        process writes it. Raises :class:`~asyncio_redis_ha.exceptions.TopologyBusyError`
+        when it is still being written after a while.
+        """
+        for attempt in range(100):
+            try:
+                return getattr(self.topology, method)(*args)
+            except TopologyBusyError:
+                yield from asyncio.sleep(.001, loop=self._loop)
+        return getattr(self.topology, method)(*args)
+
+    @asyncio.coroutine
+    def master_address(self, name):
+        """
+        ``[host, port]`` of the master `name` according to the sentinels,
+        ``None`` when none of them knows it.
+        """
+        lookup = self._lookups.get(name)
+        if lookup is None:
+            lookup = self._lookups[name] = ensure_future(self._master_address(name), loop=self._loop)
+            lookup.add_done_callback(lambda f: self._lookups.pop(name, None))
+        return (yield from asyncio.shield(lookup, loop=self._loop))
+
+    @asyncio.coroutine
+    def _master_address(self, name):
+        if not self.is_publisher:
+            address = yield from self._read_topology('master', name)
+            if address is not None:
+                return list(address)
+
+        reply = yield from self._query('get_master_addr_by_name', name)
+        if reply is not None:
+            address = yield from reply.aslist()
+            if self.topology is not None and self.topology.is_publisher and address:
+                self.topology.update(name, master=address)
+            return address
+
+    @asyncio.coroutine
+    def replicas(self, name):
+        """
+        :class:`~asyncio_redis_ha.ReplicaInfo` of the replicas of the master `name`,
+        ``None`` when no sentinel answered.
+        """
+        if not self.is_publisher:
+            replicas = yield from self._read_topology('replicas', name)
+            if replicas is not None:
+                return replicas
+
+        replicas = yield from self._query('slaves_asrecords', name)
+        if self.topology is not None and self.topology.is_publisher and replicas is not None:
+            self.topology.update(name, replicas=replicas)
+        return replicas
+
+    @asyncio.coroutine
+    def manager(self, cluster_name, db=0, password=None, encoder=None, protocol_class=ExtendedProtocol,
+                poolsize=1, read_from_replicas=False, blocking_poolsize=0, offload_threshold=None, executor=None,
+                admission=None, command_timeouts=None, hedging=None, max_replica_lag=None,
+                max_replica_lag_seconds=None, replica_check_interval=1., write_policy=None):
+        """
+        Create a :class:`~asyncio_redis_ha.ConnectionManager` for the master
+        `cluster_name`, using the sentinel connections of this group.
+        Takes the same arguments as :meth:`ConnectionManager.create`.
+        """
+        from asyncio_redis_ha.manager import ConnectionManager, HighAvailabilityConfig
+
+        config = HighAvailabilityConfig(
+            cluster_name=cluster_name,
+            sentinels=self.sentinels,
+            db=db,
+            password=password,
+            encoder=encoder,
+            protocol_class=protocol_class,
+            sentinel_protocol_class=self.protocol_class,
+            read_from_replicas=read_from_replicas,
+            offload_threshold=offload_threshold,
+            executor=executor,
+            admission=admission,
+            command_timeouts=command_timeouts,
+            hedging=hedging,
+            max_replica_lag=max_replica_lag,
+            max_replica_lag_seconds=max_replica_lag_seconds,
+            replica_check_interval=replica_check_interval,
+            write_policy=write_policy,
+        )
+        manager = ConnectionManager(config, poolsize=poolsize, loop=self._loop,
+                                    blocking_poolsize=blocking_poolsize, group=self)
+        try:
+            yield from manager._discover_master()
+        except:
+            manager.close()
+            raise
+        return manager
+
+    # Failover events
+
+    def add_switch_listener(self, name, callback):
+        """
+        Call ``callback(name, (host, port))`` when a sentinel announces the
+        failover of the master `name` to ``(host, port)``.
+        """
+        self._switch_listeners.setdefault(name, []).append(callback)
+        if self.topology is not None and name not in self._published_masters:
+            try:
+                self._published_masters[name] = self.topology.master(name)
+            except TopologyBusyError:
+                # announced by the next poll
+                pass
+        self._watch_events()
+
+    def _watch_events(self):
+        """ Subscribe to the events of the sentinels, unless another process publishes the topology. """
+        if (self.watch_events and self.is_publisher and self._switch_listeners
+                and self._events is None and self._events_connecting is None):
+            self._reconnect_events()
+
+    def remove_switch_listener(self, name, callback):
+        listeners = self._switch_listeners.get(name, [])
+        listeners.remove(callback)
+        if not listeners:
+            del self._switch_listeners[name]
+
+    def add_replicas_listener(self, name, callback):
+        """
+        Call ``callback(name)`` when the replicas of the master `name`
+        published in the shared topology change (only when following a
+        topology published by another process).
+        """
+        self._replicas_listeners.setdefault(name, []).append(callback)
+        if self.topology is not None and name not in self._published_replicas:
+            try:
+                self._published_replicas[name] = (self.topology.get(name) or {}).get('replicas')
+            except TopologyBusyError:
+                pass
+
+    def remove_replicas_listener(self, name, callback):
+        listeners = self._replicas_listeners.get(name, [])
+        listeners.remove(callback)
+        if not listeners:
+            del self._replicas_listeners[name]
+
+    @asyncio.coroutine
+    def _connect_events(self):
+        """ Subscribe to ``+switch-master`` on the first sentinel accepting a connection. """
+        self._disconnect_events()
+
+        for conf in self.sentinels:
+            try:
+                connection = yield from SentinelConnection.configurable_create(
+                    *conf, loop=self._loop, protocol_class=self.protocol_class, reconnect_cb=self._events_lost)
+            except ConnectionError:
+                continue
+            self._events = connection
+            try:
+                subscription = yield from connection.start_subscribe()
+                channel = '+switch-master'
+                if connection.protocol.native_type is bytes:
+                    channel = channel.encode('utf-8')
+                yield from subscription.subscribe([channel])
+            except:
+                self._disconnect_events()
+                raise
+            self._events_listener = ensure_future(self._listen_events(subscription), loop=self._loop)
+            logger.info('watching sentinel events at %s', conf)
+            return
+        raise ConnectionError('No sentinel available')
+
+    @asyncio.coroutine
+    def _listen_events(self, subscription):
+        while True:
+            message = yield from subscription.next_published()
+            self._dispatch_event(message.value)
+
+    def _dispatch_event(self, value):
+        """ Handle a ``+switch-master`` message: ``name old-host old-port new-host new-port``. """
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        try:
+            name, old_host, old_port, host, port = value.split()
+            address = (host, int(port))
+        except ValueError:
+            logger.warning('unexpected +switch-master message %r', value)
+            return
+        logger.info('sentinel announced master %s at %s', name, address)
+        if self.topology is not None and self.topology.is_publisher:
+            self.topology.update(name, master=address)
+        self._switch_master(name, address)
+
+    def _switch_master(self, name, address):
+        for callback in list(self._switch_listeners.get(name, ())):
+            callback(name, address)
+
+    @asyncio.coroutine
+    def _watch_topology(self):
+        """
+        Follow the shared topology: announce the masters which moved and the
+        replicas which changed, and take over when the publisher is gone.
+        """
+        while not self._closed:
+            yield from asyncio.sleep(self.poll_interval, loop=self._loop)
+            if self.topology.is_publisher:
+                continue
+            if self.topology.acquire_publisher():
+                logger.info('publishing the shared topology %s', self.topology.path)
+                self._watch_events()
+                continue
+
+            if self.topology.version == self._topology_version:
+                continue
+            try:
+                self._topology_version, topology = yield from self._read_topology('read')
+            except TopologyBusyError as e:
+                logger.warning('%s', e)
+                continue
+            for name in set(self._switch_listeners) | set(self._replicas_listeners):
+                entry = topology.get(name) or {}
+                address = tuple(entry['master']) if entry.get('master') else None
+                moved = address is not None and address != self._published_masters.get(name)
+                if moved:
+                    self._published_masters[name] = address
+                    self._switch_master(name, address)
+
+                replicas = entry.get('replicas')
+                if replicas is not None and replicas != self._published_replicas.get(name):
+                    self._published_replicas[name] = replicas
+                    if not moved:
+                        # (the rediscovery of the master finds the replicas too)
+                        for callback in list(self._replicas_listeners.get(name, ())):
+                            callback(name)
+
+    def _disconnect_events(self):
+        if self._events_listener is not None:
+            self._events_listener.cancel()
+            self._events_listener = None
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+    @asyncio.coroutine
+    def _events_lost(self, connection):
+        """ Reconnect callback of the events connection, never reconnects it: another sentinel may be used. """
+        if connection is self._events:
+            logger.warning('lost the sentinel events connection')
+            self._disconnect_events()
+            self._reconnect_events()
+        return False
+
+    def _reconnect_events(self):
+        if self._events_connecting is not None:
+            self._events_connecting.cancel()
+        self._events_connecting = ensure_future(self._reconnect_events_loop(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _reconnect_events_loop(self):
+        while not self._closed:
+            try:
+                yield from self._connect_events()
+                break
+            except (ConnectionError, Error) as e:
+                logger.info('subscribing to sentinel events failed: %r', e)
+                yield from asyncio.sleep(self.retry_interval, loop=self._loop)
+        self._events_connecting = None
+
+    def close(self):
+        """ Close every sentinel connection. (Managers created from the group keep their pools.) """
+        self._closed = True
+        if self._events_connecting is not None:
+            self._events_connecting.cancel()
+            self._events_connecting = None
+        self._disconnect_events()
+        self._close_connections()
+        if self._topology_watcher is not None:
+            self._topology_watcher.cancel()
+            self._topology_watcher = None
+        if self.topology is not None:
+            self.topology.release_publisher()
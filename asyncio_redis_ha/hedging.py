@@ -0,0 +1,97 @@
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    When to send a read a second time, to another node, see the `hedging`
+    option of :class:`~asyncio_redis_ha.ConnectionManager`.
+
+    ::
+
+        hedging = HedgePolicy(percentile=95, budget=.05)
+        manager = yield from ConnectionManager.create(..., read_from_replicas=True, hedging=hedging)
+
+    A read-only command which got no reply after the `percentile` of the
+    latencies observed recently (the last `window` replies) is sent again to
+    another node (a replica, or the master when there is no other replica),
+    the first reply wins. The other request is cancelled, and its connection
+    closed and replaced, as its reply may still arrive: a hedged read costs
+    one reconnect, whichever node wins (a lower `percentile`, or a higher
+    `budget`, means more reconnects).
+
+    The hedges are capped by a budget: every read adds `budget` hedges to
+    spend (at most `burst`), e.g. ``.05`` allows 5% more requests, and at
+    most as many reconnects.
+
+    :param percentile: percentile of the observed latencies after which a read is hedged
+    :param budget: hedges allowed per read
+    :param burst: hedges which can be saved up during quiet periods
+    :param window: number of latencies the percentile is computed from
+    :param initial_delay: delay before the first `min_samples` latencies are known
+    :param min_delay: lower bound of the delay
+    :param min_samples: latencies needed before the percentile is used
+
+    :ivar reads: reads sent with this policy
+    :ivar hedged: reads sent a second time
+    :ivar hedge_wins: hedged reads answered first by the second node
+    :ivar over_budget: reads which would have been hedged but for the budget
+    """
+
+    def __init__(self, percentile=95, budget=.05, burst=10, window=1000, initial_delay=.01, min_delay=.001,
+                 min_samples=20):
+        if not 0 < percentile <= 100:
+            raise ValueError('percentile should be in ]0, 100], not %r' % percentile)
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+
+        self._latencies = deque(maxlen=window)
+        self._delay = None  # cached percentile, None when it has to be computed again
+        self._recorded = 0  # latencies recorded since it was computed
+        self._tokens = 0.
+
+        self.reads = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+
+    def __repr__(self):
+        return 'HedgePolicy(percentile=%r, budget=%r, delay=%r, reads=%r, hedged=%r)' % (
+            self.percentile, self.budget, self.delay, self.reads, self.hedged)
+
+    @property
+    def delay(self):
+        """ Seconds to wait for a reply before hedging a read. """
+        if len(self._latencies) < self.min_samples:
+            return max(self.initial_delay, self.min_delay)
+        if self._delay is None:
+            latencies = sorted(self._latencies)
+            index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.))
+            self._delay = max(latencies[index], self.min_delay)
+            self._recorded = 0
+        return self._delay
+
+    def record(self, latency):
+        """ Add the latency of a reply. """
+        self._latencies.append(latency)
+        self._recorded += 1
+        # recompute the percentile once a tenth of the window has been replaced
+        if self._recorded * 10 >= self._latencies.maxlen:
+            self._delay = None
+
+    def start(self):
+        """ A read is sent, earn its part of the budget. """
+        self.reads += 1
+        self._tokens = min(self._tokens + self.budget, self.burst)
+
+    def allow(self):
+        """ Spend a hedge of the budget, return False when there is none left. """
+        if self._tokens < 1 - 1e-9:  # (budgets like .1 don't add up to 1 exactly)
+            self.over_budget += 1
+            return False
+        self._tokens -= 1
+        self.hedged += 1
+        return True
@@ -1,22 +1,82 @@
 import asyncio
+from collections import Counter
 from functools import wraps
 
-from asyncio_redis import Script, NoAvailableConnectionsInPoolError, NotConnectedError
+from asyncio_redis import Error, ErrorReply, Script, NoAvailableConnectionsInPoolError, NotConnectedError
 
-from asyncio_redis_ha.connection import SentinelConnection, RedisConnection
+from asyncio_redis_ha.admission import AdmissionPolicy, request_size
+from asyncio_redis_ha.connection import RedisConnection, ensure_future
+from asyncio_redis_ha.commands import CommandFlags
+from asyncio_redis_ha.exceptions import CommandTimeoutError, NoScriptError
+from asyncio_redis_ha.group import SentinelGroup
 from asyncio_redis_ha.log import logger
-from asyncio_redis_ha.protocol import ExtendedProtocol
+from asyncio_redis_ha.pipeline import Pipeline
+from asyncio_redis_ha.pubsub import PubSubManager
+from asyncio_redis_ha.protocol import ExtendedProtocol, resolve_protocol_class, sentinel_protocol_for
+from asyncio_redis_ha.replication import ReplicationLag
+from asyncio_redis_ha.scripts import ScriptRegistry
+from asyncio_redis_ha.session import Session
+from asyncio_redis_ha.stats import ManagerStats
 
 
 class HighAvailabilityConfig:
+    """
+    :param protocol_class: protocol for redis connections,
+        e.g. :class:`~asyncio_redis_ha.HiRedisExtendedProtocol`
+        (falls back to the pure-python parser when `hiredis` is missing)
+    :param sentinel_protocol_class: protocol for sentinel connections,
+        defaults to the sentinel protocol using the same parser as `protocol_class`
+    :param read_from_replicas: route read-only commands (see :class:`~asyncio_redis_ha.CommandFlags`)
+        to replica connections, when there are any
+    :param offload_threshold: decode replies of at least this many bytes in `executor`
+        (see :attr:`ExtendedProtocol.offload_threshold <asyncio_redis_ha.ExtendedProtocol.offload_threshold>`)
+    :param executor: executor decoding large replies, defaults to the one of the loop
+    :param admission: (optional) :class:`~asyncio_redis_ha.AdmissionController` bounding the commands in flight
+    :param command_timeouts: (optional) default timeouts in seconds, by command name or
+        :class:`~asyncio_redis_ha.CommandFlags` (e.g. ``{CommandFlags.READONLY: .5, CommandFlags.WRITE: 2}``).
+        Blocking commands only get a timeout set for their name or ``CommandFlags.BLOCKING``.
+    :param hedging: (optional) :class:`~asyncio_redis_ha.HedgePolicy`, sending slow reads to a
+        second node (with `read_from_replicas`)
+    :param max_replica_lag: (with `read_from_replicas`) bytes of replication stream a replica
+        can be behind the master and still serve reads
+    :param max_replica_lag_seconds: the same, in seconds
+    :param replica_check_interval: seconds between reads of the replication offsets, see
+        :class:`~asyncio_redis_ha.ReplicationLag`
+    :param write_policy: (optional) :class:`~asyncio_redis_ha.WaitPolicy`, following selected
+        writes with ``WAIT``
+    """
+
     def __init__(self,
                  cluster_name: str,
                  sentinels: list,
                  db=0,
                  password=None,
                  encoder=None,
-                 protocol_class=ExtendedProtocol):
-        self.protocol_class = protocol_class
+                 protocol_class=ExtendedProtocol,
+                 sentinel_protocol_class=None,
+                 read_from_replicas=False,
+                 offload_threshold=None,
+                 executor=None,
+                 admission=None,
+                 command_timeouts=None,
+                 hedging=None,
+                 max_replica_lag=None,
+                 max_replica_lag_seconds=None,
+                 replica_check_interval=1.,
+                 write_policy=None):
+        self.read_from_replicas = read_from_replicas
+        self.write_policy = write_policy
+        self.max_replica_lag = max_replica_lag
+        self.max_replica_lag_seconds = max_replica_lag_seconds
+        self.replica_check_interval = replica_check_interval
+        self.hedging = hedging
+        self.admission = admission
+        self.command_timeouts = command_timeouts or {}
+        self.offload_threshold = offload_threshold
+        self.executor = executor
+        self.protocol_class = resolve_protocol_class(protocol_class)
+        self.sentinel_protocol_class = resolve_protocol_class(
+            sentinel_protocol_class or sentinel_protocol_for(self.protocol_class))
         self.encoder = encoder
         self.password = password
         self.db = db
@@ -28,21 +88,51 @@ class ConnectionManager:
     """
     Sentinel guarded connection manager, also manages connection Pool (always)
 
-    :type _sentinels: list[SentinelConnection]
+    :type _group: SentinelGroup
     :type _connections: list[RedisConnection]
+    :type _replicas: list[RedisConnection]
+    :type _blocking: list[RedisConnection]
     """
 
-    def __init__(self, config: HighAvailabilityConfig, poolsize=1, loop=None):
+    def __init__(self, config: HighAvailabilityConfig, poolsize=1, loop=None, blocking_poolsize=0, group=None):
         """
 
         :param config: HighAvailabilityConfig
+        :param blocking_poolsize: number of master connections reserved for blocking commands
+        :param group: (optional) :class:`~asyncio_redis_ha.SentinelGroup` to share with other managers,
+            see :meth:`SentinelGroup.manager`. Without it, the manager has sentinel connections of its own.
         """
+        self._loop = loop or asyncio.get_event_loop()
         self._poolsize = poolsize
-        self._sentinels = []
+        self._blocking_poolsize = blocking_poolsize
+        self._owns_group = group is None
+        if group is None:
+            group = SentinelGroup(config.sentinels, protocol_class=config.sentinel_protocol_class,
+                                  watch_events=False, loop=self._loop)
+        self._group = group
+        self._discovery = None
+        self._generation = 0  # bumped by every discovery
         self._connections = []
-        self._loop = loop or asyncio.get_event_loop()
+        self._blocking = []
+        self._replicas = []
+        self._in_flight = Counter()  # connection -> commands in flight
+        self._replication = None
+        self._replication_watcher = None
+        if config.read_from_replicas and (
+                config.max_replica_lag is not None or config.max_replica_lag_seconds is not None):
+            self._replication = ReplicationLag(config.max_replica_lag, config.max_replica_lag_seconds)
+        self._commands = config.protocol_class.commands
+        self._master_address = None
+        self._discovery_listeners = []
+        self.scripts = ScriptRegistry()
+        self._pubsub = None
+        #: :class:`~asyncio_redis_ha.ManagerStats` of this manager.
+        self.stats = ManagerStats()
         self.config = config
         self.cluster_name = self.config.cluster_name
+        group.add_switch_listener(self.cluster_name, self._on_switch_master)
+        if config.read_from_replicas:
+            group.add_replicas_listener(self.cluster_name, self._on_replicas_changed)
 
     @classmethod
     @asyncio.coroutine
@@ -54,7 +144,19 @@ class ConnectionManager:
                encoder=None,
                protocol_class=ExtendedProtocol,
                poolsize=1,
-               loop=None):
+               loop=None,
+               sentinel_protocol_class=None,
+               read_from_replicas=False,
+               blocking_poolsize=0,
+               offload_threshold=None,
+               executor=None,
+               admission=None,
+               command_timeouts=None,
+               hedging=None,
+               max_replica_lag=None,
+               max_replica_lag_seconds=None,
+               replica_check_interval=1.,
+               write_policy=None):
         """
         creates new instance of ConnectionManager, and initializes it
 
@@ -70,9 +172,40 @@ class ConnectionManager:
         :type encoder: :class:`~asyncio_redis.encoders.BaseEncoder` instance.
         :param loop: (optional) asyncio event loop.
         :type protocol_class: :class:`~asyncio_redis_ha.ExtendedProtocol`
-        :param protocol_class: (optional) redis protocol implementation:param protocol_class:
+        :param protocol_class: (optional) redis protocol implementation
+        :type sentinel_protocol_class: :class:`~asyncio_redis_ha.SentinelProtocol`
+        :param sentinel_protocol_class: (optional) sentinel protocol implementation
         :type poolsize: int
-        :param poolsize: The number of parallel connections.
+        :param poolsize: The number of parallel connections (per node).
+        :type read_from_replicas: bool
+        :param read_from_replicas: (optional) send read-only commands to replicas
+        :type blocking_poolsize: int
+        :param blocking_poolsize: (optional) The number of master connections reserved for blocking
+            commands (``blpop``, ``brpop``, ``brpoplpush``), so they can't starve the pool.
+            With 0 they share the pool.
+        :type offload_threshold: int
+        :param offload_threshold: (optional) decode replies of at least this many bytes in an
+            executor instead of the event loop, see :attr:`stats` for the counts.
+        :type executor: :class:`concurrent.futures.Executor`
+        :param executor: (optional) executor for `offload_threshold`, defaults to the one of the loop.
+        :type admission: :class:`~asyncio_redis_ha.AdmissionController`
+        :param admission: (optional) limits on the commands in flight, and what to do with
+            the commands over them.
+        :type command_timeouts: dict
+        :param command_timeouts: (optional) default timeouts by command name or
+            :class:`~asyncio_redis_ha.CommandFlags`, see :class:`HighAvailabilityConfig`.
+        :type hedging: :class:`~asyncio_redis_ha.HedgePolicy`
+        :param hedging: (optional) send read-only commands without a reply after a percentile of
+            the observed latency to a second node, needs `read_from_replicas`.
+        :type max_replica_lag: int
+        :param max_replica_lag: (optional) with `read_from_replicas`, stop reading from replicas
+            more than this many bytes of replication stream behind the master.
+        :type max_replica_lag_seconds: float
+        :param max_replica_lag_seconds: (optional) the same, in seconds.
+        :param replica_check_interval: (optional) seconds between reads of the replication offsets.
+        :type write_policy: :class:`~asyncio_redis_ha.WaitPolicy`
+        :param write_policy: (optional) acknowledge the selected writes once replicated,
+            following them with ``WAIT`` (one per batch of concurrent writes on a connection).
         :return: ConnectionManager
         """
         config = HighAvailabilityConfig(
@@ -82,41 +215,37 @@ class ConnectionManager:
             password=password,
             encoder=encoder,
             protocol_class=protocol_class,
+            sentinel_protocol_class=sentinel_protocol_class,
+            read_from_replicas=read_from_replicas,
+            offload_threshold=offload_threshold,
+            executor=executor,
+            admission=admission,
+            command_timeouts=command_timeouts,
+            hedging=hedging,
+            max_replica_lag=max_replica_lag,
+            max_replica_lag_seconds=max_replica_lag_seconds,
+            replica_check_interval=replica_check_interval,
+            write_policy=write_policy,
         )
 
-        self = cls(config, poolsize=poolsize, loop=loop)
+        self = cls(config, poolsize=poolsize, loop=loop, blocking_poolsize=blocking_poolsize)
         # run initial discovery
         yield from self._discover_master()
         # now we are ready
         return self
 
-    @asyncio.coroutine
-    def _recreate_sentinel_connections(self):
-        """creates connections for configured sentinels, closes previously opened connections if any"""
-        self._close_sentinel_connections()
-
-        for conf in self.config.sentinels:
-            try:
-                logger.info('connecting sentinel (%s, %s)', *conf)
-                connection = yield from SentinelConnection.configurable_create(
-                    *conf, loop=self._loop, auto_reconnect=True, ensure_connection_established=False
-                )
-                """:type connection SentinelConnection"""
-                self._sentinels.append(connection)
-            except ConnectionError:
-                pass
-        yield from asyncio.sleep(.1)  # make sure above coroutines run
-
-    def _close_sentinel_connections(self):
-        logger.info('closing sentinel connections')
-
-        for s in self._sentinels:
-            s.close()
+    @property
+    def group(self):
+        """ The :class:`~asyncio_redis_ha.SentinelGroup` used for discovery. """
+        return self._group
 
-        self._sentinels = []
+    @property
+    def _sentinels(self):
+        """:rtype: list[SentinelConnection]"""
+        return self._group._connections
 
     @asyncio.coroutine
-    def _add_pool_instance(self, host='localhost', port=6379, protocol_class=ExtendedProtocol):
+    def _add_pool_instance(self, host='localhost', port=6379, protocol_class=None, pool=None):
         """
         Create a new connection pool instance.
 
@@ -127,9 +256,11 @@ class ConnectionManager:
         :param poolsize: The number of parallel connections.
         :type poolsize: int
         :type protocol_class: :class:`~asyncio_redis.RedisProtocol`
-        :param protocol_class: (optional) redis protocol implementation
+        :param protocol_class: (optional) redis protocol implementation, defaults to the configured one
+        :type pool: list
+        :param pool: (optional) pool to add the connection to, defaults to the master pool
         """
-        logger.info('connecting redis-master (%s, %s)', host, port)
+        logger.info('connecting redis (%s, %s)', host, port)
         connection = yield from RedisConnection.configurable_create(
             host=host,
             port=port,
@@ -137,10 +268,14 @@ class ConnectionManager:
             db=self.config.db,
             auto_reconnect=False,
             loop=self._loop,
-            protocol_class=protocol_class
+            protocol_class=protocol_class or self.config.protocol_class
         )
         """:type connection RedisConnection"""
-        self._connections.append(connection)
+        protocol = connection.protocol
+        protocol.offload_threshold = self.config.offload_threshold
+        protocol.executor = self.config.executor
+        protocol.stats = self.stats
+        (self._connections if pool is None else pool).append(connection)
         return connection
 
     @asyncio.coroutine
@@ -150,22 +285,26 @@ class ConnectionManager:
     @asyncio.coroutine
     def _discover_master(self):
         """
-        :return: ExtendedProtocol
+        (Re)discover the master and (re)create the pools.
+        Concurrent callers wait for the same discovery.
         """
-        config_pair = None
-        self._close_master_pool()
+        if self._discovery is None:
+            self._discovery = ensure_future(self._do_discover_master(), loop=self._loop)
+            self._discovery.add_done_callback(self._discovery_done)
+        yield from asyncio.shield(self._discovery, loop=self._loop)
 
-        if self.sentinels_connected < 1:
-            yield from self._recreate_sentinel_connections()
+    def _discovery_done(self, future):
+        self._discovery = None
 
-        for sentinel in [c for c in self._sentinels if c.protocol.is_connected]:
-            try:
-                # try retrieve master address from sentinels
-                """:type config_pair list"""
-                config_pair = yield from (yield from sentinel.get_master_addr_by_name(self.cluster_name)).aslist()
-                break
-            except ConnectionError:
-                pass
+    @asyncio.coroutine
+    def _do_discover_master(self):
+        self._generation += 1
+        self._master_address = None
+        self._close_master_pool()
+
+        # try retrieve master address from sentinels
+        """:type config_pair list"""
+        config_pair = yield from self._group.master_address(self.cluster_name)
 
         if not config_pair or not isinstance(config_pair, list):
             raise NotConnectedError('Failed to discover redis-master')
@@ -176,9 +315,12 @@ class ConnectionManager:
                 reply = yield from (yield from connection.role()).aslist()
                 role = reply[0]
                 if role == 'master':
+                    yield from self._load_scripts(connection)
                     # initialize rest of the pool
                     for x in range(self.poolsize - 1):
                         yield from self._add_pool_instance(config_pair[0], int(config_pair[1]))
+                    for x in range(self._blocking_poolsize):
+                        yield from self._add_pool_instance(config_pair[0], int(config_pair[1]), pool=self._blocking)
                 else:
                     self._close_master_pool()
             except ConnectionError:
@@ -187,28 +329,175 @@ class ConnectionManager:
         if self.connections_connected < 1:
             raise NoAvailableConnectionsInPoolError
         logger.info('master at %s', config_pair)
+        self._master_address = (config_pair[0], int(config_pair[1]))
+
+        if self.config.read_from_replicas:
+            yield from self._discover_slaves()
+            if self._replication is not None:
+                self._replication.reset()
+                yield from self._check_replication()
+                if self._replication_watcher is None:
+                    self._replication_watcher = ensure_future(self._watch_replication(), loop=self._loop)
+
+        for callback in list(self._discovery_listeners):
+            callback(self)
+
+    def add_discovery_listener(self, callback):
+        """
+        Call ``callback(manager)`` every time a master has been (re)discovered,
+        e.g. after a failover.
+        """
+        self._discovery_listeners.append(callback)
+
+    def remove_discovery_listener(self, callback):
+        self._discovery_listeners.remove(callback)
+
+    def _on_switch_master(self, name, address):
+        """ A sentinel announced a failover, move the pools right away. """
+        if address != self._master_address:
+            ensure_future(self._rediscover(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _rediscover(self):
+        try:
+            yield from self._discover_master()
+        except (ConnectionError, Error) as e:
+            # the next command tries again
+            logger.warning('rediscovery of %s failed: %r', self.cluster_name, e)
+
+    def _on_replicas_changed(self, name):
+        """ The shared topology lists other replicas, reconnect the replica pool. """
+        if self._master_address is not None:
+            ensure_future(self._rediscover_replicas(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _rediscover_replicas(self):
+        try:
+            yield from self._discover_slaves()
+            if self._replication is not None:
+                yield from self._check_replication()
+        except (ConnectionError, Error) as e:
+            logger.warning('rediscovery of the replicas of %s failed: %r', self.cluster_name, e)
 
     def _discover_sentinels(self):
         # todo: add sentinel discovery
         pass
 
+    @asyncio.coroutine
     def _discover_slaves(self):
-        # todo: add slave discovery and promotion algorithms
-        pass
+        """
+        (Re)create the replica pool from the replicas known to sentinel,
+        skipping the ones sentinel considers down.
+        """
+        self._close_replica_pool()
+
+        replicas = yield from self._group.replicas(self.cluster_name)
+        for replica in replicas or []:
+            if replica.is_down:
+                continue
+            pool = []
+            try:
+                connection = yield from self._add_pool_instance(replica.ip, replica.port, pool=pool)
+                reply = yield from (yield from connection.role()).aslist()
+                if reply[0] == 'slave':
+                    yield from self._load_scripts(connection)
+                    for x in range(self.poolsize - 1):
+                        yield from self._add_pool_instance(replica.ip, replica.port, pool=pool)
+                    self._replicas.extend(pool)
+                else:
+                    connection.close()
+            except ConnectionError:
+                for c in pool:
+                    c.close()
+
+        logger.info('%s replica connections', len(self._replicas))
+
+    @asyncio.coroutine
+    def _watch_replication(self):
+        while True:
+            yield from asyncio.sleep(self.config.replica_check_interval, loop=self._loop)
+            try:
+                yield from self._check_replication()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('failed to check the replication of %s', self.cluster_name)
+
+    @asyncio.coroutine
+    def _check_replication(self):
+        """ Read the replication offsets of the replicas with ``ROLE`` on the master. """
+        connection = self._get_free_connection()
+        if connection is None:
+            return
+        try:
+            reply = yield from (yield from connection.role()).aslist()
+        except (ConnectionError, Error) as e:
+            logger.warning('failed to read the replication offsets: %r', e)
+            return
+        if reply[0] != 'master':
+            return
+        replicas = {(host, int(port)): int(offset) for host, port, offset in reply[2]}
+        self._replication.update(self._loop.time(), int(reply[1]), replicas)
+
+    def _is_lagging(self, connection):
+        """ True when `connection` is to a replica too far behind the master to serve reads. """
+        return self._replication is not None and self._replication.is_lagging((connection.host, connection.port))
+
+    @property
+    def replication(self):
+        """
+        :class:`~asyncio_redis_ha.ReplicationLag` of the replicas, ``None``
+        unless `max_replica_lag` or `max_replica_lag_seconds` is set.
+        """
+        return self._replication
+
+    @asyncio.coroutine
+    def _load_scripts(self, connection):
+        """ Load the registered scripts on a newly discovered node. """
+        if len(self.scripts):
+            try:
+                yield from self.scripts.load(connection, loop=self._loop)
+            except (Error, ErrorReply) as e:
+                # evalsha loads them on demand
+                logger.warning('failed to preload scripts: %r', e)
+
+    def _close_replica_pool(self):
+        for c in self._replicas:
+            c.close()
+
+        self._replicas = []
 
     def _close_master_pool(self):
         """
         Close all the connections in the pool.
         """
         logger.info('closing redis-master connections')
-        for c in self._connections:
+        for c in self._connections + self._blocking:
             c.close()
 
         self._connections = []
+        self._blocking = []
 
     def close(self):
+        if self._replication_watcher is not None:
+            self._replication_watcher.cancel()
+            self._replication_watcher = None
+        if self._pubsub is not None:
+            if not self._pubsub.done():
+                self._pubsub.cancel()
+            elif not self._pubsub.cancelled() and not self._pubsub.exception():
+                self._pubsub.result().close()
+            self._pubsub = None
         self._close_master_pool()
-        self._close_sentinel_connections()
+        self._close_replica_pool()
+        try:
+            self._group.remove_switch_listener(self.cluster_name, self._on_switch_master)
+            if self.config.read_from_replicas:
+                self._group.remove_replicas_listener(self.cluster_name, self._on_replicas_changed)
+        except ValueError:
+            pass
+        if self._owns_group:
+            self._group.close()
 
     def __repr__(self):
         return 'ConnectionManager(cluster=%r, poolsize=%r)' % (self.config.cluster_name, self._poolsize)
@@ -218,6 +507,11 @@ class ConnectionManager:
         """ Number of parallel connections in the pool."""
         return self._poolsize
 
+    @property
+    def master_address(self):
+        """ ``(host, port)`` of the current master, ``None`` until it is discovered. """
+        return self._master_address
+
     @property
     def connections_in_use(self):
         """
@@ -232,62 +526,508 @@ class ConnectionManager:
         """
         return sum([1 for c in self._connections if c.protocol.is_connected])
 
+    @property
+    def blocking_poolsize(self):
+        """ Number of master connections reserved for blocking commands. """
+        return self._blocking_poolsize
+
+    @property
+    def blocking_connections_in_use(self):
+        """
+        Return how many connections of the blocking sub-pool are in use.
+        """
+        return sum([1 for c in self._blocking if c.protocol.in_use])
+
+    @property
+    def blocking_connections_connected(self):
+        """
+        The amount of open TCP connections in the blocking sub-pool.
+        """
+        return sum([1 for c in self._blocking if c.protocol.is_connected])
+
+    @property
+    def replicas_connected(self):
+        """
+        The amount of open TCP connections to replicas.
+        """
+        return sum([1 for c in self._replicas if c.protocol.is_connected])
+
     @property
     def sentinels_connected(self):
         """
-        The amount of open TCP connections.
+        The amount of open TCP connections to sentinels (shared with the other managers of the group).
         """
-        return sum([1 for c in self._sentinels if c.protocol.is_connected])
+        return self._group.sentinels_connected
 
-    def _get_free_connection(self):
+    def _get_free_connection(self, readonly=False, blocking=False):
         """
         Return the next protocol instance that's not in use.
         (A protocol in pubsub mode or doing a blocking request is considered busy,
         and can't be used for anything else.)
+
+        :param readonly: the command only reads, prefer a replica connection
+        :param blocking: the command blocks, only use the blocking sub-pool (when there is one)
         """
+        if blocking and self._blocking_poolsize:
+            self._blocking = self._blocking[1:] + self._blocking[:1]
+
+            for c in self._blocking:
+                if c.protocol.is_connected and not c.protocol.in_use:
+                    return c
+            return None
+
+        if readonly and self._replicas:
+            self._shuffle_replicas()
+
+            for c in self._replicas:
+                if (c.protocol.is_connected and not c.protocol.in_use and not self._saturated(c)
+                        and not self._is_lagging(c)):
+                    return c
+
         self._shuffle_connections()
 
         for c in self._connections:
-            if c.protocol.is_connected and not c.protocol.in_use:
+            if c.protocol.is_connected and not c.protocol.in_use and not self._saturated(c):
                 return c
 
+    def _saturated(self, connection):
+        """ True when `connection` has the maximum of commands in flight of the admission control. """
+        admission = self.config.admission
+        limit = admission and admission.max_in_flight_per_connection
+        return limit is not None and self._in_flight[connection] >= limit
+
     def _shuffle_connections(self):
         """
         'shuffle' protocols. Make sure that we devide the load equally among the protocols.
         """
         self._connections = self._connections[1:] + self._connections[:1]
 
+    def _shuffle_replicas(self):
+        self._replicas = self._replicas[1:] + self._replicas[:1]
+
+    def _is_blocking(self, name):
+        """ True when `name` is a blocking command, to be sent through the blocking sub-pool. """
+        info = self._commands.get(name)
+        return info is not None and info.is_blocking
+
+    def _is_readonly(self, name):
+        """ True when `name` is a read-only command which may be routed to a replica. """
+        if not self.config.read_from_replicas:
+            return False
+        info = self._commands.get(name)
+        return info is not None and info.is_readonly
+
     def __getattr__(self, name):
         """
         Proxy to a protocol. (This will choose a protocol instance that's not
         busy in a blocking request or transaction.)
         """
+        return self._guard(name)
 
+    def _guard(self, name, priority=0, timeout=None, deadline=None, session=None):
         @asyncio.coroutine
         def guard(*args, **kwargs):
             """wrapper ensuring that where are active connections to master, and performing rediscover if needed"""
-            if self.connections_connected == 0:
-                yield from self._discover_master()
-            connection = self._get_free_connection()
-
-            if connection:
-                result = yield from getattr(connection, name)(*args, **kwargs)
-                return result
-            else:
-                raise NoAvailableConnectionsInPoolError(
-                    'No available connections in the pool: size=%s, in_use=%s, connected=%s' % (
-                        self.poolsize, self.connections_in_use, self.connections_connected))
+            expiry = self._expiry(name, timeout)
+            if deadline is not None:
+                expiry = deadline if expiry is None else min(expiry, deadline)
+            if expiry is None:
+                return (yield from self._call(name, args, kwargs, priority, session=session))
+
+            sent = []
+            try:
+                remaining = expiry - self._loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                return (yield from asyncio.wait_for(
+                    self._call(name, args, kwargs, priority, sent, session), remaining, loop=self._loop))
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                for connection in sent:
+                    self._mark_suspect(connection)
+                raise CommandTimeoutError('%s did not complete before its deadline' % name)
 
         return guard
 
+    @asyncio.coroutine
+    def _call(self, name, args, kwargs, priority=0, sent=None, session=None):
+        """
+        Send a command on a free connection, through the admission control.
+        The connections are appended to `sent` once the command was written to them.
+
+        :param session: (optional) routes the command instead of the manager
+            (a :class:`~asyncio_redis_ha.Session`, a :class:`~asyncio_redis_ha.NearCache`)
+        """
+        if sent is None:
+            sent = []
+        sender = self if session is None else session
+        admission = self.config.admission
+        if admission is None:
+            return (yield from sender._send(name, args, kwargs, sent))
+
+        size = request_size(args, kwargs)
+        yield from admission.acquire(size, priority)
+        try:
+            return (yield from sender._send(name, args, kwargs, sent))
+        finally:
+            admission.release(size)
+
+    @asyncio.coroutine
+    def _send(self, name, args, kwargs, sent):
+        readonly = self._is_readonly(name)
+        connection = yield from self._acquire_connection(readonly, self._is_blocking(name))
+        if readonly and self.config.hedging is not None:
+            return (yield from self._hedge(connection, name, args, kwargs, sent))
+        sent.append(connection)
+        return (yield from self._send_on(connection, name, args, kwargs))
+
+    @asyncio.coroutine
+    def _send_on(self, connection, name, args, kwargs):
+        self._in_flight[connection] += 1
+        try:
+            policy = self.config.write_policy
+            if policy is not None and policy.selects(self._commands.get(name), args, kwargs):
+                return (yield from policy.send(connection, getattr(connection, name)(*args, **kwargs), self._loop))
+            return (yield from getattr(connection, name)(*args, **kwargs))
+        finally:
+            self._in_flight[connection] -= 1
+            if not self._in_flight[connection]:
+                del self._in_flight[connection]
+
+    @asyncio.coroutine
+    def _hedge(self, connection, name, args, kwargs, sent):
+        """
+        Send a read, and send it again to another node when it takes longer
+        than the delay of the :class:`~asyncio_redis_ha.HedgePolicy`.
+        The first successful reply wins, the other request is cancelled (and
+        its connection replaced, as its reply may still arrive): the caller
+        releases its admission slot when this returns.
+        """
+        hedging = self.config.hedging
+        hedging.start()
+        attempts = [self._timed_attempt(connection, name, args, kwargs, sent)]
+        try:
+            done, pending = yield from asyncio.wait(attempts, timeout=hedging.delay, loop=self._loop)
+            if not done:
+                other = self._hedge_connection(connection)
+                if other is not None and hedging.allow():
+                    attempts.append(self._timed_attempt(other, name, args, kwargs, sent))
+
+            pending = set(attempts)
+            while True:
+                done, pending = yield from asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED, loop=self._loop)
+                failed = None
+                for attempt in attempts:
+                    if attempt in done and attempt.exception() is None:
+                        if attempt is not attempts[0]:
+                            hedging.hedge_wins += 1
+                        self._cancel_attempts(attempts)
+                        return attempt.result()
+                    if attempt in done:
+                        failed = attempt
+                if not pending:
+                    return failed.result()
+        except asyncio.CancelledError:
+            self._cancel_attempts(attempts)
+            raise
+
+    def _cancel_attempts(self, attempts):
+        """ Cancel the hedged attempts still running, closing their connections. """
+        for attempt in attempts:
+            if not attempt.done():
+                attempt.cancel()
+                self._mark_suspect(attempt.connection)
+
+    def _timed_attempt(self, connection, name, args, kwargs, sent):
+        """ Task sending a read on `connection`, recording its latency. """
+        sent.append(connection)
+        start = self._loop.time()
+
+        def done(task):
+            if not task.cancelled() and task.exception() is None:
+                self.config.hedging.record(self._loop.time() - start)
+
+        task = ensure_future(self._send_on(connection, name, args, kwargs), loop=self._loop)
+        task.add_done_callback(done)
+        task.connection = connection
+        return task
+
+    def _hedge_connection(self, connection):
+        """ A free connection to another node than the one of `connection`, preferably a replica. """
+        address = (connection.host, connection.port)
+        self._shuffle_replicas()
+        replicas = [c for c in self._replicas if not self._is_lagging(c)]
+        for c in replicas + self._connections:
+            if ((c.host, c.port) != address and c.protocol.is_connected and not c.protocol.in_use
+                    and not self._saturated(c)):
+                return c
+
+    def _expiry(self, name, timeout=None):
+        """ Loop time at which the command `name` times out, ``None`` without a timeout. """
+        if timeout is None:
+            timeout = self._default_timeout(name)
+        if timeout is not None:
+            return self._loop.time() + timeout
+
+    def _default_timeout(self, name):
+        timeouts = self.config.command_timeouts
+        if not timeouts:
+            return None
+        if name in timeouts:
+            return timeouts[name]
+        info = self._commands.get(name)
+        if info is None:
+            return None
+        if info.command in timeouts:
+            return timeouts[info.command]
+        if info.is_blocking:
+            return timeouts.get(CommandFlags.BLOCKING)
+        for flag in (CommandFlags.PUBSUB, CommandFlags.ADMIN, CommandFlags.READONLY, CommandFlags.WRITE):
+            if info.flags & flag and flag in timeouts:
+                return timeouts[flag]
+
+    def _mark_suspect(self, connection):
+        """
+        Close a connection with a command whose caller gave up: its reply
+        may still arrive, and must not be taken for the reply of another
+        command. Another connection to the same server replaces it.
+        """
+        for pool in ('_connections', '_blocking', '_replicas'):
+            if connection in getattr(self, pool):
+                getattr(self, pool).remove(connection)
+                break
+        else:
+            return
+        logger.info('closing suspect connection to (%s, %s)', connection.host, connection.port)
+        connection.close()
+        self.stats.suspect_connections += 1
+        ensure_future(self._replace_connection(connection, pool, self._generation), loop=self._loop)
+
+    @asyncio.coroutine
+    def _replace_connection(self, connection, pool, generation):
+        try:
+            replacement = yield from self._add_pool_instance(connection.host, connection.port, pool=[])
+        except ConnectionError as e:
+            # the next discovery recreates the pool
+            logger.warning('failed to replace a connection to (%s, %s): %r', connection.host, connection.port, e)
+            return
+        if generation != self._generation:
+            # the pools have been recreated meanwhile
+            replacement.close()
+            return
+        getattr(self, pool).append(replacement)
+
+    def with_options(self, priority=0, timeout=None, deadline=None):
+        """
+        Proxy to this manager, sending commands with the given options::
+
+            yield from manager.with_options(priority=10).get('key')
+            yield from manager.with_options(timeout=.2).get('key')
+
+        :param priority: admission priority, commands with a higher priority
+            are admitted first and shed last (see :class:`~asyncio_redis_ha.AdmissionController`)
+        :param timeout: seconds before a command fails with
+            :class:`~asyncio_redis_ha.exceptions.CommandTimeoutError`, instead
+            of the default timeout of the command (see `command_timeouts`)
+        :param deadline: loop time (``loop.time()``) before which the commands
+            have to complete, e.g. to share the budget of a request between
+            several commands
+        """
+        return CommandOptions(self, priority=priority, timeout=timeout, deadline=deadline)
+
+    @asyncio.coroutine
+    def _acquire_connection(self, readonly=False, blocking=False):
+        """
+        Return a free connection, rediscovering the master when there are no
+        active connections to it (in the pool, or in the blocking sub-pool).
+        """
+        if self.connections_connected == 0 or (
+                blocking and self._blocking_poolsize and self.blocking_connections_connected == 0):
+            yield from self._discover_master()
+        connection = self._get_free_connection(readonly, blocking)
+
+        admission = self.config.admission
+        while connection is None and admission is not None and self._all_saturated(readonly, blocking):
+            if admission.policy == AdmissionPolicy.FAIL_FAST:
+                raise admission._reject('Every connection has %s commands in flight' %
+                                        admission.max_in_flight_per_connection)
+            yield from admission.wait_release()
+            connection = self._get_free_connection(readonly, blocking)
+
+        if connection:
+            return connection
+        elif blocking and self._blocking_poolsize:
+            raise NoAvailableConnectionsInPoolError(
+                'No available connections in the blocking pool: size=%s, in_use=%s, connected=%s' % (
+                    self._blocking_poolsize, self.blocking_connections_in_use, self.blocking_connections_connected))
+        else:
+            raise NoAvailableConnectionsInPoolError(
+                'No available connections in the pool: size=%s, in_use=%s, connected=%s' % (
+                    self.poolsize, self.connections_in_use, self.connections_connected))
+
+    def _all_saturated(self, readonly=False, blocking=False):
+        """ True when every available connection is only busy with the commands in flight on it. """
+        if blocking and self._blocking_poolsize:
+            return False
+        pool = self._connections + (self._replicas if readonly else [])
+        available = [c for c in pool if c.protocol.is_connected and not c.protocol.in_use]
+        return bool(available) and all(self._saturated(c) for c in available)
+
+    @asyncio.coroutine
+    def pubsub(self):
+        """
+        The :class:`~asyncio_redis_ha.PubSubManager` of this manager, sharing
+        one dedicated subscription connection to the master between all its
+        consumers (created on first use).
+        (``start_subscribe`` on the manager pins a pool connection instead,
+        and is not resubscribed after a failover.)
+        """
+        if self._pubsub is None or (self._pubsub.done() and self._pubsub.exception()):
+            self._pubsub = ensure_future(PubSubManager.create(self, loop=self._loop), loop=self._loop)
+        return (yield from asyncio.shield(self._pubsub, loop=self._loop))
+
+    def session(self):
+        """
+        Create a :class:`~asyncio_redis_ha.Session`, whose reads see its own
+        writes: with `read_from_replicas`, they only go to the replicas which
+        replicated its last write, to the master otherwise.
+        """
+        return Session(self)
+
+    def pipeline(self, transaction=False, max_commands=1000):
+        """
+        Create a :class:`~asyncio_redis_ha.Pipeline`, sending a batch of
+        commands in one write on a single connection.
+
+        :param transaction: wrap the commands in ``MULTI``/``EXEC``
+        :param max_commands: split larger batches in chunks of this many commands
+        """
+        return Pipeline(self, transaction=transaction, max_commands=max_commands, loop=self._loop)
+
+    def bulk_loader(self, chunk_size=1000, max_in_flight=None, retries=2):
+        """
+        Create a :class:`~asyncio_redis_ha.BulkLoader`, writing keys in
+        pipelined batches spread over the pool.
+
+        :param chunk_size: items per batch
+        :param max_in_flight: batches written at the same time, defaults to the poolsize
+        :param retries: attempts to send a batch again after a connection error
+        """
+        from asyncio_redis_ha.bulk import BulkLoader
+        return BulkLoader(self, chunk_size=chunk_size, max_in_flight=max_in_flight, retries=retries,
+                          loop=self._loop)
+
+    @asyncio.coroutine
+    def bulk_set(self, items, chunk_size=1000, max_in_flight=None, retries=2):
+        """
+        Write a (sync or async) iterable of ``(key, value)`` or ``(key, value, ttl)`` items,
+        see :meth:`bulk_loader`. Returns the :class:`~asyncio_redis_ha.BulkLoader`,
+        listing the items which failed.
+        """
+        loader = self.bulk_loader(chunk_size=chunk_size, max_in_flight=max_in_flight, retries=retries)
+        return (yield from loader.load(items))
+
+    def bulk_reader(self, keys, chunk_size=1000, max_in_flight=None, retries=2):
+        """
+        Create a :class:`~asyncio_redis_ha.BulkReader`, streaming the values of
+        `keys` read by concurrent ``MGET`` requests of `chunk_size` keys.
+
+        :param max_in_flight: chunks requested at the same time, defaults to the poolsize
+        """
+        from asyncio_redis_ha.bulk import BulkReader
+        return BulkReader(self, keys, chunk_size=chunk_size, max_in_flight=max_in_flight, retries=retries,
+                          loop=self._loop)
+
+    @asyncio.coroutine
+    def bulk_get(self, keys, chunk_size=1000, max_in_flight=None, retries=2):
+        """
+        Values of `keys`, in order (``None`` for missing keys), read by
+        concurrent ``MGET`` requests of `chunk_size` keys, see :meth:`bulk_reader`.
+        """
+        reader = self.bulk_reader(keys, chunk_size=chunk_size, max_in_flight=max_in_flight, retries=retries)
+        return (yield from reader.fetchall())
+
+    def scan_iter(self, match=None, count=100, prefetch=True):
+        """
+        Walk through the key space with a :class:`~asyncio_redis_ha.ScanIterator`,
+        prefetching pages and surviving failovers (see its guarantees).
+
+        :param match: (optional) glob-style pattern
+        :param count: number of keys the server looks at per page
+        :param prefetch: request the next page before the current one is consumed
+        """
+        return self._scan_iter('scan', match=match, count=count, prefetch=prefetch)
+
+    def sscan_iter(self, key, match=None, count=100, prefetch=True):
+        """ Walk through the members of a set, see :meth:`scan_iter`. """
+        return self._scan_iter('sscan', key, match=match, count=count, prefetch=prefetch)
+
+    def hscan_iter(self, key, match=None, count=100, prefetch=True):
+        """ Walk through the ``(field, value)`` pairs of a hash, see :meth:`scan_iter`. """
+        return self._scan_iter('hscan', key, match=match, count=count, prefetch=prefetch)
+
+    def zscan_iter(self, key, match=None, count=100, prefetch=True):
+        """ Walk through the ``(member, score)`` pairs of a sorted set, see :meth:`scan_iter`. """
+        return self._scan_iter('zscan', key, match=match, count=count, prefetch=prefetch)
+
+    def _scan_iter(self, command, *args, **kwargs):
+        from asyncio_redis_ha.scan import ScanIterator
+        return ScanIterator(self, command, *args, loop=self._loop, **kwargs)
+
     # Proxy the register_script method, so that the returned object will
     # execute on any available connection in the pool.
     @asyncio.coroutine
-    @wraps(ExtendedProtocol.register_script)
+    @wraps(ExtendedProtocol.register_script, assigned=('__name__', '__qualname__'), updated=())
     def register_script(self, script: str) -> Script:
+        """
+        Load a Lua script, returning a :class:`~asyncio_redis.Script` which
+        runs on any connection of the pool (see :meth:`evalsha`).
+        """
         # Call register_script from the Protocol.
         script = yield from self.__getattr__('register_script')(script)
         assert isinstance(script, Script)
 
+        # Remember it, to load it on every node discovered later.
+        self.scripts.add(script.sha, script.code)
+
         # Return a new script instead that runs it on any connection of the pool.
         return Script(script.sha, script.code, lambda: self.evalsha)
+
+    @asyncio.coroutine
+    @wraps(ExtendedProtocol.evalsha, assigned=('__name__', '__qualname__'), updated=())
+    def evalsha(self, sha, keys=None, args=None):
+        """ ``EVALSHA``, loading the script again on a server which lost it. """
+        evalsha = self.__getattr__('evalsha')
+        try:
+            return (yield from evalsha(sha, keys, args))
+        except NoScriptError:
+            # The server lost the script (e.g. a promoted replica), load it
+            # again and retry once.
+            code = self.scripts.get(sha)
+            if code is None:
+                raise
+            logger.info('reloading script %s', sha)
+            yield from self.__getattr__('script_load')(code)
+            return (yield from evalsha(sha, keys, args))
+
+
+class CommandOptions:
+    """
+    Proxy to a :class:`ConnectionManager`, sending its commands with some
+    options, see :meth:`ConnectionManager.with_options`.
+    """
+
+    def __init__(self, manager, priority=0, timeout=None, deadline=None):
+        self._manager = manager
+        self.priority = priority
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def __repr__(self):
+        return 'CommandOptions(%r, priority=%r, timeout=%r, deadline=%r)' % (
+            self._manager, self.priority, self.timeout, self.deadline)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._manager._guard(name, priority=self.priority, timeout=self.timeout, deadline=self.deadline)
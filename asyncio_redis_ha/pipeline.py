@@ -0,0 +1,248 @@
+import asyncio
+from collections import deque
+
+from asyncio_redis import Error, NotConnectedError, TransactionError
+from asyncio_redis.protocol import MultiBulkReply
+
+from asyncio_redis_ha.admission import request_size
+from asyncio_redis_ha.compat import ensure_future
+
+#: Commands which need a connection of their own, or a reply before anything else can be sent.
+_NOT_PIPELINED = frozenset(['multi', 'register_script', 'scan', 'sscan', 'hscan', 'zscan'])
+
+
+class Pipeline:
+    """
+    Batch of commands written to one connection in a single write.
+
+    ::
+
+        pipeline = manager.pipeline()
+        pipeline.set('key', 'value')
+        pipeline.incr('counter').get('counter')
+        results = yield from pipeline.execute()   # [StatusReply('OK'), 1, '1']
+
+    Results are returned in the order of the commands, and are the same as
+    when calling the commands on the manager. With an
+    :class:`~asyncio_redis_ha.AdmissionController`, each chunk (or the
+    transaction) is admitted at once, counting all its commands and bytes,
+    and its commands count as in flight on their connection for
+    `max_in_flight_per_connection`.
+
+    Unlike commands sent through the manager, pipelined commands are not
+    followed by the ``WAIT`` of a `write_policy`, and do not time out
+    (`command_timeouts`, :meth:`~asyncio_redis_ha.ConnectionManager.with_options`):
+    wrap :meth:`execute` in :func:`asyncio.wait_for` for a deadline.
+
+    :param manager: ConnectionManager
+    :param transaction: wrap the commands in ``MULTI``/``EXEC``.
+        A transaction is always written at once, `max_commands` does not apply.
+    :param max_commands: split larger batches in chunks of this many commands,
+        each one written after the replies of the previous one arrived, to cap
+        the memory used by the write buffer and the pending replies.
+    """
+
+    def __init__(self, manager, transaction=False, max_commands=1000, loop=None):
+        self._manager = manager
+        self._registry = manager.config.protocol_class.commands
+        self._loop = loop or manager._loop
+        self._commands = []
+        self.transaction = transaction
+        self.max_commands = max_commands
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __repr__(self):
+        return 'Pipeline(commands=%r, transaction=%r)' % (len(self._commands), self.transaction)
+
+    def __getattr__(self, name):
+        """
+        Queue a command, returns the pipeline to allow chaining.
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        info = self._registry.get(name)
+        if info is None:
+            raise AttributeError(name)
+        if info.is_blocking or info.is_pubsub or info.command in _NOT_PIPELINED:
+            raise Error('%s can not be pipelined' % name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def reset(self):
+        """ Drop the queued commands. """
+        self._commands = []
+
+    @asyncio.coroutine
+    def execute(self, raise_on_error=True):
+        """
+        Send the queued commands and return their results.
+
+        :param raise_on_error: raise the first error, otherwise errors are
+            returned in place of the results of the commands that failed.
+        :returns: list of results, in the order of the commands
+        """
+        commands, self._commands = self._commands, []
+        if not commands:
+            return []
+
+        if self.transaction:
+            results = yield from self._admitted(self._execute_transaction, commands, readonly=False)
+        else:
+            results = []
+            for i in range(0, len(commands), self.max_commands):
+                chunk = commands[i:i + self.max_commands]
+                results.extend((yield from self._admitted(self._execute_chunk, chunk, self._is_readonly(chunk))))
+
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    @asyncio.coroutine
+    def _wait_sent(self, protocol, tasks, count):
+        """
+        Let the command tasks run until `count` commands are buffered (or
+        their tasks failed before sending anything).
+        Sending happens in the first step of every task, so this normally
+        takes one iteration. (Uncorking earlier would only cost extra writes.)
+        """
+        for i in range(100):
+            if protocol.buffered_commands + sum(1 for t in tasks if t.done()) >= count:
+                break
+            yield from asyncio.sleep(0, loop=self._loop)
+
+    @asyncio.coroutine
+    def _admitted(self, execute, commands, readonly):
+        """ Run ``execute(connection, commands)`` through the admission control of the manager. """
+        admission = self._manager.config.admission
+        if admission is None:
+            return (yield from self._on_connection(execute, commands, readonly))
+
+        size = sum(request_size(args, kwargs) for name, args, kwargs in commands)
+        yield from admission.acquire(size, count=len(commands))
+        try:
+            return (yield from self._on_connection(execute, commands, readonly))
+        finally:
+            admission.release(size, len(commands))
+
+    @asyncio.coroutine
+    def _on_connection(self, execute, commands, readonly):
+        """ Run ``execute(connection, commands)`` on a free connection, counting the commands in flight there. """
+        manager = self._manager
+        connection = yield from manager._acquire_connection(readonly)
+        manager._in_flight[connection] += len(commands)
+        try:
+            return (yield from execute(connection, commands))
+        finally:
+            manager._in_flight[connection] -= len(commands)
+            if not manager._in_flight[connection]:
+                del manager._in_flight[connection]
+
+    def _is_readonly(self, commands):
+        return all(self._manager._is_readonly(name) for name, args, kwargs in commands)
+
+    @asyncio.coroutine
+    def _execute_chunk(self, connection, commands):
+        protocol = connection.protocol
+
+        protocol.cork()
+        try:
+            tasks = [ensure_future(getattr(protocol, name)(*args, **kwargs), loop=self._loop)
+                     for name, args, kwargs in commands]
+            yield from self._wait_sent(protocol, tasks, len(tasks))
+        finally:
+            protocol.uncork()
+
+        return (yield from asyncio.gather(*tasks, loop=self._loop, return_exceptions=True))
+
+    @asyncio.coroutine
+    def _execute_transaction(self, connection, commands):
+        protocol = connection.protocol
+
+        # MULTI, the commands and EXEC go out in one write: the transaction
+        # object exists as soon as MULTI has been sent, before its reply.
+        protocol.cork()
+        try:
+            multi = ensure_future(protocol.multi(), loop=self._loop)
+            yield from self._wait_sent(protocol, [multi], 1)
+            transaction = protocol._transaction
+            if transaction is None:
+                protocol.uncork()
+                yield from multi
+                raise NotConnectedError
+
+            tasks = [ensure_future(getattr(protocol, name)(transaction, *args, **kwargs), loop=self._loop)
+                     for name, args, kwargs in commands]
+            yield from self._wait_sent(protocol, tasks, len(tasks) + 1)
+            exec_ = ensure_future(_exec(protocol, transaction), loop=self._loop)
+            yield from self._wait_sent(protocol, tasks + [exec_], len(tasks) + 2)
+        finally:
+            protocol.uncork()
+
+        yield from multi
+        queued = yield from asyncio.gather(*tasks, loop=self._loop, return_exceptions=True)
+        # Raises TransactionError (or the EXECABORT error) when nothing was executed.
+        answers = yield from exec_
+
+        # The futures of commands failing inside the transaction are never
+        # resolved by asyncio_redis, take their errors from the raw answers.
+        results = []
+        for f, answer in zip(queued, answers):
+            if isinstance(answer, Exception):
+                results.append(answer)
+            else:
+                results.append((yield from f))
+        return results
+
+
+@asyncio.coroutine
+def _exec(protocol, transaction):
+    """
+    ``transaction.exec()``, collecting the answer futures once EXEC is
+    answered, so EXEC can be written together with the commands, before they
+    are QUEUED.
+
+    :returns: the raw answers, errors of single commands included
+        (those never reach the futures returned by the commands)
+
+    (A copy of ``RedisProtocol._exec`` of asyncio_redis 0.14.3, the version
+    pinned in setup.py, relying on the same private attributes of the
+    protocol: check it when upgrading, ``PipelineTest.test_private_api``
+    fails when they are gone.)
+    """
+    if not protocol._transaction or protocol._transaction != transaction:
+        raise Error('Not in transaction')
+    try:
+        multi_bulk_reply = yield from protocol._query(transaction, b'exec', _bypass=True)
+
+        futures_and_postprocessors = protocol._transaction_response_queue
+        protocol._transaction_response_queue = None
+
+        if multi_bulk_reply is None:
+            # We get None when a transaction failed.
+            raise TransactionError('Transaction failed.')
+        assert isinstance(multi_bulk_reply, MultiBulkReply)
+
+        answers = []
+        for f in multi_bulk_reply.iter_raw():
+            answer = yield from f
+            answers.append(answer)
+            f2, call = futures_and_postprocessors.popleft()
+
+            if isinstance(answer, Exception):
+                f2.set_exception(answer)
+            else:
+                if call:
+                    protocol._pipelined_calls.remove(call)
+                f2.set_result(answer)
+        return answers
+    finally:
+        protocol._transaction_response_queue = deque()
+        protocol._transaction = None
+        protocol._transaction_lock.release()
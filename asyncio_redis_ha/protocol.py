@@ -1,6 +1,13 @@
 import asyncio
-
-from asyncio_redis import RedisProtocol
+import itertools
+import sys
+import time
+import types
+from collections import OrderedDict
+from inspect import getfullargspec, signature
+
+from asyncio_redis import RedisProtocol, HiRedisProtocol
+from asyncio_redis.exceptions import ErrorReply, ScriptKilledError
 from asyncio_redis.cursors import Cursor, SetCursor, DictCursor, ZCursor
 from asyncio_redis.protocol import CommandCreator, NativeType, \
     _RedisProtocolMeta as _CoreRedisProtocolMeta, PostProcessors, MultiBulkReply, ListOf, Transaction, Subscription, \
@@ -8,9 +15,37 @@ from asyncio_redis.protocol import CommandCreator, NativeType, \
 from asyncio_redis.replies import ListReply, BlockingPopReply, ConfigPairReply, DictReply, InfoReply, ClientListReply, \
     SetReply, StatusReply, ZRangeReply, EvalScriptReply
 
-from asyncio_redis_ha.replies import NestedDictReply, NestedListReply
+from asyncio_redis_ha.commands import build_registry
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.exceptions import NoScriptError
+from asyncio_redis_ha.log import logger
+from asyncio_redis_ha.replies import NestedDictReply, NestedListReply, NodeListReply, ReplicaListReply, \
+    SentinelListReply
+
+try:
+    import hiredis
+except ImportError:
+    hiredis = None
+
+# Values sent as they are, whatever the encoder.
+_BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+# Commands followed by a subcommand, cached with it in the request headers.
+_CONTAINER_COMMANDS = frozenset([b'client', b'cluster', b'command', b'config', b'debug', b'latency', b'memory',
+                                 b'object', b'pubsub', b'script', b'sentinel', b'slowlog'])
+
+# (number of arguments, command name[, subcommand]) -> (encoded start of the request, names in it)
+_HEADERS = {}
+_MAX_HEADERS = 4096
 
-_all_commands = []
+# Pre-encoded `$<length>\r\n` lines of short arguments.
+_LENGTHS = [('$%d\r\n' % i).encode('ascii') for i in range(1024)]
+
+
+def _encode_length(size):
+    if size < 1024:
+        return _LENGTHS[size]
+    return ('$%d\r\n' % size).encode('ascii')
 
 
 class SentinelPostProcessors(PostProcessors):
@@ -22,8 +57,25 @@ class SentinelPostProcessors(PostProcessors):
             return {
                 NestedListReply: cls.multibulk_as_nested_list,
                 NestedDictReply: cls.multibulk_as_nested_dict,
+                ReplicaListReply: cls.multibulk_as_replica_list,
+                SentinelListReply: cls.multibulk_as_sentinel_list,
             }[return_type]
 
+    @classmethod
+    def get_alternate_post_processor(cls, return_type):
+        """ For node listings, create an additional post processor returning typed records """
+        if isinstance(return_type, type) and issubclass(return_type, NodeListReply):
+            original_post_processor = cls.get_default(return_type)
+
+            @asyncio.coroutine
+            def as_records(protocol, result):
+                result = yield from original_post_processor(protocol, result)
+                return (yield from result.asrecords())
+
+            return '_asrecords', list, as_records
+
+        return super().get_alternate_post_processor(return_type)
+
     # === Post processor handlers below. ===
 
     @asyncio.coroutine
@@ -36,62 +88,154 @@ class SentinelPostProcessors(PostProcessors):
         assert isinstance(result, MultiBulkReply)
         return NestedDictReply(result)
 
+    @asyncio.coroutine
+    def multibulk_as_replica_list(protocol, result):
+        assert isinstance(result, MultiBulkReply)
+        return ReplicaListReply(result)
+
+    @asyncio.coroutine
+    def multibulk_as_sentinel_list(protocol, result):
+        assert isinstance(result, MultiBulkReply)
+        return SentinelListReply(result)
+
+
+def _annotation_names():
+    """ Mapping of type annotations to doc strings, built on first use. """
+    global _ANNOTATION_NAMES
+    if _ANNOTATION_NAMES is None:
+        _ANNOTATION_NAMES = {
+            BlockingPopReply: ":class:`BlockingPopReply <asyncio_redis.replies.BlockingPopReply>`",
+            ConfigPairReply: ":class:`ConfigPairReply <asyncio_redis.replies.ConfigPairReply>`",
+            DictReply: ":class:`DictReply <asyncio_redis.replies.DictReply>`",
+            InfoReply: ":class:`InfoReply <asyncio_redis.replies.InfoReply>`",
+            ClientListReply: ":class:`InfoReply <asyncio_redis.replies.ClientListReply>`",
+            ListReply: ":class:`ListReply <asyncio_redis.replies.ListReply>`",
+            MultiBulkReply: ":class:`MultiBulkReply <asyncio_redis.replies.MultiBulkReply>`",
+            NativeType: "Native Python type, as defined by " +
+                        ":attr:`~asyncio_redis.encoders.BaseEncoder.native_type`",
+            NoneType: "None",
+            SetReply: ":class:`SetReply <asyncio_redis.replies.SetReply>`",
+            StatusReply: ":class:`StatusReply <asyncio_redis.replies.StatusReply>`",
+            ZRangeReply: ":class:`ZRangeReply <asyncio_redis.replies.ZRangeReply>`",
+            ZScoreBoundary: ":class:`ZScoreBoundary <asyncio_redis.replies.ZScoreBoundary>`",
+            EvalScriptReply: ":class:`EvalScriptReply <asyncio_redis.replies.EvalScriptReply>`",
+            Cursor: ":class:`Cursor <asyncio_redis.cursors.Cursor>`",
+            SetCursor: ":class:`SetCursor <asyncio_redis.cursors.SetCursor>`",
+            DictCursor: ":class:`DictCursor <asyncio_redis.cursors.DictCursor>`",
+            ZCursor: ":class:`ZCursor <asyncio_redis.cursors.ZCursor>`",
+            _ScanPart: ":class:`_ScanPart",
+            int: 'int',
+            bool: 'bool',
+            float: 'float',
+            str: 'str',
+            bytes: 'bytes',
+
+            list: 'list',
+            set: 'set',
+            dict: 'dict',
+
+            # XXX: Because of circular references, we cannot use the real types here.
+            Transaction: ":class:`asyncio_redis.Transaction`",
+            Subscription: ":class:`asyncio_redis.Subscription`",
+            Script: ":class:`~asyncio_redis.Script`",
+            'Transaction': ":class:`asyncio_redis.Transaction`",
+            'Subscription': ":class:`asyncio_redis.Subscription`",
+            'Script': ":class:`~asyncio_redis.Script`",
+
+            NestedDictReply: ":class:`NestedDictReply <asyncio_redis_ha.replies.NestedDictReply>`",
+            NestedListReply: ":class:`NestedListReply <asyncio_redis_ha.replies.NestedListReply>`",
+            ReplicaListReply: ":class:`ReplicaListReply <asyncio_redis_ha.replies.ReplicaListReply>`",
+            SentinelListReply: ":class:`SentinelListReply <asyncio_redis_ha.replies.SentinelListReply>`",
+        }
+    return _ANNOTATION_NAMES
+
+
+_ANNOTATION_NAMES = None
+
+
+class _CommandMethod:
+    # Protocol method created by a command creator. Behaves like the wrapped
+    # function, but the sphinx docstring is only generated on first access
+    # of ``__doc__``, keeping class creation (and so the import) cheap.
+    __slots__ = ('function', '_creator', '_suffix', '_return_type', '_doc')
+
+    def __init__(self, function, creator, suffix, return_type):
+        self.function = function
+        self._creator = creator
+        self._suffix = suffix
+        self._return_type = return_type
+        self._doc = None
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return types.MethodType(self.function, instance)
+
+    def __call__(self, *a, **kw):
+        return self.function(*a, **kw)
+
+    @property
+    def __doc__(self):
+        if self._doc is None:
+            self._doc = self._creator.get_docstring(self._suffix, self._return_type)
+            # Bound methods take their docstring from the function.
+            self.function.__doc__ = self._doc
+        return self._doc
+
+    def __getattr__(self, name):
+        # __name__, __qualname__, __wrapped__, ...
+        return getattr(self.function, name)
+
+    def __repr__(self):
+        return '<command %s>' % self.function.__qualname__
+
 
 class ExtendedCommandCreator(CommandCreator):
+    @property
+    def specs(self):
+        """ Argspecs (inspected only once) """
+        try:
+            return self._specs
+        except AttributeError:
+            self._specs = getfullargspec(self.method)
+            return self._specs
+
+    @property
+    def return_type(self):
+        """ Return type as defined in the method's annotation. """
+        return self.specs.annotations.get('return', None)
+
+    @property
+    def params(self):
+        try:
+            return self._params
+        except AttributeError:
+            self._params = {k: v for k, v in self.specs.annotations.items() if k != 'return'}
+            return self._params
+
     def _get_docstring(self, suffix, return_type):
+        # Called while creating the wrapper, keep it cheap: the full docstring
+        # is generated by `get_docstring` once somebody asks for it.
+        return self.method.__doc__
+
+    def get_docstring(self, suffix, return_type):
         # Append the real signature as the first line in the docstring.
         # (This will make the sphinx docs show the real signature instead of
         # (*a, **kw) of the wrapper.)
         # (But don't put the anotations inside the copied signature, that's rather
         # ugly in the docs.)
-        from inspect import formatargspec
-        signature = formatargspec(*self.specs[:6])
+        sig = signature(self.method)
+        sig = sig.replace(parameters=[p.replace(annotation=p.empty) for p in sig.parameters.values()],
+                          return_annotation=sig.empty)
 
         # Use function annotations to generate param documentation.
+        names = _annotation_names()
 
         def get_name(type_):
             """ Turn type annotation into doc string. """
             try:
-                return {
-                    BlockingPopReply: ":class:`BlockingPopReply <asyncio_redis.replies.BlockingPopReply>`",
-                    ConfigPairReply: ":class:`ConfigPairReply <asyncio_redis.replies.ConfigPairReply>`",
-                    DictReply: ":class:`DictReply <asyncio_redis.replies.DictReply>`",
-                    InfoReply: ":class:`InfoReply <asyncio_redis.replies.InfoReply>`",
-                    ClientListReply: ":class:`InfoReply <asyncio_redis.replies.ClientListReply>`",
-                    ListReply: ":class:`ListReply <asyncio_redis.replies.ListReply>`",
-                    MultiBulkReply: ":class:`MultiBulkReply <asyncio_redis.replies.MultiBulkReply>`",
-                    NativeType: "Native Python type, as defined by " +
-                                ":attr:`~asyncio_redis.encoders.BaseEncoder.native_type`",
-                    NoneType: "None",
-                    SetReply: ":class:`SetReply <asyncio_redis.replies.SetReply>`",
-                    StatusReply: ":class:`StatusReply <asyncio_redis.replies.StatusReply>`",
-                    ZRangeReply: ":class:`ZRangeReply <asyncio_redis.replies.ZRangeReply>`",
-                    ZScoreBoundary: ":class:`ZScoreBoundary <asyncio_redis.replies.ZScoreBoundary>`",
-                    EvalScriptReply: ":class:`EvalScriptReply <asyncio_redis.replies.EvalScriptReply>`",
-                    Cursor: ":class:`Cursor <asyncio_redis.cursors.Cursor>`",
-                    SetCursor: ":class:`SetCursor <asyncio_redis.cursors.SetCursor>`",
-                    DictCursor: ":class:`DictCursor <asyncio_redis.cursors.DictCursor>`",
-                    ZCursor: ":class:`ZCursor <asyncio_redis.cursors.ZCursor>`",
-                    _ScanPart: ":class:`_ScanPart",
-                    int: 'int',
-                    bool: 'bool',
-                    float: 'float',
-                    str: 'str',
-                    bytes: 'bytes',
-
-                    list: 'list',
-                    set: 'set',
-                    dict: 'dict',
-
-                    # XXX: Because of circular references, we cannot use the real types here.
-                    Transaction: ":class:`asyncio_redis.Transaction`",
-                    Subscription: ":class:`asyncio_redis.Subscription`",
-                    Script: ":class:`~asyncio_redis.Script`",
-
-                    NestedDictReply: ":class:`NestedDictReply <asyncio_redis_ha.replies.NestedDictReply>`",
-                    NestedListReply: ":class:`NestedListReply <asyncio_redis_ha.replies.NestedListReply>`",
-                }[type_]
-            except KeyError:
+                return names[type_]
+            except (KeyError, TypeError):
                 if isinstance(type_, ListOf):
                     return "List or iterable of %s" % get_name(type_.type)
 
@@ -108,12 +252,16 @@ class ExtendedCommandCreator(CommandCreator):
         returns = ':returns: (Future of) %s\n' % get_name(return_type) if return_type else ''
 
         return '%s%s\n%s\n\n%s%s' % (
-            self.method.__name__ + suffix, signature,
+            self.method.__name__ + suffix, sig,
             self.method.__doc__,
             ''.join(params_str),
             returns
         )
 
+    def get_methods(self):
+        return [('', _CommandMethod(self._get_wrapped_method(None, '', self.return_type),
+                                    self, '', self.return_type))]
+
 
 class ExtendedQueryCommandCreator(ExtendedCommandCreator):
     def get_methods(self):
@@ -124,7 +272,8 @@ class ExtendedQueryCommandCreator(ExtendedCommandCreator):
         result = []
 
         for suffix, return_type, post_processor in all_post_processors:
-            result.append((suffix, self._get_wrapped_method(post_processor, suffix, return_type)))
+            method = self._get_wrapped_method(post_processor, suffix, return_type)
+            result.append((suffix, _CommandMethod(method, self, suffix, return_type)))
 
         return result
 
@@ -153,27 +302,326 @@ class _query_command(_command):
 
 class _RedisProtocolMeta(_CoreRedisProtocolMeta):
     """
-    Metaclass for `RedisProtocol` which applies the _command decorator.
+    Metaclass for `RedisProtocol` which applies the _command decorator,
+    and registers the commands of every class in its own frozen ``commands``
+    registry (``{method name: CommandInfo}``, including inherited commands).
     """
 
     def __new__(cls, name, bases, attrs):
+        new_commands = []
         for attr_name, value in dict(attrs).items():
             if isinstance(value, _command):
                 creator = value.creator(value.method)
                 for suffix, method in creator.get_methods():
                     attrs[attr_name + suffix] = method
+                    new_commands.append((attr_name + suffix, value.method))
+
+        klass = type.__new__(cls, name, bases, attrs)
+        # Register commands.
+        klass.commands = build_registry(klass, new_commands)
+        return klass
+
+
+def _decode_items(decode, data):
+    """ Decode the bytes of a multi bulk reply (in the executor), return the items and the time it took. """
+    started = time.perf_counter()
+    items = [decode(d) if isinstance(d, bytes) else d for d in data]
+    return items, time.perf_counter() - started
+
+
+class OffloadingMultiBulkReply(MultiBulkReply):
+    """
+    Multi bulk reply decoded in the executor of its protocol when reading
+    at least :attr:`ExtendedProtocol.offload_threshold` bytes at once (e.g.
+    ``aslist``, ``asdict``, ``asset`` of a large reply).
+    """
+
+    def __init__(self, protocol, count, loop=None):
+        super().__init__(protocol, count, loop=loop)
+        #: Size of the bulk items received so far.
+        self.size = 0
+
+    def _feed_received(self, item):
+        if isinstance(item, bytes):
+            self.size += len(item)
+        super()._feed_received(item)
 
-                    # Register command.
-                    _all_commands.append(attr_name + suffix)
+    def _flush(self):
+        threshold = self.protocol.offload_threshold
+        if threshold is None or self.size < threshold:
+            return super()._flush()
 
-        return type.__new__(cls, name, bases, attrs)
+        while self._f_queue and self._f_queue[0][0] <= len(self._data_queue):
+            count, f, decode, one_only = self._f_queue.popleft()
+            data, self._data_queue = self._data_queue[:count], self._data_queue[count:]
+
+            if decode and not one_only:
+                size = sum(len(d) for d in data if isinstance(d, bytes))
+                if size >= threshold:
+                    self.protocol._decode_in_executor(data, size, f)
+                    continue
+            if decode:
+                data = [self._decode(d) for d in data]
+            f.set_result(data[0] if one_only else data)
 
 
 class ExtendedProtocol(RedisProtocol, metaclass=_RedisProtocolMeta):
+    #: Encoded commands waiting for :meth:`uncork`, ``None`` when not corked.
+    _write_buffer = None
+
+    #: Decode multi bulk replies of at least this many bytes in :attr:`executor`,
+    #: keeping the event loop responsive. ``None`` always decodes in the loop.
+    offload_threshold = None
+    #: Executor decoding large replies, ``None`` for the default executor of the loop.
+    executor = None
+    #: :class:`~asyncio_redis_ha.ManagerStats` counting the offloaded replies, if any.
+    stats = None
+    #: Write arguments of at least this many bytes as they are, next to the
+    #: encoded rest of the request, instead of copying them into it.
+    #: ``None`` (the default) always copies. When enabled, a ``bytearray`` or
+    #: ``memoryview`` value is referenced by the transport until it is
+    #: flushed: it must not be modified or resized before the reply.
+    zero_copy_threshold = None
+    #: Keep the encoded form of up to this many strings (of at most
+    #: :attr:`key_cache_max_length` characters), least recently used first out.
+    #: Meant for hot keys, ``None`` encodes every argument again.
+    key_cache_size = None
+    #: Longer strings are never kept by the key cache.
+    key_cache_max_length = 128
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Bytes-like values are sent as they are, whatever the encoder.
+        # (`native_type` is still the one of the encoder, for typechecking.)
+        self._native_types = (self.native_type,) + tuple(t for t in _BUFFER_TYPES if t is not self.native_type)
+        encode_from_native = self.encode_from_native
+        self._key_cache = OrderedDict()  # string -> encoded string
+        self.key_cache_hits = 0
+        self.key_cache_misses = 0
+
+        def encode(data):
+            if isinstance(data, _BUFFER_TYPES):
+                if type(data) is memoryview and (data.format != 'B' or data.ndim != 1):
+                    # measured in bytes
+                    return data.cast('B')
+                return data
+            size = self.key_cache_size
+            if not size or type(data) is not str or len(data) > self.key_cache_max_length:
+                return encode_from_native(data)
+
+            cache = self._key_cache
+            encoded = cache.get(data)
+            if encoded is not None:
+                cache.move_to_end(data)
+                self.key_cache_hits += 1
+                return encoded
+            self.key_cache_misses += 1
+            encoded = cache[data] = encode_from_native(data)
+            while len(cache) > size:
+                cache.popitem(last=False)
+            return encoded
+
+        self.encode_from_native = encode
+
+    @asyncio.coroutine
+    def _handle_multi_bulk_reply(self, cb):
+        # (Same as asyncio_redis, creating an OffloadingMultiBulkReply.)
+        count = int((yield from self._reader.readline()).rstrip(b'\r\n'))
+
+        # Handle multi-bulk none.
+        # (Used when a transaction exec fails.)
+        if count == -1:
+            cb(None)
+            return
+
+        reply = OffloadingMultiBulkReply(self, count, loop=self._loop)
+
+        # Return the empty queue immediately as an answer.
+        if self._in_pubsub:
+            ensure_future(self._handle_pubsub_multibulk_reply(reply), loop=self._loop)
+        else:
+            cb(reply)
+
+        # Wait for all multi bulk reply content.
+        for i in range(count):
+            yield from self._handle_item(reply._feed_received)
+
+    def _decode_in_executor(self, data, size, future):
+        """ Decode `data` in :attr:`executor` and set the result of `future`. """
+        task = self._loop.run_in_executor(self.executor, _decode_items, self.decode_to_native, data)
+
+        def done(task):
+            if future.cancelled():
+                return
+            if task.exception() is not None:
+                future.set_exception(task.exception())
+                return
+            items, elapsed = task.result()
+            if self.stats is not None:
+                self.stats.record_offload(size, elapsed)
+            future.set_result(items)
+
+        task.add_done_callback(done)
+
+    def _command_header(self, args):
+        """
+        The encoded ``*<count>`` line and command name (with the subcommand of
+        commands like ``SENTINEL`` or ``CONFIG``) of a request, and the number
+        of arguments it covers. Cached per command and number of arguments.
+        """
+        count = len(args)
+        name = args[0]
+        try:
+            if name in _CONTAINER_COMMANDS and count > 1:
+                key = (count, name, args[1])
+            else:
+                key = (count, name)
+            return _HEADERS[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # not hashable, not a command name
+            return b''.join([b'*', self._encode_int(count), b'\r\n']), 0
+
+        names = key[1:]
+        data = [b'*', self._encode_int(count), b'\r\n']
+        for name in names:
+            data += [_encode_length(len(name)), name, b'\r\n']
+        header = b''.join(data), len(names)
+        if len(_HEADERS) < _MAX_HEADERS:
+            _HEADERS[key] = header
+        return header
+
+    def _encode_command(self, args):
+        """
+        Serialize a request, `args` being a list of bytes-like objects
+        (memoryviews of format ``'B'``), into a list of chunks: the arguments
+        of at least :attr:`zero_copy_threshold` bytes as memoryviews,
+        everything in between joined.
+        """
+        threshold = self.zero_copy_threshold
+        if threshold is None:
+            threshold = sys.maxsize
+        short = min(threshold, len(_LENGTHS))
+        header, skip = self._command_header(args)
+        chunks = []
+        data = [header]
+        for arg in args[skip:]:
+            size = len(arg)
+            if size < short:
+                data += (_LENGTHS[size], arg, b'\r\n')
+            elif size < threshold:
+                data += (_encode_length(size), arg, b'\r\n')
+            else:
+                data.append(_encode_length(size))
+                chunks += (b''.join(data), memoryview(arg))
+                data = [b'\r\n']
+        chunks.append(b''.join(data))
+        return chunks
+
+    def _send_command(self, args):
+        """
+        Send Redis request command.
+        `args` should be a list of bytes-like objects to be written to the transport.
+        (Buffered while the protocol is corked.)
+        """
+        chunks = self._encode_command(args)
+        if self._write_buffer is not None:
+            self._write_buffer.append(chunks)
+        elif len(chunks) == 1:
+            self.transport.write(chunks[0])
+        else:
+            self.transport.writelines(chunks)
+
+    def cork(self):
+        """
+        Buffer the commands sent from now on, until :meth:`uncork` writes them
+        all at once. The protocol counts as in use meanwhile.
+        """
+        if self._write_buffer is None:
+            self._write_buffer = []
+
+    def uncork(self):
+        """ Write the buffered commands in one piece and stop buffering. """
+        buffer, self._write_buffer = self._write_buffer, None
+        if not buffer or self.transport is None:
+            return
+        chunks = list(itertools.chain.from_iterable(buffer))
+        if len(chunks) == len(buffer):
+            # nothing large
+            self.transport.write(b''.join(chunks))
+        else:
+            self.transport.writelines(chunks)
+
+    @property
+    def corked(self):
+        """ True between :meth:`cork` and :meth:`uncork`. """
+        return self._write_buffer is not None
+
+    @property
+    def buffered_commands(self):
+        """ Number of commands buffered since :meth:`cork`. """
+        return len(self._write_buffer or ())
+
+    @property
+    def in_use(self):
+        """ True when this protocol is in use. """
+        return self._write_buffer is not None or RedisProtocol.in_use.fget(self)
+
     @_query_command
     def role(self, tr) -> NestedListReply:
         return self._query(tr, b'role')
 
+    @_query_command
+    def wait(self, tr, numreplicas: int, timeout: int) -> int:
+        """
+        Block until the writes sent on this connection are acknowledged by
+        `numreplicas` replicas, or `timeout` milliseconds. Returns the number of
+        replicas which acknowledged them.
+        """
+        return self._query(tr, b'wait', self._encode_int(numreplicas), self._encode_int(timeout))
+
+    @_query_command
+    def mset(self, tr, values: dict) -> StatusReply:
+        """ Set multiple keys to multiple values """
+        data = []
+        for k, v in values.items():
+            assert isinstance(k, self._native_types)
+            assert isinstance(v, self._native_types)
+
+            data.append(self.encode_from_native(k))
+            data.append(self.encode_from_native(v))
+
+        return self._query(tr, b'mset', *data)
+
+    @_query_command
+    @asyncio.coroutine
+    def evalsha(self, tr, sha: str,
+                keys: (ListOf(NativeType), NoneType)=None,
+                args: (ListOf(NativeType), NoneType)=None) -> EvalScriptReply:
+        """
+        Evaluates a script cached on the server side by its SHA1 digest.
+        Scripts are cached on the server side using the SCRIPT LOAD command.
+
+        The return type/value depends on the script.
+
+        This will raise a :class:`~asyncio_redis_ha.exceptions.NoScriptError`
+        exception if the server does not know the script, and a
+        :class:`~asyncio_redis.exceptions.ScriptKilledError` exception if
+        the script was killed.
+        """
+        if not keys: keys = []
+        if not args: args = []
+
+        try:
+            return (yield from self._query(tr, b'evalsha', sha.encode('ascii'),
+                                           self._encode_int(len(keys)),
+                                           *map(self.encode_from_native, keys + args)))
+        except ErrorReply as e:
+            if 'NOSCRIPT' in e.args[0]:
+                raise NoScriptError(e.args[0])
+            raise ScriptKilledError
+
 
 class SentinelProtocol(ExtendedProtocol, metaclass=_RedisProtocolMeta):
     @_query_command
@@ -182,9 +630,62 @@ class SentinelProtocol(ExtendedProtocol, metaclass=_RedisProtocolMeta):
         return self._query(tr, b'sentinel', b'get-master-addr-by-name', self.encode_from_native(name))
 
     @_query_command
-    def slaves(self, tr, name: NativeType) -> NestedDictReply:
+    def slaves(self, tr, name: NativeType) -> ReplicaListReply:
+        """sentinel slaves command, list replicas of the master (see :class:`~asyncio_redis_ha.ReplicaInfo`)"""
         return self._query(tr, b'sentinel', b'slaves', self.encode_from_native(name))
 
     @_query_command
-    def sentinels(self, tr, name: NativeType) -> NestedDictReply:
+    def sentinels(self, tr, name: NativeType) -> SentinelListReply:
+        """sentinel sentinels command, list other sentinels (see :class:`~asyncio_redis_ha.SentinelInfo`)"""
         return self._query(tr, b'sentinel', b'sentinels', self.encode_from_native(name))
+
+
+class HiRedisExtendedProtocol(HiRedisProtocol, ExtendedProtocol, metaclass=_RedisProtocolMeta):
+    """
+    :class:`ExtendedProtocol` parsing replies with the `hiredis` library.
+
+    Multi bulk replies are only delivered once they have been received completely,
+    which makes large (nested) replies considerably faster to decode.
+    """
+    fallback_class = ExtendedProtocol
+
+    def _process_hiredis_item(self, item, cb):
+        # (Same as asyncio_redis, creating an OffloadingMultiBulkReply.)
+        if isinstance(item, list):
+            reply = OffloadingMultiBulkReply(self, len(item), loop=self._loop)
+
+            for i in item:
+                self._process_hiredis_item(i, reply._feed_received)
+
+            cb(reply)
+        else:
+            super()._process_hiredis_item(item, cb)
+
+
+class HiRedisSentinelProtocol(HiRedisProtocol, SentinelProtocol, metaclass=_RedisProtocolMeta):
+    """
+    :class:`SentinelProtocol` parsing replies with the `hiredis` library.
+    """
+    fallback_class = SentinelProtocol
+
+
+def resolve_protocol_class(protocol_class):
+    """
+    Return `protocol_class`, or its pure-python fallback when it requires
+    `hiredis` and the library is not installed.
+    """
+    if hiredis is None and issubclass(protocol_class, HiRedisProtocol):
+        fallback = getattr(protocol_class, 'fallback_class', None)
+        if fallback is None:
+            raise ImportError('`hiredis` library not available, required by %s' % protocol_class.__name__)
+        logger.warning('hiredis not available, falling back from %s to %s',
+                       protocol_class.__name__, fallback.__name__)
+        return fallback
+    return protocol_class
+
+
+def sentinel_protocol_for(protocol_class):
+    """ Sentinel protocol using the same reply parser as `protocol_class`. """
+    if issubclass(protocol_class, HiRedisProtocol):
+        return resolve_protocol_class(HiRedisSentinelProtocol)
+    return SentinelProtocol
@@ -0,0 +1,404 @@
+import asyncio
+from collections import deque
+
+from asyncio_redis import Error
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.connection import RedisConnection
+from asyncio_redis_ha.exceptions import ConsumerClosedError
+from asyncio_redis_ha.log import logger
+
+
+class MasterSubscriber:
+    """
+    Dedicated pubsub connection to the current master of a
+    :class:`~asyncio_redis_ha.ConnectionManager`, reopened when the master is
+    rediscovered (failover) or the connection is lost.
+
+    Subclasses subscribe in :meth:`_subscribed`, receive messages in
+    :meth:`_dispatch` and are told about interruptions by :meth:`_disconnected`.
+
+    :param manager: ConnectionManager
+    :param retry_interval: delay between attempts to reconnect
+    """
+
+    def __init__(self, manager, retry_interval=.5, loop=None):
+        self._manager = manager
+        self._loop = loop or manager._loop
+        self.retry_interval = retry_interval
+
+        self._connection = None
+        self._subscription = None
+        self._listener = None
+        self._connecting = None
+        self._active = False
+        self._closed = False
+
+    @property
+    def is_active(self):
+        """ True while connected and subscribed. """
+        return self._active
+
+    @asyncio.coroutine
+    def _open(self):
+        yield from self._connect()
+        self._manager.add_discovery_listener(self._on_discovery)
+
+    @asyncio.coroutine
+    def _connect(self):
+        """ Open the connection to the current master and subscribe. """
+        self._disconnect()
+
+        address = self._manager.master_address
+        if address is None:
+            raise ConnectionError('No master discovered')
+
+        config = self._manager.config
+        connection = yield from RedisConnection.configurable_create(
+            *address, password=config.password, db=config.db, encoder=config.encoder, loop=self._loop,
+            protocol_class=config.protocol_class, reconnect_cb=self._connection_lost)
+        self._connection = connection
+
+        try:
+            subscription = yield from connection.start_subscribe()
+            self._subscription = subscription
+            self._listener = ensure_future(self._listen(subscription), loop=self._loop)
+            yield from self._subscribed(subscription)
+        except:
+            self._disconnect()
+            raise
+
+        self._active = True
+        logger.info('%s subscribed at %s', type(self).__name__, address)
+
+    def _encode_names(self, names):
+        """ Channel names in the native type of the connection. """
+        if self._connection.protocol.native_type is bytes:
+            return [n.encode('utf-8', 'surrogateescape') if isinstance(n, str) else n for n in names]
+        return names
+
+    @asyncio.coroutine
+    def _listen(self, subscription):
+        while True:
+            message = yield from subscription.next_published()
+            self._dispatch(message)
+
+    def _disconnect(self):
+        self._active = False
+        self._subscription = None
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @asyncio.coroutine
+    def _connection_lost(self, connection):
+        """ Reconnect callback of the connection, never reconnects it: a new one is opened to the master. """
+        if connection is self._connection:
+            logger.warning('%s lost its connection', type(self).__name__)
+            self._disconnect()
+            self._disconnected()
+            self._reconnect()
+        return False
+
+    def _on_discovery(self, manager):
+        """ The master has been (re)discovered, subscribe there. """
+        self._disconnect()
+        self._disconnected()
+        self._reconnect()
+
+    def _reconnect(self):
+        if self._connecting is not None:
+            self._connecting.cancel()
+        self._connecting = ensure_future(self._reconnect_loop(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _reconnect_loop(self):
+        while not self._closed:
+            try:
+                yield from self._connect()
+                break
+            except (ConnectionError, Error) as e:
+                logger.info('%s reconnect failed: %r', type(self).__name__, e)
+                yield from asyncio.sleep(self.retry_interval, loop=self._loop)
+        self._connecting = None
+
+    def close(self):
+        self._closed = True
+        if self._connecting is not None:
+            self._connecting.cancel()
+            self._connecting = None
+        self._disconnect()
+        try:
+            self._manager.remove_discovery_listener(self._on_discovery)
+        except ValueError:
+            pass
+
+    # Hooks
+
+    @asyncio.coroutine
+    def _subscribed(self, subscription):
+        """ Subscribe on a new connection. """
+
+    def _dispatch(self, message):
+        """ Handle a published message. """
+
+    def _disconnected(self):
+        """ The connection was closed, messages published meanwhile are lost. """
+
+
+class OverflowPolicy:
+    """
+    What a :class:`Consumer` does with a message when its queue is full.
+    """
+    #: Drop the new message.
+    DROP_NEWEST = 'drop_newest'
+    #: Drop the oldest queued message to make room.
+    DROP_OLDEST = 'drop_oldest'
+    #: Close the consumer, :meth:`Consumer.next_published` raises
+    #: :class:`~asyncio_redis_ha.exceptions.ConsumerClosedError` once the queue is drained.
+    DISCONNECT = 'disconnect'
+
+
+class Consumer:
+    """
+    Local receiver of the messages of some channels and patterns of a
+    :class:`PubSubManager`, with a bounded queue.
+
+    :ivar dropped: number of messages dropped because the queue was full
+    :ivar interruptions: number of times the subscription connection was lost
+        (messages published meanwhile are missed)
+    """
+
+    def __init__(self, pubsub, maxsize=1000, overflow=OverflowPolicy.DROP_OLDEST):
+        if overflow not in (OverflowPolicy.DROP_NEWEST, OverflowPolicy.DROP_OLDEST, OverflowPolicy.DISCONNECT):
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        self._pubsub = pubsub
+        self._queue = deque()
+        self._waiter = None
+        self._closed = False
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.channels = set()
+        self.patterns = set()
+        self.dropped = 0
+        self.interruptions = 0
+
+    def __repr__(self):
+        return 'Consumer(channels=%r, patterns=%r, queued=%r)' % (self.channels, self.patterns, len(self._queue))
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def queued(self):
+        """ Number of messages waiting in the queue. """
+        return len(self._queue)
+
+    @asyncio.coroutine
+    def subscribe(self, channels):
+        """ Receive the messages published to `channels`. """
+        self._check_open()
+        new = [c for c in channels if c not in self.channels]
+        self.channels.update(new)
+        yield from self._pubsub._add(self, new, self._pubsub._channels, 'subscribe')
+
+    @asyncio.coroutine
+    def unsubscribe(self, channels):
+        gone = [c for c in channels if c in self.channels]
+        self.channels.difference_update(gone)
+        yield from self._pubsub._remove(self, gone, self._pubsub._channels, 'unsubscribe')
+
+    @asyncio.coroutine
+    def psubscribe(self, patterns):
+        """ Receive the messages published to channels matching `patterns`. """
+        self._check_open()
+        new = [p for p in patterns if p not in self.patterns]
+        self.patterns.update(new)
+        yield from self._pubsub._add(self, new, self._pubsub._patterns, 'psubscribe')
+
+    @asyncio.coroutine
+    def punsubscribe(self, patterns):
+        gone = [p for p in patterns if p in self.patterns]
+        self.patterns.difference_update(gone)
+        yield from self._pubsub._remove(self, gone, self._pubsub._patterns, 'punsubscribe')
+
+    @asyncio.coroutine
+    def next_published(self):
+        """
+        Wait for the next message, a :class:`~asyncio_redis.replies.PubSubReply`.
+        Raises :class:`~asyncio_redis_ha.exceptions.ConsumerClosedError` once
+        the consumer is closed and its queue drained.
+        """
+        while not self._queue:
+            if self._closed:
+                raise ConsumerClosedError('Consumer closed (dropped=%s)' % self.dropped)
+            self._waiter = asyncio.Future(loop=self._pubsub._loop)
+            try:
+                yield from self._waiter
+            finally:
+                self._waiter = None
+        return self._queue.popleft()
+
+    @asyncio.coroutine
+    def close(self):
+        """ Unsubscribe from everything and stop receiving messages. """
+        channels, patterns = list(self.channels), list(self.patterns)
+        self._set_closed()
+        self._pubsub._consumers.discard(self)
+        yield from self.unsubscribe(channels)
+        yield from self.punsubscribe(patterns)
+
+    def _check_open(self):
+        if self._closed:
+            raise ConsumerClosedError('Consumer closed')
+
+    def _set_closed(self):
+        self._closed = True
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _put(self, message):
+        if self._closed:
+            return
+        if len(self._queue) >= self.maxsize:
+            self.dropped += 1
+            if self.overflow == OverflowPolicy.DROP_NEWEST:
+                return
+            elif self.overflow == OverflowPolicy.DROP_OLDEST:
+                self._queue.popleft()
+            else:
+                logger.warning('closing %r, it fell behind', self)
+                self._pubsub._forget(self)
+                self._set_closed()
+                return
+        self._queue.append(message)
+        self._wakeup()
+
+
+class PubSubManager(MasterSubscriber):
+    """
+    Pubsub on a dedicated connection to the master, shared by any number of
+    local consumers: every channel and pattern is subscribed once, and its
+    messages are fanned out to the queues of the consumers interested in it.
+    Everything is subscribed again after a failover or a lost connection.
+
+    ::
+
+        pubsub = yield from manager.pubsub()
+        consumer = pubsub.consumer(maxsize=100)
+        yield from consumer.subscribe(['channel'])
+        message = yield from consumer.next_published()
+    """
+
+    def __init__(self, manager, retry_interval=.5, loop=None):
+        super().__init__(manager, retry_interval=retry_interval, loop=loop)
+        self._channels = {}  # channel -> set of consumers
+        self._patterns = {}  # pattern -> set of consumers
+        self._consumers = set()
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, manager, **kwargs):
+        """ Create a pubsub manager and connect it to the master of `manager`. """
+        self = cls(manager, **kwargs)
+        yield from self._open()
+        return self
+
+    def __repr__(self):
+        return 'PubSubManager(channels=%r, patterns=%r, consumers=%r)' % (
+            len(self._channels), len(self._patterns), len(self._consumers))
+
+    @property
+    def channels(self):
+        """ Channels subscribed on the server. """
+        return set(self._channels)
+
+    @property
+    def patterns(self):
+        """ Patterns subscribed on the server. """
+        return set(self._patterns)
+
+    def consumer(self, maxsize=1000, overflow=OverflowPolicy.DROP_OLDEST):
+        """
+        Create a consumer.
+
+        :param maxsize: maximum number of queued messages
+        :param overflow: :class:`OverflowPolicy` applied when the queue is full
+        """
+        consumer = Consumer(self, maxsize=maxsize, overflow=overflow)
+        self._consumers.add(consumer)
+        return consumer
+
+    @staticmethod
+    def _key(name):
+        """
+        Registry key of a channel or pattern: always a str, as the names of
+        the published messages are bytes with a bytes encoder (see :meth:`_encode_names`).
+        """
+        return name.decode('utf-8', 'surrogateescape') if isinstance(name, bytes) else name
+
+    @asyncio.coroutine
+    def _add(self, consumer, names, registry, method):
+        names = [self._key(n) for n in names]
+        new = [n for n in names if n not in registry]
+        for name in names:
+            registry.setdefault(name, set()).add(consumer)
+        # (Without a connection, everything is subscribed once it is back.)
+        if new and self._subscription is not None:
+            yield from getattr(self._subscription, method)(self._encode_names(new))
+
+    @asyncio.coroutine
+    def _remove(self, consumer, names, registry, method):
+        gone = []
+        for name in map(self._key, names):
+            consumers = registry.get(name)
+            if consumers is not None:
+                consumers.discard(consumer)
+                if not consumers:
+                    del registry[name]
+                    gone.append(name)
+        if gone and self._subscription is not None:
+            yield from getattr(self._subscription, method)(self._encode_names(gone))
+
+    def _forget(self, consumer):
+        """ Drop a consumer closed by its overflow policy. """
+        self._consumers.discard(consumer)
+        ensure_future(self._remove(consumer, list(consumer.channels), self._channels, 'unsubscribe'),
+                      loop=self._loop)
+        ensure_future(self._remove(consumer, list(consumer.patterns), self._patterns, 'punsubscribe'),
+                      loop=self._loop)
+
+    @asyncio.coroutine
+    def _subscribed(self, subscription):
+        if self._channels:
+            yield from subscription.subscribe(self._encode_names(list(self._channels)))
+        if self._patterns:
+            yield from subscription.psubscribe(self._encode_names(list(self._patterns)))
+
+    def _dispatch(self, message):
+        if message.pattern is not None:
+            consumers = self._patterns.get(self._key(message.pattern))
+        else:
+            consumers = self._channels.get(self._key(message.channel))
+        for consumer in list(consumers or ()):
+            consumer._put(message)
+
+    def _disconnected(self):
+        for consumer in self._consumers:
+            consumer.interruptions += 1
+
+    def close(self):
+        """ Close the connection and every consumer. """
+        super().close()
+        for consumer in list(self._consumers):
+            consumer._set_closed()
+        self._consumers.clear()
+        self._channels.clear()
+        self._patterns.clear()
@@ -0,0 +1,89 @@
+from collections import deque
+
+
+class ReplicationLag:
+    """
+    Replication lag of the replicas of a master, from the offsets listed by
+    ``ROLE`` on the master, see the `max_replica_lag` options of
+    :class:`~asyncio_redis_ha.ConnectionManager`.
+
+    The lag in bytes is the difference between the offsets of the master and
+    of a replica. The lag in seconds is the time since the master was at the
+    offset of the replica, estimated from the offsets recorded at every
+    :meth:`update` (so no finer than the interval between updates).
+
+    A replica missing from the last update (its link to the master is down)
+    is lagging, so is every replica before the first update. A replica
+    behind the oldest offset recorded (e.g. right after the discovery of the
+    master) is lagging by an unknown number of seconds (``None``), so it is
+    lagging when `max_seconds` is set.
+
+    :param max_bytes: replicas further behind are lagging (``None``: no limit)
+    :param max_seconds: replicas further behind are lagging (``None``: no limit)
+    :param history: master offsets kept to estimate the lag in seconds
+    """
+
+    def __init__(self, max_bytes=None, max_seconds=None, history=100):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._offsets = deque(maxlen=history)  # (time, master offset)
+        self._lags = {}  # (host, port) -> (bytes, seconds)
+        self.updated = None
+
+    def __repr__(self):
+        return 'ReplicationLag(max_bytes=%r, max_seconds=%r, lags=%r)' % (self.max_bytes, self.max_seconds, self._lags)
+
+    def reset(self):
+        """ Forget the offsets, e.g. after a failover. """
+        self._offsets.clear()
+        self._lags = {}
+        self.updated = None
+
+    def update(self, now, master_offset, replicas):
+        """
+        Record the offsets at time `now`.
+
+        :param replicas: ``{(host, port): offset}`` of the replicas connected to the master
+        """
+        if self._offsets and master_offset < self._offsets[-1][1]:
+            # the offsets of another master
+            self._offsets.clear()
+        self._offsets.append((now, master_offset))
+
+        lags = {}
+        for address, offset in replicas.items():
+            behind = max(master_offset - offset, 0)
+            seconds = 0.
+            if behind:
+                # time since the master was at that offset, unknown when
+                # older than the history
+                seconds = None
+                for i, (t, o) in enumerate(self._offsets):
+                    if o >= offset:
+                        if i or o == offset:
+                            seconds = now - t
+                        break
+            lags[address] = (behind, seconds)
+        self._lags = lags
+        self.updated = now
+
+    def lag(self, address):
+        """
+        ``(bytes, seconds)`` behind the master of the replica at ``(host, port)``
+        (seconds are ``None`` when unknown), ``None`` when the replica is unknown.
+        """
+        return self._lags.get(address)
+
+    @property
+    def lags(self):
+        """ ``{(host, port): (bytes, seconds)}`` of the replicas at the last update. """
+        return dict(self._lags)
+
+    def is_lagging(self, address):
+        """ True when the replica at ``(host, port)`` should not serve reads. """
+        lag = self._lags.get(address)
+        if lag is None:
+            return True
+        behind, seconds = lag
+        return ((self.max_bytes is not None and behind > self.max_bytes) or
+                (self.max_seconds is not None and (seconds is None or seconds > self.max_seconds)))
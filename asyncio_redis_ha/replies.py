@@ -4,26 +4,52 @@ from asyncio_redis.protocol import MultiBulkReply
 from asyncio_redis.replies import ListReply, DictReply
 
 
+def _read_buffered(multibulk: MultiBulkReply):
+    """
+    Return all decoded items of `multibulk` if they have been received already
+    and nothing else is reading from it, otherwise ``None``.
+    """
+    count = multibulk.count
+    data = multibulk._data_queue
+    if multibulk._f_queue or len(data) < count:
+        return None
+    multibulk._data_queue = data[count:]
+
+    decode = multibulk.protocol.decode_to_native
+    return [decode(x) if type(x) is bytes else x for x in data[:count]]
+
+
+@asyncio.coroutine
+def _read_all(multibulk: MultiBulkReply):
+    """ Decoded items of `multibulk`, waiting for them only when still streaming. """
+    items = _read_buffered(multibulk)
+    if items is None:
+        items = yield from multibulk._read(count=multibulk.count)
+    return items
+
+
 class NestedListReply(ListReply):
     @asyncio.coroutine
     def aslist(self):
-        """ Return the result as a Python ``list[list]``. """
-
-        @asyncio.coroutine
-        def _resolve_nested(multibulk: MultiBulkReply):
-            result = []
-            l1 = yield from ListReply(multibulk).aslist()
-            """:type l1 list"""
-            for x in l1:
-                if isinstance(x, MultiBulkReply):
-                    l2 = yield from _resolve_nested(x)
-                    result.append(l2)
-                else:
-                    result.append(x)
-            return result
+        """
+        Return the result as a Python ``list[list]``.
 
-        """:type data : list"""
-        final = yield from _resolve_nested(self._result)
+        Nested replies are decoded iteratively, only waiting on the ones
+        which are still being received.
+        """
+        final = []
+        pending = [(self._result, final)]
+        while pending:
+            multibulk, target = pending.pop()
+            items = _read_buffered(multibulk)
+            if items is None:
+                items = yield from multibulk._read(count=multibulk.count)
+            for x in items:
+                if isinstance(x, MultiBulkReply):
+                    nested = []
+                    pending.append((x, nested))
+                    x = nested
+                target.append(x)
         return final
 
 
@@ -32,13 +58,180 @@ class NestedDictReply(ListReply):
     def aslist(self):
         """ Return the result as a Python ``list[dict]``. """
         final = []
-        data = yield from super().aslist()
+        data = yield from _read_all(self._result)
         """:type data : list"""
         for x in data:
             if isinstance(x, MultiBulkReply):
-                x = DictReply(x)
-                nested = yield from x.asdict()
-                final.append(nested)
+                values = _read_buffered(x)
+                if values is None:
+                    values = yield from DictReply(x).asdict()
+                else:
+                    values = dict(zip(values[::2], values[1::2]))
+                final.append(values)
             else:
                 final.append(x)
         return final
+
+
+class NodeFlags:
+    """
+    Bitmask values for the ``flags`` field reported by sentinel,
+    see :attr:`NodeInfo.flags`.
+    """
+    MASTER = 1 << 0
+    SLAVE = 1 << 1
+    SENTINEL = 1 << 2
+    S_DOWN = 1 << 3
+    O_DOWN = 1 << 4
+    DISCONNECTED = 1 << 5
+    MASTER_DOWN = 1 << 6
+    FAILOVER_IN_PROGRESS = 1 << 7
+    PROMOTED = 1 << 8
+    RECONF_SENT = 1 << 9
+    RECONF_INPROG = 1 << 10
+    RECONF_DONE = 1 << 11
+
+    #: Flags which make a node unusable.
+    DOWN = S_DOWN | O_DOWN | DISCONNECTED
+
+    _by_name = {
+        'master': MASTER, 'slave': SLAVE, 'sentinel': SENTINEL,
+        's_down': S_DOWN, 'o_down': O_DOWN, 'disconnected': DISCONNECTED, 'master_down': MASTER_DOWN,
+        'failover_in_progress': FAILOVER_IN_PROGRESS, 'promoted': PROMOTED,
+        'reconf_sent': RECONF_SENT, 'reconf_inprog': RECONF_INPROG, 'reconf_done': RECONF_DONE,
+    }
+
+    @classmethod
+    def parse(cls, value: str) -> int:
+        """ Turn a comma separated flags string into a bitmask, ignoring unknown flags. """
+        mask = 0
+        for flag in value.split(','):
+            mask |= cls._by_name.get(flag, 0)
+        return mask
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _to_int(value):
+    return int(value) if value not in (None, '', b'') else None
+
+
+def _to_flags(value):
+    return NodeFlags.parse(_to_str(value))
+
+
+class NodeInfo:
+    """
+    Base for the typed records of sentinel node listings.
+    Numeric fields are parsed once, unknown fields are dropped.
+    """
+    #: Maps reply field names to ``(attribute, converter)``.
+    _fields = {
+        'name': ('name', _to_str),
+        'ip': ('ip', _to_str),
+        'port': ('port', _to_int),
+        'runid': ('runid', _to_str),
+        'flags': ('flags', _to_flags),
+        'last-ok-ping-reply': ('last_ok_ping_reply', _to_int),
+        'last-ping-reply': ('last_ping_reply', _to_int),
+        'down-after-milliseconds': ('down_after_milliseconds', _to_int),
+    }
+    __slots__ = ('name', 'ip', 'port', 'runid', 'flags', 'last_ok_ping_reply', 'last_ping_reply',
+                 'down_after_milliseconds')
+    #: All attributes, including the ones of base classes.
+    _attrs = __slots__
+
+    def __init__(self, **kwargs):
+        for attr in self._attrs:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError('Unexpected fields %r' % sorted(kwargs))
+        if self.flags is None:
+            self.flags = 0
+
+    @classmethod
+    def from_pairs(cls, items: list):
+        """ Build a record from a flat ``[key, value, key, value, ...]`` list. """
+        record = cls()
+        fields = cls._fields
+        for i in range(0, len(items) - 1, 2):
+            field = fields.get(_to_str(items[i]))
+            if field is not None:
+                setattr(record, field[0], field[1](items[i + 1]))
+        return record
+
+    @property
+    def address(self):
+        """ ``(ip, port)`` tuple """
+        return self.ip, self.port
+
+    @property
+    def is_down(self):
+        """ True when sentinel considers the node down or disconnected. """
+        return bool(self.flags & NodeFlags.DOWN)
+
+    def _key(self):
+        return tuple(getattr(self, attr) for attr in self._attrs)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return '%s(name=%r, ip=%r, port=%r, flags=%r)' % (
+            self.__class__.__name__, self.name, self.ip, self.port, self.flags)
+
+
+class ReplicaInfo(NodeInfo):
+    """ Replica as listed by ``SENTINEL slaves``. """
+    _fields = dict(NodeInfo._fields, **{
+        'master-link-down-time': ('master_link_down_time', _to_int),
+        'master-link-status': ('master_link_status', _to_str),
+        'master-host': ('master_host', _to_str),
+        'master-port': ('master_port', _to_int),
+        'slave-priority': ('slave_priority', _to_int),
+        'slave-repl-offset': ('slave_repl_offset', _to_int),
+    })
+    __slots__ = ('master_link_down_time', 'master_link_status', 'master_host', 'master_port',
+                 'slave_priority', 'slave_repl_offset')
+    _attrs = NodeInfo._attrs + __slots__
+
+
+class SentinelInfo(NodeInfo):
+    """ Sentinel as listed by ``SENTINEL sentinels``. """
+    _fields = dict(NodeInfo._fields, **{
+        'last-hello-message': ('last_hello_message', _to_int),
+        'voted-leader': ('voted_leader', _to_str),
+        'voted-leader-epoch': ('voted_leader_epoch', _to_int),
+    })
+    __slots__ = ('last_hello_message', 'voted_leader', 'voted_leader_epoch')
+    _attrs = NodeInfo._attrs + __slots__
+
+
+class NodeListReply(NestedDictReply):
+    """ :class:`NestedDictReply` which can also be read as typed records. """
+    record_class = NodeInfo
+
+    @asyncio.coroutine
+    def asrecords(self):
+        """ Return the result as a list of :attr:`record_class` instances. """
+        final = []
+        data = yield from _read_all(self._result)
+        for x in data:
+            if isinstance(x, MultiBulkReply):
+                final.append(self.record_class.from_pairs((yield from _read_all(x))))
+        return final
+
+
+class ReplicaListReply(NodeListReply):
+    """ ``SENTINEL slaves`` reply, see :class:`ReplicaInfo`. """
+    record_class = ReplicaInfo
+
+
+class SentinelListReply(NodeListReply):
+    """ ``SENTINEL sentinels`` reply, see :class:`SentinelInfo`. """
+    record_class = SentinelInfo
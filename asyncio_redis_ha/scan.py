@@ -0,0 +1,183 @@
+import asyncio
+from collections import deque
+
+from asyncio_redis import NotConnectedError
+from asyncio_redis.exceptions import ConnectionLostError
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.log import logger
+
+
+class ScanIterator:
+    """
+    Iterator over the pages of a ``SCAN``, ``SSCAN``, ``HSCAN`` or ``ZSCAN``
+    through a :class:`~asyncio_redis_ha.ConnectionManager`, see
+    :meth:`ConnectionManager.scan_iter <asyncio_redis_ha.ConnectionManager.scan_iter>`.
+
+    ::
+
+        keys = manager.scan_iter(match='session:*', count=1000)
+        while True:
+            key = yield from keys.fetchone()
+            if key is None:
+                break
+
+        async for field, value in manager.hscan_iter('hash'):    # Python 3.5+
+            ...
+
+    The next page is requested while the current one is consumed (`prefetch`).
+    Every page is read from the master. Lost connections are retried, and
+    after a failover (or when the connection was lost while a page was being
+    read, the server may have restarted) the scan starts over from the
+    beginning on the new master: cursors are only valid on the server which
+    returned them.
+
+    The guarantees are those of ``SCAN``: an element present during the whole
+    iteration is returned, elements may be returned more than once (all of
+    them again after a restart, see :attr:`restarts`), and elements added or
+    removed meanwhile may or may not be returned.
+
+    :param manager: ConnectionManager
+    :param verb: ``'scan'``, ``'sscan'``, ``'hscan'`` or ``'zscan'``
+    :param key: the set, hash or sorted set to scan (not for ``scan``)
+    :param match: (optional) glob-style pattern
+    :param count: number of elements the server looks at per page
+    :param prefetch: request the next page before the current one is consumed
+    :param retries: attempts per page when the connection fails
+    :param retry_interval: delay between those attempts
+    """
+
+    def __init__(self, manager, verb, key=None, match=None, count=100, prefetch=True,
+                 retries=10, retry_interval=.5, loop=None):
+        if verb not in ('scan', 'sscan', 'hscan', 'zscan'):
+            raise ValueError('Unknown scan command %r' % verb)
+        if verb != 'scan' and key is None:
+            raise ValueError('%s needs a key' % verb)
+        self._manager = manager
+        self._loop = loop or manager._loop
+        self.verb = verb
+        self.key = key
+        self.match = match
+        self.count = count
+        self.prefetch = prefetch
+        self.retries = retries
+        self.retry_interval = retry_interval
+
+        self._queue = deque()
+        self._cursor = 0
+        self._address = None  # master the cursor belongs to
+        self._pending = None  # task fetching the next page
+        self._done = False
+
+        #: Pages read so far.
+        self.pages = 0
+        #: Number of times the scan started over on another (or restarted) server.
+        self.restarts = 0
+
+    def __repr__(self):
+        return 'ScanIterator(%s, key=%r, match=%r, pages=%r, restarts=%r)' % (
+            self.verb, self.key, self.match, self.pages, self.restarts)
+
+    @property
+    def done(self):
+        """ True once the last page has been read. """
+        return self._done
+
+    @asyncio.coroutine
+    def _query(self, connection, cursor):
+        if self.verb == 'scan':
+            return (yield from connection._scan(cursor, self.match, self.count))
+        return (yield from connection._do_scan(self.verb.encode('ascii'), self.key, cursor, self.match, self.count))
+
+    def _parse(self, items):
+        if self.verb == 'hscan':
+            return list(zip(items[::2], items[1::2]))
+        elif self.verb == 'zscan':
+            return [(member, float(score)) for member, score in zip(items[::2], items[1::2])]
+        return items
+
+    @asyncio.coroutine
+    def _fetch(self, cursor):
+        """ Read the page at `cursor`, return ``(next cursor, items)``. """
+        failures = 0
+        lost = False
+        while True:
+            try:
+                connection = yield from self._manager._acquire_connection()
+                address = self._manager.master_address
+                if self._address is not None and cursor and (lost or address != self._address):
+                    logger.info('%r starting over on %s', self, address)
+                    self.restarts += 1
+                    cursor = 0
+                self._address = address
+
+                part = yield from self._query(connection, cursor)
+                self.pages += 1
+                return part.new_cursor_pos, self._parse(part.items)
+            except (ConnectionError, NotConnectedError) as e:
+                failures += 1
+                if failures > self.retries:
+                    raise
+                if isinstance(e, (ConnectionError, ConnectionLostError)):
+                    lost = True
+                logger.info('%r page failed: %r', self, e)
+                yield from asyncio.sleep(self.retry_interval, loop=self._loop)
+
+    @asyncio.coroutine
+    def fetchpage(self):
+        """ The items of the next page (possibly none), ``None`` after the last page. """
+        if self._pending is None:
+            if self._done:
+                return None
+            self._pending = ensure_future(self._fetch(self._cursor), loop=self._loop)
+
+        try:
+            cursor, items = yield from self._pending
+        finally:
+            self._pending = None
+
+        self._cursor = cursor
+        if cursor == 0:
+            self._done = True
+        elif self.prefetch:
+            self._pending = ensure_future(self._fetch(cursor), loop=self._loop)
+        return items
+
+    @asyncio.coroutine
+    def fetchone(self):
+        """ The next item, ``None`` after the last one. """
+        # (Pages can be empty before the end.)
+        while not self._queue:
+            items = yield from self.fetchpage()
+            if items is None:
+                return None
+            self._queue.extend(items)
+        return self._queue.popleft()
+
+    @asyncio.coroutine
+    def fetchall(self):
+        """ Every remaining item, in a list. """
+        results = list(self._queue)
+        self._queue.clear()
+        while True:
+            items = yield from self.fetchpage()
+            if items is None:
+                return results
+            results.extend(items)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        item = yield from self.fetchone()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        """ Stop prefetching. """
+        self._done = True
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
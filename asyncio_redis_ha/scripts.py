@@ -0,0 +1,48 @@
+import asyncio
+from collections import OrderedDict
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.log import logger
+
+
+class ScriptRegistry:
+    """
+    Every LUA script registered through a :class:`~asyncio_redis_ha.ConnectionManager`,
+    so they can be loaded again on servers which do not know them yet.
+    """
+
+    def __init__(self):
+        self._scripts = OrderedDict()  # sha -> code
+
+    def __len__(self):
+        return len(self._scripts)
+
+    def __contains__(self, sha):
+        return sha in self._scripts
+
+    def __iter__(self):
+        return iter(self._scripts)
+
+    def add(self, sha, code):
+        self._scripts[sha] = code
+
+    def get(self, sha):
+        """ Code of the script, ``None`` when it was not registered. """
+        return self._scripts.get(sha)
+
+    @asyncio.coroutine
+    def load(self, connection, loop=None):
+        """
+        Load every script on the server behind `connection`, sending all
+        ``SCRIPT LOAD`` commands at once instead of waiting for every reply.
+
+        :return: number of scripts loaded
+        """
+        if not self._scripts:
+            return 0
+        futures = [ensure_future(connection.script_load(code), loop=loop) for code in self._scripts.values()]
+        shas = yield from asyncio.gather(*futures, loop=loop)
+        for expected, sha in zip(self._scripts, shas):
+            if sha != expected:
+                logger.warning('script %s was loaded as %s', expected, sha)
+        return len(shas)
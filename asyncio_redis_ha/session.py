@@ -0,0 +1,120 @@
+import asyncio
+
+from asyncio_redis_ha.connection import ensure_future
+
+
+class Session:
+    """
+    Read-your-writes consistency for a client of a
+    :class:`~asyncio_redis_ha.ConnectionManager` reading from replicas, see
+    :meth:`ConnectionManager.session <asyncio_redis_ha.ConnectionManager.session>`.
+
+    ::
+
+        session = manager.session()
+        yield from session.set('profile:42', data)
+        yield from session.get('profile:42')     # never older than the set
+
+    After every write, the replication offset of the master is read with a
+    ``ROLE`` sent right behind the write, on the same connection. The reads
+    which follow go to a replica only when it has replicated that offset: a
+    ``ROLE`` sent right before the read, on the same connection, tells (and
+    is skipped once the replica is known to be far enough). Otherwise they go
+    to the master.
+
+    Reads before the first write are routed as usual. After a failover, the
+    reads go to the master until the next write.
+
+    :ivar offset: replication offset of the master after the last write
+    :ivar replica_reads: reads served by a replica which had caught up
+    :ivar master_reads: reads sent to the master because no replica had
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._generation = manager._generation
+        self._verified = {}  # (host, port) -> replication offset the replica is known to have reached
+        self.offset = 0
+        self.replica_reads = 0
+        self.master_reads = 0
+
+    def __repr__(self):
+        return 'Session(offset=%r, replica_reads=%r, master_reads=%r)' % (
+            self.offset, self.replica_reads, self.master_reads)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._manager._guard(name, session=self)
+
+    @asyncio.coroutine
+    def _role(self, connection):
+        return (yield from (yield from connection.role()).aslist())
+
+    @asyncio.coroutine
+    def _send(self, name, args, kwargs, sent):
+        manager = self._manager
+        info = manager._commands.get(name)
+        if info is None or info.is_blocking or info.is_pubsub or not manager.config.read_from_replicas:
+            return (yield from manager._send(name, args, kwargs, sent))
+        if info.is_readonly:
+            return (yield from self._read(name, args, kwargs, sent))
+        return (yield from self._write(name, args, kwargs, sent))
+
+    @asyncio.coroutine
+    def _write(self, name, args, kwargs, sent):
+        manager = self._manager
+        connection = yield from manager._acquire_connection()
+        sent.append(connection)
+        write = ensure_future(manager._send_on(connection, name, args, kwargs), loop=manager._loop)
+        # queued after the write, on the same connection
+        role = ensure_future(self._role(connection), loop=manager._loop)
+        try:
+            result = yield from write
+        finally:
+            try:
+                reply = yield from role
+            except Exception:
+                # the next write records the offset
+                pass
+            else:
+                if reply[0] == 'master':
+                    if self._generation != manager._generation:
+                        self._generation = manager._generation
+                        self._verified = {}
+                    self.offset = max(self.offset, int(reply[1]))
+        return result
+
+    @asyncio.coroutine
+    def _read(self, name, args, kwargs, sent):
+        manager = self._manager
+        if not self.offset:
+            return (yield from manager._send(name, args, kwargs, sent))
+
+        if self._generation == manager._generation:
+            connection = manager._get_free_connection(readonly=True)
+            if connection is not None and connection in manager._replicas:
+                sent.append(connection)
+                address = (connection.host, connection.port)
+                if self._verified.get(address, 0) >= self.offset:
+                    self.replica_reads += 1
+                    return (yield from manager._send_on(connection, name, args, kwargs))
+
+                role = ensure_future(self._role(connection), loop=manager._loop)
+                # queued after the ROLE, executed after it
+                read = ensure_future(manager._send_on(connection, name, args, kwargs), loop=manager._loop)
+                try:
+                    reply = yield from role
+                except Exception:
+                    reply = None
+                if reply is not None and reply[0] == 'slave':
+                    self._verified[address] = int(reply[4])
+                    if self._verified[address] >= self.offset:
+                        self.replica_reads += 1
+                        return (yield from read)
+                read.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        self.master_reads += 1
+        connection = yield from manager._acquire_connection()
+        sent.append(connection)
+        return (yield from manager._send_on(connection, name, args, kwargs))
@@ -0,0 +1,30 @@
+class ManagerStats:
+    """
+    Counters of a :class:`~asyncio_redis_ha.ConnectionManager`, see
+    :attr:`ConnectionManager.stats <asyncio_redis_ha.ConnectionManager.stats>`.
+
+    :ivar offloaded_replies: replies decoded in the executor
+        (see the `offload_threshold` of the manager)
+    :ivar offloaded_bytes: size of those replies
+    :ivar offload_time: seconds spent decoding them in the executor
+    :ivar timeouts: commands which did not complete before their deadline
+    :ivar suspect_connections: connections closed because a command timed out on them
+    """
+
+    def __init__(self):
+        self.offloaded_replies = 0
+        self.offloaded_bytes = 0
+        self.offload_time = 0.
+        self.timeouts = 0
+        self.suspect_connections = 0
+
+    def record_offload(self, size, elapsed):
+        self.offloaded_replies += 1
+        self.offloaded_bytes += size
+        self.offload_time += elapsed
+
+    def asdict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return 'ManagerStats(%s)' % ', '.join('%s=%r' % item for item in sorted(self.__dict__.items()))
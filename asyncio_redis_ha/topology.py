@@ -0,0 +1,156 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+
+from asyncio_redis_ha.exceptions import TopologyBusyError
+from asyncio_redis_ha.replies import ReplicaInfo
+
+#: magic, version, payload length
+_HEADER = struct.Struct('<4sQI')
+_MAGIC = b'RHAT'
+
+
+class SharedTopology:
+    """
+    Topology of the masters (address and replicas) shared by the processes
+    of a host through a memory mapped file, with a version counter bumped on
+    every change.
+
+    One process, holding the publisher lock (see :meth:`acquire_publisher`),
+    queries the sentinels and writes the topology; the others only read it.
+    Readers never block: the version is odd while a write is in progress, and
+    a read overlapping a write is retried (a sequence lock).
+
+    Pass it to :class:`~asyncio_redis_ha.SentinelGroup` rather than using it directly.
+
+    :param path: file shared by the processes, the publisher lock is ``path + '.lock'``
+    :param size: bytes mapped, the same in every process
+    """
+
+    def __init__(self, path, size=64 * 1024):
+        self.path = path
+        self.size = size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock_fd = None
+
+    def __repr__(self):
+        return 'SharedTopology(path=%r, version=%r, publisher=%r)' % (self.path, self.version, self.is_publisher)
+
+    # Publisher election
+
+    @property
+    def is_publisher(self):
+        return self._lock_fd is not None
+
+    def acquire_publisher(self):
+        """
+        Try to become the publisher, return whether this process is the publisher.
+        The lock is released by :meth:`release_publisher`, or when the process exits.
+        """
+        if self._lock_fd is None:
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._lock_fd = fd
+        return True
+
+    def release_publisher(self):
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    # Reading
+
+    @property
+    def version(self):
+        """ Version of the topology, 0 until something is published. """
+        magic, version, length = _HEADER.unpack_from(self._map)
+        return version if magic == _MAGIC else 0
+
+    def read(self, retries=100):
+        """
+        Return ``(version, {master name: entry})``.
+
+        Never sleeps: raises :class:`~asyncio_redis_ha.exceptions.TopologyBusyError`
+        when a write is in progress in another process during `retries` attempts.
+        """
+        for i in range(retries):
+            magic, version, length = _HEADER.unpack_from(self._map)
+            if magic != _MAGIC:
+                return 0, {}
+            if not version & 1 and length <= self.size - _HEADER.size:
+                payload = self._map[_HEADER.size:_HEADER.size + length]
+                if _HEADER.unpack_from(self._map)[1] == version:
+                    return version, json.loads(payload.decode('utf-8'))
+            # a write is in progress in another process
+        raise TopologyBusyError('Could not read a consistent topology from %s' % self.path)
+
+    def get(self, name):
+        """
+        Entry of the master `name`: ``{'master': [host, port], 'replicas': [...], 'updated': timestamp}``,
+        ``None`` when it was never published.
+        """
+        return self.read()[1].get(name)
+
+    def master(self, name):
+        """ ``(host, port)`` of the master `name`, ``None`` when unknown. """
+        entry = self.get(name)
+        if entry is not None and entry.get('master'):
+            return tuple(entry['master'])
+
+    def replicas(self, name):
+        """ :class:`~asyncio_redis_ha.ReplicaInfo` of the replicas of the master `name`, ``None`` when unknown. """
+        entry = self.get(name)
+        if entry is not None and entry.get('replicas') is not None:
+            return [ReplicaInfo(**r) for r in entry['replicas']]
+
+    # Writing
+
+    def update(self, name, master=None, replicas=None):
+        """
+        Publish the `master` address and/or the `replicas`
+        (:class:`~asyncio_redis_ha.ReplicaInfo`) of the master `name`.
+        Returns the new version.
+        """
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            magic, version, length = _HEADER.unpack_from(self._map)
+            if magic == _MAGIC and version & 1:
+                # the previous publisher died while writing, start over
+                version, topology = version + 1, {}
+            else:
+                version, topology = self.read()
+            entry = topology.setdefault(name, {})
+            if master is not None:
+                entry['master'] = [master[0], int(master[1])]
+            if replicas is not None:
+                entry['replicas'] = [{attr: getattr(r, attr) for attr in r._attrs} for r in replicas]
+            entry['updated'] = time.time()
+            return self._write(version, topology)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _write(self, version, topology):
+        payload = json.dumps(topology, separators=(',', ':')).encode('utf-8')
+        if len(payload) > self.size - _HEADER.size:
+            raise ValueError('Topology of %s bytes does not fit in %s' % (len(payload), self.path))
+
+        _HEADER.pack_into(self._map, 0, _MAGIC, version + 1, 0)
+        self._map[_HEADER.size:_HEADER.size + len(payload)] = payload
+        _HEADER.pack_into(self._map, 0, _MAGIC, version + 2, len(payload))
+        return version + 2
+
+    def close(self):
+        self.release_publisher()
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Request encoding benchmark: copying values into the request vs writing them
+as they are (:attr:`ExtendedProtocol.zero_copy_threshold`), and small
+requests with and without the key cache (:attr:`ExtendedProtocol.key_cache_size`).
+
+Encodes ``SET`` requests with values from 1 KB to 64 MB and hands them to an
+in-memory transport, so only the encoding is measured (no sockets). The
+transport keeps the default ``writelines``, which joins the chunks (as the
+transports of Python before 3.12 do), so the zero-copy column includes that
+copy.
+
+::
+
+    PYTHONPATH=. python benchmarks/encoding.py
+"""
+import asyncio
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from asyncio_redis_ha.protocol import ExtendedProtocol
+
+
+class NullTransport(asyncio.Transport):
+    """ Transport dropping every write (`writelines` joins the data first). """
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def run(threshold, value, iterations, loop):
+    protocol = ExtendedProtocol(loop=loop)
+    protocol.zero_copy_threshold = threshold
+    protocol.connection_made(NullTransport())
+    args = [b'set', b'key', value]
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        protocol._send_command(args)
+    elapsed = time.perf_counter() - started
+
+    protocol.connection_lost(None)
+    return elapsed / iterations
+
+
+def run_small(key_cache_size, args, iterations, loop):
+    protocol = ExtendedProtocol(loop=loop)
+    protocol.key_cache_size = key_cache_size
+    protocol.connection_made(NullTransport())
+    name, key, rest = args[0], args[1], args[2:]
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        protocol._send_command([name, protocol.encode_from_native(key)] + rest)
+    elapsed = time.perf_counter() - started
+
+    protocol.connection_lost(None)
+    return elapsed / iterations
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    sizes = [2 ** i for i in range(10, 27, 2)]  # 1 KB to 64 MB
+    print('%-10s %16s %16s' % ('value', 'copied', 'zero-copy'))
+    for size in sizes:
+        value = b'x' * size
+        iterations = max(5, min(20000, 2 ** 28 // size))
+        copied = run(None, value, iterations, loop)
+        zero_copy = run(64 * 1024, value, iterations, loop)
+        print('%-10s %14.3fms %14.3fms   x%.1f' % (
+            '%d KB' % (size // 1024) if size < 2 ** 20 else '%d MB' % (size // 2 ** 20),
+            copied * 1000, zero_copy * 1000, copied / zero_copy))
+
+    print()
+    print('%-10s %16s %16s' % ('request', 'encoded', 'key cache'))
+    for args in ([b'get', 'user:1234:profile'], [b'set', 'user:1234:profile', b'x' * 100]):
+        uncached = run_small(None, args, 200000, loop)
+        cached = run_small(1000, args, 200000, loop)
+        print('%-10s %14.3fus %14.3fus' % (args[0].decode().upper(), uncached * 1e6, cached * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Import time benchmark.
+
+Measures ``import asyncio_redis_ha`` in fresh interpreters. ``asyncio_redis``
+is imported before the timer starts, so only the module level work of this
+package (protocol classes, command wrappers) is measured. Bytecode caching is
+enabled and warmed up first, compilation is not part of the numbers.
+
+::
+
+    PYTHONPATH=. python benchmarks/import_time.py
+"""
+import os
+import subprocess
+import sys
+
+RUNS = 20
+
+IMPORT_SCRIPT = '''
+import time
+import asyncio_redis
+started = time.perf_counter()
+import asyncio_redis_ha
+print(time.perf_counter() - started)
+'''
+
+DOCSTRINGS_SCRIPT = '''
+import time
+import asyncio_redis_ha
+started = time.perf_counter()
+for cls in (asyncio_redis_ha.ExtendedProtocol, asyncio_redis_ha.SentinelProtocol):
+    for name in cls.__dict__:
+        getattr(cls, name).__doc__
+print(time.perf_counter() - started)
+'''
+
+
+def measure(script):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(['.', os.environ.get('PYTHONPATH', '')]))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    subprocess.check_output([sys.executable, '-c', script], env=env)
+
+    timings = []
+    for _ in range(RUNS):
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        timings.append(float(output))
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    print('import asyncio_redis_ha (median of %d):   %.3fms' % (RUNS, measure(IMPORT_SCRIPT) * 1000))
+    print('first __doc__ access of every command: %.3fms' % (measure(DOCSTRINGS_SCRIPT) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Reply parsing benchmark: pure-python vs hiredis backed HA protocols.
+
+Feeds pre-serialized replies into a protocol over an in-memory transport,
+so only parsing and decoding is measured (no sockets).
+
+::
+
+    PYTHONPATH=. python benchmarks/parsing.py
+"""
+import asyncio
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from asyncio_redis_ha.compat import ensure_future
+from asyncio_redis_ha.protocol import ExtendedProtocol, HiRedisExtendedProtocol, hiredis
+
+
+class NullTransport(asyncio.Transport):
+    """ Transport dropping every write. """
+
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def bulk(value):
+    return b'$' + str(len(value)).encode('ascii') + b'\r\n' + value + b'\r\n'
+
+
+def multibulk(items):
+    return b'*' + str(len(items)).encode('ascii') + b'\r\n' + b''.join(items)
+
+
+def lrange_reply(count, size=16):
+    return multibulk([bulk(b'x' * size) for _ in range(count)])
+
+
+def role_reply(replicas):
+    return multibulk([bulk(b'master'), b':123456789\r\n'] + [
+        multibulk([bulk(('10.0.0.%d' % (i % 250)).encode('ascii')), bulk(b'6379'), bulk(b'123456789')])
+        for i in range(replicas)])
+
+
+@asyncio.coroutine
+def run(protocol_class, command, reply, iterations, loop):
+    protocol = protocol_class(loop=loop)
+    protocol.connection_made(NullTransport())
+    yield from asyncio.sleep(0, loop=loop)
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        f = ensure_future(command(protocol), loop=loop)
+        yield from asyncio.sleep(0, loop=loop)
+        protocol.data_received(reply)
+        yield from f
+    elapsed = time.perf_counter() - started
+
+    protocol.connection_lost(None)
+    return elapsed / iterations
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    classes = [ExtendedProtocol]
+    if hiredis:
+        classes.append(HiRedisExtendedProtocol)
+    else:
+        print('hiredis not installed, only measuring the pure-python parser')
+
+    scenarios = [
+        ('lrange 100', lambda p: p.lrange_aslist('key'), lrange_reply(100), 2000),
+        ('lrange 10000', lambda p: p.lrange_aslist('key'), lrange_reply(10000), 50),
+        ('lrange 100000', lambda p: p.lrange_aslist('key'), lrange_reply(100000), 5),
+        ('role 5 replicas', lambda p: (yield from (yield from p.role()).aslist()), role_reply(5), 2000),
+        ('role 500 replicas', lambda p: (yield from (yield from p.role()).aslist()), role_reply(500), 50),
+    ]
+    print('%-20s %s' % ('scenario', ''.join('%26s' % c.__name__ for c in classes)))
+    for name, command, reply, iterations in scenarios:
+        timings = [loop.run_until_complete(run(c, asyncio.coroutine(command), reply, iterations, loop))
+                   for c in classes]
+        line = '%-20s %s' % (name, ''.join('%24.3fms' % (t * 1000) for t in timings))
+        if len(timings) == 2:
+            line += '   x%.1f' % (timings[0] / timings[1])
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
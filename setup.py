@@ -36,7 +36,7 @@ setup(
 
     packages=['asyncio_redis_ha'],
     install_requires=install_requires,
-    # extra_require={
-    #     'hiredis': ['hiredis'],
-    # }
+    extras_require={
+        'hiredis': ['hiredis'],
+    }
 )
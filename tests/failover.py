@@ -0,0 +1,869 @@
+#!/usr/bin/env python
+"""
+Local failover simulation harness.
+
+Runs a fake Redis master, fake replicas and fake Sentinels inside the event
+loop, so failover scenarios can be driven and measured without docker:
+
+::
+
+    cluster = FakeCluster(replicas=2, sentinels=3, loop=loop)
+    yield from cluster.start()
+
+    manager = yield from ConnectionManager.create(
+        cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, poolsize=4, loop=loop)
+
+    load = LoadGenerator(manager, concurrency=20, loop=loop)
+    load.start()
+    yield from asyncio.sleep(.2, loop=loop)
+    yield from cluster.failover()
+    yield from asyncio.sleep(1, loop=loop)
+    yield from load.stop()
+
+    report = FailoverReport.collect(cluster, load)
+    print(report)
+
+The fake nodes speak just enough RESP for the commands used by the package
+and its tests. The server side is deliberately simple: one in-memory dict per
+node, with writes propagated from the master to its replicas synchronously.
+"""
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from inspect import signature
+
+# In Python 3.4.4, `async` was renamed to `ensure_future`.
+try:
+    ensure_future = asyncio.ensure_future
+except AttributeError:
+    ensure_future = getattr(asyncio, 'async')
+
+
+class Status:
+    """ RESP simple string reply (``+OK``). """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Error:
+    """ RESP error reply (``-ERR ...``). """
+
+    def __init__(self, value):
+        self.value = value
+
+
+OK = Status('OK')
+
+#: Marker for commands that already wrote their replies.
+_NoReply = object()
+
+
+def encode_reply(value):
+    """ Serialize a python value into RESP bytes. """
+    if value is None:
+        return b'$-1\r\n'
+    elif isinstance(value, Status):
+        return b'+' + value.value.encode('utf-8') + b'\r\n'
+    elif isinstance(value, Error):
+        return b'-' + value.value.encode('utf-8') + b'\r\n'
+    elif isinstance(value, bool):
+        return b':' + (b'1' if value else b'0') + b'\r\n'
+    elif isinstance(value, int):
+        return b':' + str(value).encode('ascii') + b'\r\n'
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return b'$' + str(len(value)).encode('ascii') + b'\r\n' + bytes(value) + b'\r\n'
+    elif isinstance(value, (list, tuple)):
+        return b'*' + str(len(value)).encode('ascii') + b'\r\n' + b''.join(encode_reply(v) for v in value)
+    raise TypeError('Cannot encode %r' % (value,))
+
+
+class RequestParser:
+    """ Incremental parser for client requests (arrays of bulk strings). """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer.extend(data)
+
+    def gets(self):
+        """ Return the next complete request as ``list[bytes]``, or ``None``. """
+        buf = self._buffer
+        if not buf:
+            return None
+        assert buf[:1] == b'*', 'Only multibulk requests are supported'
+        pos = buf.find(b'\r\n')
+        if pos < 0:
+            return None
+        count = int(buf[1:pos])
+        pos += 2
+        args = []
+        for _ in range(count):
+            end = buf.find(b'\r\n', pos)
+            if end < 0:
+                return None
+            length = int(buf[pos + 1:end])
+            start = end + 2
+            if len(buf) < start + length + 2:
+                return None
+            args.append(bytes(buf[start:start + length]))
+            pos = start + length + 2
+        del buf[:pos]
+        return args
+
+
+class FakeServerProtocol(asyncio.Protocol):
+    """ Server side of one client connection to a fake node. """
+
+    def __init__(self, node):
+        self.node = node
+        self.transport = None
+        self.parser = RequestParser()
+        self.subscribed = set()
+        self.psubscribed = set()
+        #: Requests queued after MULTI, ``None`` outside of a transaction.
+        self.multi = None
+        self.multi_failed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.node._client_connected(self)
+
+    def connection_lost(self, exc):
+        self.node._client_disconnected(self)
+        self.transport = None
+
+    def data_received(self, data):
+        self.parser.feed(data)
+        if self.node.stalled:
+            # Keep the data, answer once the node resumes.
+            return
+        self.process()
+
+    def process(self):
+        while self.transport is not None:
+            request = self.parser.gets()
+            if request is None:
+                break
+            self.reply(self.node.execute(self, request))
+
+    def reply(self, value):
+        if value is not _NoReply and self.transport is not None:
+            self.transport.write(encode_reply(value))
+
+
+class FakeNode:
+    """
+    Base class for an in-loop fake server listening on a random local port.
+
+    :param loop: asyncio event loop.
+    """
+
+    def __init__(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.host = '127.0.0.1'
+        self.port = None
+        self._server = None
+        self.clients = set()
+        self.stalled = False
+        #: Timestamps (``time.monotonic()``) of accepted connections.
+        self.accepted = []
+        #: Number of commands executed by this node.
+        self.commands_executed = 0
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    @property
+    def is_running(self):
+        return self._server is not None
+
+    @asyncio.coroutine
+    def start(self):
+        """ Start listening, reusing the previous port if the node was killed. """
+        self._server = yield from self._loop.create_server(
+            lambda: FakeServerProtocol(self), self.host, self.port or 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def kill(self):
+        """ Stop listening and drop every client connection. """
+        if self._server is not None:
+            self._server.close()
+            yield from self._server.wait_closed()
+            self._server = None
+        for client in list(self.clients):
+            if client.transport is not None:
+                client.transport.abort()
+        yield from asyncio.sleep(0, loop=self._loop)
+
+    def stall(self):
+        """ Keep connections open, but stop answering requests. """
+        self.stalled = True
+
+    def resume(self):
+        """ Answer every request received while stalled. """
+        self.stalled = False
+        for client in list(self.clients):
+            client.process()
+
+    def _client_connected(self, client):
+        self.clients.add(client)
+        self.accepted.append(time.monotonic())
+
+    def _client_disconnected(self, client):
+        self.clients.discard(client)
+
+    def execute(self, client, request):
+        self.commands_executed += 1
+        name = request[0].decode('ascii').lower()
+        handler = getattr(self, 'cmd_' + name, None)
+        if handler is None:
+            return Error("ERR unknown command '%s'" % name)
+        try:
+            signature(handler).bind(client, *request[1:])
+        except TypeError:
+            return Error("ERR wrong number of arguments for '%s' command" % name)
+        return handler(client, *request[1:])
+
+    def publish(self, channel, message):
+        """ Deliver a message to subscribed clients, return the number of receivers. """
+        receivers = 0
+        for client in list(self.clients):
+            if channel in client.subscribed:
+                client.reply([b'message', channel, message])
+                receivers += 1
+            for pattern in client.psubscribed:
+                if fnmatchcase(channel.decode('utf-8'), pattern.decode('utf-8')):
+                    client.reply([b'pmessage', pattern, channel, message])
+                    receivers += 1
+        return receivers
+
+    # Commands shared by every node type.
+
+    def cmd_ping(self, client, *a):
+        return Status('PONG')
+
+    def cmd_echo(self, client, value):
+        return value
+
+    def cmd_subscribe(self, client, *channels):
+        for channel in channels:
+            client.subscribed.add(channel)
+            client.reply([b'subscribe', channel, len(client.subscribed) + len(client.psubscribed)])
+        # Confirmations already written.
+        return _NoReply
+
+    def cmd_psubscribe(self, client, *patterns):
+        for pattern in patterns:
+            client.psubscribed.add(pattern)
+            client.reply([b'psubscribe', pattern, len(client.subscribed) + len(client.psubscribed)])
+        return _NoReply
+
+    def cmd_publish(self, client, channel, message):
+        return self.publish(channel, message)
+
+
+class FakeRedis(FakeNode):
+    """
+    Fake Redis server with a minimal keyspace.
+
+    :param cluster: owning :class:`FakeCluster`, used for write propagation.
+    """
+
+    def __init__(self, cluster=None, loop=None):
+        super().__init__(loop=loop)
+        self.cluster = cluster
+        self.data = {}
+        self.master = None
+        self.repl_offset = 0
+        #: Number of ``WAIT`` received.
+        self.wait_calls = 0
+        #: Writes of the master not applied yet, see :meth:`pause_replication`.
+        self.replication_backlog = None
+        self.notify_keyspace_events = ''
+        #: Loaded scripts, ``{sha: code}``. (Not replicated, like after a full resync.)
+        self.scripts = {}
+        #: Clients blocked in BLPOP, ``[(client, keys, timeout handle)]``.
+        self.blocked = []
+        #: Salt of the SCAN order, which differs between nodes (like the hash seed of redis).
+        self.scan_salt = str(id(self)).encode('ascii')
+
+    @property
+    def is_master(self):
+        return self.master is None
+
+    def pause_replication(self):
+        """ Stop applying the writes of the master (as a replica lagging behind). """
+        if self.replication_backlog is None:
+            self.replication_backlog = []
+
+    def resume_replication(self):
+        """ Catch up with the master. """
+        backlog, self.replication_backlog = self.replication_backlog or [], None
+        for request in backlog:
+            self.replicate(request)
+
+    def replicate(self, request):
+        """ Apply a write propagated from the master. """
+        if self.replication_backlog is not None:
+            self.replication_backlog.append(request)
+            return
+        self.repl_offset += sum(len(a) for a in request)
+        handler = getattr(self, 'cmd_' + request[0].decode('ascii').lower())
+        handler(None, *request[1:])
+
+    def _write(self, client, request):
+        """ Check that writes are allowed and propagate them to replicas. """
+        if client is None:
+            return None
+        if not self.is_master:
+            return Error("READONLY You can't write against a read only slave.")
+        self.repl_offset += sum(len(a) for a in request)
+        if self.cluster is not None:
+            for replica in self.cluster.replicas_of(self):
+                replica.replicate(request)
+
+    def execute(self, client, request):
+        name = request[0].lower()
+        if client is not None and client.multi is not None and name not in (b'multi', b'exec', b'discard'):
+            self.commands_executed += 1
+            if not hasattr(self, 'cmd_' + name.decode('ascii')):
+                client.multi_failed = True
+                return Error("ERR unknown command '%s'" % name.decode('ascii'))
+            client.multi.append(request)
+            return Status('QUEUED')
+        if name in self.WRITE_COMMANDS:
+            error = self._write(client, request)
+            if error is not None:
+                self.commands_executed += 1
+                return error
+        return super().execute(client, request)
+
+    WRITE_COMMANDS = {b'set', b'mset', b'setex', b'del', b'flushdb', b'hset', b'incr', b'rpush'}
+
+    def notify(self, key, event):
+        """ Publish a keyspace notification, when enabled with ``CONFIG SET notify-keyspace-events``. """
+        if 'K' in self.notify_keyspace_events:
+            self.publish(b'__keyspace@0__:' + key, event)
+
+    def cmd_select(self, client, db):
+        return OK
+
+    def cmd_auth(self, client, password):
+        return OK
+
+    def cmd_config(self, client, subcommand, parameter, *value):
+        if subcommand.lower() == b'set' and parameter.lower() == b'notify-keyspace-events':
+            self.notify_keyspace_events = value[0].decode('ascii')
+            return OK
+        return Error('ERR Unsupported CONFIG parameter')
+
+    def cmd_multi(self, client):
+        if client.multi is not None:
+            return Error('ERR MULTI calls can not be nested')
+        client.multi = []
+        client.multi_failed = False
+        return OK
+
+    def cmd_exec(self, client):
+        queued, client.multi = client.multi, None
+        if queued is None:
+            return Error('ERR EXEC without MULTI')
+        if client.multi_failed:
+            return Error('EXECABORT Transaction discarded because of previous errors.')
+        return [self.execute(client, request) for request in queued]
+
+    def cmd_discard(self, client):
+        if client.multi is None:
+            return Error('ERR DISCARD without MULTI')
+        client.multi = None
+        return OK
+
+    def cmd_get(self, client, key):
+        return self.data.get(key)
+
+    def cmd_incr(self, client, key):
+        try:
+            value = int(self.data.get(key, b'0')) + 1
+        except ValueError:
+            return Error('ERR value is not an integer or out of range')
+        self.data[key] = str(value).encode('ascii')
+        self.notify(key, b'incrby')
+        return value
+
+    def cmd_set(self, client, key, value, *options):
+        self.data[key] = value
+        self.notify(key, b'set')
+        return OK
+
+    def cmd_mset(self, client, *pairs):
+        if not pairs or len(pairs) % 2:
+            return Error("ERR wrong number of arguments for 'mset' command")
+        for key, value in zip(pairs[::2], pairs[1::2]):
+            self.data[key] = value
+            self.notify(key, b'set')
+        return OK
+
+    def cmd_setex(self, client, key, seconds, value):
+        if int(seconds) <= 0:
+            return Error('ERR invalid expire time in setex')
+        # (expiry is not simulated)
+        self.data[key] = value
+        self.notify(key, b'set')
+        return OK
+
+    def cmd_mget(self, client, *keys):
+        values = [self.data.get(key) for key in keys]
+        return [v if isinstance(v, bytes) else None for v in values]
+
+    def cmd_del(self, client, *keys):
+        deleted = [k for k in keys if self.data.pop(k, None) is not None]
+        for key in deleted:
+            self.notify(key, b'del')
+        return len(deleted)
+
+    def cmd_hset(self, client, key, field, value):
+        created = field not in self.data.setdefault(key, {})
+        self.data[key][field] = value
+        self.notify(key, b'hset')
+        return created
+
+    def cmd_hget(self, client, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def cmd_hgetall(self, client, key):
+        return [x for item in self.data.get(key, {}).items() for x in item]
+
+    def _scan(self, names, cursor, options):
+        """ One SCAN page over `names`, the cursor being a position in the order of this node. """
+        options = dict(zip([o.lower() for o in options[::2]], options[1::2]))
+        match = options.get(b'match', b'*').decode('utf-8')
+        count = int(options.get(b'count', b'10'))
+        names = sorted(names, key=lambda n: hashlib.md5(self.scan_salt + n).digest())
+        cursor = int(cursor)
+        page = [n for n in names[cursor:cursor + count] if fnmatchcase(n.decode('utf-8'), match)]
+        cursor += count
+        return (str(cursor) if cursor < len(names) else '0').encode('ascii'), page
+
+    def cmd_scan(self, client, cursor, *options):
+        cursor, page = self._scan(self.data, cursor, options)
+        return [cursor, page]
+
+    def cmd_hscan(self, client, key, cursor, *options):
+        fields = self.data.get(key, {})
+        cursor, page = self._scan(fields, cursor, options)
+        return [cursor, [x for field in page for x in (field, fields[field])]]
+
+    def cmd_flushdb(self, client):
+        self.data.clear()
+        return OK
+
+    def cmd_script(self, client, subcommand, *args):
+        subcommand = subcommand.lower()
+        if subcommand == b'load':
+            sha = hashlib.sha1(args[0]).hexdigest()
+            self.scripts[sha] = args[0]
+            return sha
+        elif subcommand == b'exists':
+            return [int(sha.decode('ascii') in self.scripts) for sha in args]
+        elif subcommand == b'flush':
+            self.scripts.clear()
+            return OK
+        return Error('ERR Unknown SCRIPT subcommand')
+
+    def cmd_evalsha(self, client, sha, numkeys, *args):
+        # Lua is not interpreted, scripts answer with their own source.
+        code = self.scripts.get(sha.decode('ascii'))
+        if code is None:
+            return Error('NOSCRIPT No matching script. Please use EVAL.')
+        return code
+
+    def cmd_rpush(self, client, key, *values):
+        self.data.setdefault(key, []).extend(values)
+        length = len(self.data[key])
+        self.notify(key, b'rpush')
+        self._unblock(key)
+        return length
+
+    def cmd_llen(self, client, key):
+        return len(self.data.get(key, ()))
+
+    def _pop(self, key):
+        items = self.data.get(key)
+        if items:
+            value = items.pop(0)
+            if not items:
+                del self.data[key]
+            return [key, value]
+
+    def cmd_blpop(self, client, *args):
+        keys, timeout = args[:-1], int(args[-1])
+        for key in keys:
+            reply = self._pop(key)
+            if reply:
+                return reply
+
+        entry = [client, keys, None]
+        if timeout:
+            entry[2] = self._loop.call_later(timeout, self._timeout_blocked, entry)
+        self.blocked.append(entry)
+        return _NoReply
+
+    def _timeout_blocked(self, entry):
+        if entry in self.blocked:
+            self.blocked.remove(entry)
+            if entry[0].transport is not None:
+                entry[0].transport.write(b'*-1\r\n')
+
+    def _unblock(self, key):
+        for entry in list(self.blocked):
+            client, keys, handle = entry
+            if client.transport is None:
+                self.blocked.remove(entry)
+            elif key in keys:
+                reply = self._pop(key)
+                if reply is None:
+                    break
+                self.blocked.remove(entry)
+                if handle:
+                    handle.cancel()
+                client.reply(reply)
+
+    def cmd_wait(self, client, numreplicas, timeout):
+        """ Replicas which applied every write (answers at once, even when short of `numreplicas`). """
+        self.wait_calls += 1
+        replicas = self.cluster.replicas_of(self) if self.cluster else []
+        return sum(1 for r in replicas if r.is_running and r.repl_offset >= self.repl_offset)
+
+    def cmd_role(self, client):
+        if self.is_master:
+            replicas = self.cluster.replicas_of(self) if self.cluster else []
+            return ['master', self.repl_offset,
+                    [[r.host, str(r.port), str(r.repl_offset)] for r in replicas if r.is_running]]
+        return ['slave', self.master.host, self.master.port, 'connected', self.repl_offset]
+
+
+class FakeSentinel(FakeNode):
+    """
+    Fake Sentinel answering from the topology of the :class:`FakeCluster`
+    instances it watches.
+    """
+
+    def __init__(self, cluster, loop=None):
+        super().__init__(loop=loop)
+        self.clusters = {cluster.name: cluster}
+
+    def watch(self, cluster):
+        self.clusters[cluster.name] = cluster
+
+    def cmd_role(self, client):
+        return ['sentinel', sorted(self.clusters)]
+
+    def cmd_sentinel(self, client, subcommand, *args):
+        subcommand = subcommand.decode('ascii').lower().replace('-', '_')
+        handler = getattr(self, 'sentinel_' + subcommand, None)
+        if handler is None:
+            return Error('ERR Unknown sentinel subcommand')
+        return handler(*args)
+
+    def _cluster(self, name):
+        return self.clusters.get(name.decode('utf-8'))
+
+    def sentinel_get_master_addr_by_name(self, name):
+        cluster = self._cluster(name)
+        if cluster is None:
+            return None
+        master = cluster.master
+        return [master.host, str(master.port)]
+
+    def sentinel_slaves(self, name):
+        cluster = self._cluster(name)
+        if cluster is None:
+            return Error('ERR No such master with that name')
+        result = []
+        for replica in cluster.replicas_of(cluster.master):
+            flags = 'slave' if replica.is_running else 'slave,s_down,disconnected'
+            result.append([
+                'name', '%s:%s' % replica.address,
+                'ip', replica.host,
+                'port', str(replica.port),
+                'flags', flags,
+                'master-link-down-time', '0',
+                'master-link-status', 'ok',
+                'master-host', cluster.master.host,
+                'master-port', str(cluster.master.port),
+                'slave-priority', '100',
+                'slave-repl-offset', str(replica.repl_offset),
+            ])
+        return result
+
+    def sentinel_sentinels(self, name):
+        cluster = self._cluster(name)
+        if cluster is None:
+            return Error('ERR No such master with that name')
+        return [
+            ['name', 'sentinel-%s' % s.port, 'ip', s.host, 'port', str(s.port), 'flags', 'sentinel']
+            for s in cluster.sentinels if s is not self
+        ]
+
+
+class FakeCluster:
+    """
+    A fake master with replicas, watched by fake sentinels.
+
+    :param name: master name as known to the sentinels.
+    :param replicas: number of replicas.
+    :param sentinels: number of sentinels, or the sentinels of another
+        cluster, to watch both of them.
+    """
+
+    def __init__(self, name='mymaster', replicas=1, sentinels=3, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.name = name
+        self.nodes = [FakeRedis(self, loop=self._loop) for _ in range(replicas + 1)]
+        self.master = self.nodes[0]
+        for replica in self.nodes[1:]:
+            replica.master = self.master
+        if isinstance(sentinels, int):
+            self.sentinels = [FakeSentinel(self, loop=self._loop) for _ in range(sentinels)]
+        else:
+            self.sentinels = list(sentinels)
+            for sentinel in self.sentinels:
+                sentinel.watch(self)
+        #: ``(monotonic time, event name)`` of every topology change.
+        self.events = []
+
+    @property
+    def sentinel_addresses(self):
+        return [s.address for s in self.sentinels]
+
+    def replicas_of(self, master):
+        return [n for n in self.nodes if n.master is master]
+
+    @asyncio.coroutine
+    def start(self):
+        for node in self.nodes + self.sentinels:
+            if not node.is_running:
+                yield from node.start()
+
+    @asyncio.coroutine
+    def stop(self):
+        for node in self.nodes + self.sentinels:
+            yield from node.kill()
+
+    def _event(self, name):
+        self.events.append((time.monotonic(), name))
+
+    @asyncio.coroutine
+    def kill_master(self):
+        """ Kill the current master without promoting anybody. """
+        self._event('kill-master')
+        yield from self.master.kill()
+
+    def promote(self, replica=None):
+        """
+        Promote a replica to master, and point every other node at it.
+        Sentinels answer with the new address from now on and publish
+        ``+switch-master``.
+        """
+        old = self.master
+        replica = replica or next(n for n in self.nodes if n is not old and n.is_running)
+        replica.master = None
+        for node in self.nodes:
+            if node is not replica:
+                node.master = replica
+        self.master = replica
+        self._event('promote')
+
+        message = ('%s %s %s %s %s' % (self.name, old.host, old.port, replica.host, replica.port)).encode('utf-8')
+        for sentinel in self.sentinels:
+            if sentinel.is_running:
+                sentinel.publish(b'+switch-master', message)
+
+    @asyncio.coroutine
+    def failover(self, delay=0):
+        """
+        Kill the master, wait ``delay`` seconds (the sentinel down-after
+        period) and promote a replica.
+        """
+        yield from self.kill_master()
+        if delay:
+            yield from asyncio.sleep(delay, loop=self._loop)
+        self.promote()
+
+    def connections_accepted(self):
+        """ Sorted accept timestamps over every redis node. """
+        return sorted(t for n in self.nodes for t in n.accepted)
+
+
+class LoadGenerator:
+    """
+    Run ``concurrency`` workers issuing commands through a manager until stopped.
+
+    :param command: coroutine function ``f(manager, worker, sequence)``;
+        defaults to a ``SET`` of a per-worker key.
+    :param failure_pause: seconds a worker sleeps after a failed command,
+        so that a broken pool does not spin the loop.
+    """
+
+    def __init__(self, manager, concurrency=10, command=None, failure_pause=.005, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.manager = manager
+        self.concurrency = concurrency
+        self.command = command or self._default_command
+        self.failure_pause = failure_pause
+        #: ``(started, finished, succeeded)`` monotonic times per command.
+        self.results = []
+        self._running = False
+        self._workers = []
+
+    @staticmethod
+    def _default_command(manager, worker, sequence):
+        return manager.set('load:%s' % worker, str(sequence))
+
+    @asyncio.coroutine
+    def _worker(self, worker):
+        sequence = 0
+        while self._running:
+            sequence += 1
+            started = time.monotonic()
+            try:
+                yield from self.command(self.manager, worker, sequence)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.results.append((started, time.monotonic(), False))
+                yield from asyncio.sleep(self.failure_pause, loop=self._loop)
+            else:
+                self.results.append((started, time.monotonic(), True))
+
+    def start(self):
+        self._running = True
+        self._workers = [ensure_future(self._worker(i), loop=self._loop) for i in range(self.concurrency)]
+
+    @asyncio.coroutine
+    def stop(self, timeout=1):
+        """ Stop workers, cancelling the ones still stuck in a command after ``timeout``. """
+        self._running = False
+        done, pending = yield from asyncio.wait(self._workers, timeout=timeout, loop=self._loop)
+        for worker in pending:
+            worker.cancel()
+        if pending:
+            yield from asyncio.wait(pending, loop=self._loop)
+        self._workers = []
+
+
+class FailoverReport:
+    """
+    Failover metrics computed from the recorded load and cluster events.
+
+    :ivar recovery_time: seconds from the master being killed to the first
+        success of a command issued after the kill (``None`` if it never
+        recovered).
+    :ivar failed_commands: commands issued after the kill that failed.
+    :ivar succeeded_commands: commands issued after the kill that succeeded.
+    :ivar peak_reconnect_rate: highest number of connections accepted by
+        the redis nodes within ``window`` seconds, scaled to per second.
+    """
+
+    def __init__(self, recovery_time, failed_commands, succeeded_commands, peak_reconnect_rate):
+        self.recovery_time = recovery_time
+        self.failed_commands = failed_commands
+        self.succeeded_commands = succeeded_commands
+        self.peak_reconnect_rate = peak_reconnect_rate
+
+    @classmethod
+    def collect(cls, cluster, load, window=.1):
+        killed_at = next((t for t, name in cluster.events if name == 'kill-master'), None)
+        after = [(finished, ok) for started, finished, ok in load.results
+                 if killed_at is None or started >= killed_at]
+
+        successes = [t for t, ok in after if ok]
+        first_success = min(successes) if successes else None
+        recovery_time = None
+        if killed_at is not None and first_success is not None:
+            recovery_time = first_success - killed_at
+
+        return cls(
+            recovery_time=recovery_time,
+            failed_commands=sum(1 for t, ok in after if not ok),
+            succeeded_commands=sum(1 for t, ok in after if ok),
+            peak_reconnect_rate=peak_rate(cluster.connections_accepted(), window),
+        )
+
+    def __repr__(self):
+        return ('FailoverReport(recovery_time=%r, failed_commands=%r, succeeded_commands=%r, '
+                'peak_reconnect_rate=%r)' % (self.recovery_time, self.failed_commands,
+                                             self.succeeded_commands, self.peak_reconnect_rate))
+
+    def asdict(self):
+        return OrderedDict([
+            ('recovery_time', self.recovery_time),
+            ('failed_commands', self.failed_commands),
+            ('succeeded_commands', self.succeeded_commands),
+            ('peak_reconnect_rate', self.peak_reconnect_rate),
+        ])
+
+
+def peak_rate(timestamps, window):
+    """ Highest number of events in any ``window`` seconds, per second. """
+    peak = 0
+    start = 0
+    for end, t in enumerate(timestamps):
+        while t - timestamps[start] > window:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak / window
+
+
+@asyncio.coroutine
+def simulate_failover(manager_factory, *, replicas=1, concurrency=10, warmup=.2, failover_delay=0,
+                      settle=1, loop=None):
+    """
+    Run one failover scenario and return its :class:`FailoverReport`.
+
+    :param manager_factory: coroutine function ``f(cluster)`` returning a
+        started :class:`~asyncio_redis_ha.ConnectionManager`.
+    """
+    loop = loop or asyncio.get_event_loop()
+    cluster = FakeCluster(replicas=replicas, loop=loop)
+    yield from cluster.start()
+    manager = yield from manager_factory(cluster)
+    load = LoadGenerator(manager, concurrency=concurrency, loop=loop)
+    try:
+        load.start()
+        yield from asyncio.sleep(warmup, loop=loop)
+        yield from cluster.failover(delay=failover_delay)
+        yield from asyncio.sleep(settle, loop=loop)
+    finally:
+        yield from load.stop()
+        manager.close()
+        yield from cluster.stop()
+    return FailoverReport.collect(cluster, load)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+
+    from asyncio_redis_ha import ConnectionManager
+
+    @asyncio.coroutine
+    def factory(cluster):
+        return (yield from ConnectionManager.create(
+            cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, poolsize=4))
+
+    loop = asyncio.get_event_loop()
+    for delay in (0, .5):
+        report = loop.run_until_complete(simulate_failover(factory, concurrency=20, failover_delay=delay))
+        print('failover_delay=%s' % delay)
+        for key, value in report.asdict().items():
+            print('  %-20s %s' % (key, value))
@@ -2,8 +2,13 @@
 
 import asyncio
 import gc
+import inspect
 import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from asyncio.futures import Future
 from asyncio.tasks import gather
 from asyncio.test_utils import run_briefly
@@ -28,6 +33,7 @@ from asyncio_redis import (
 from asyncio_redis.cursors import Cursor
 from asyncio_redis.encoders import BytesEncoder
 from asyncio_redis.exceptions import TimeoutError, ConnectionLostError
+from asyncio_redis.protocol import MultiBulkReply
 from asyncio_redis.replies import (
     BlockingPopReply,
     ClientListReply,
@@ -42,10 +48,27 @@ from asyncio_redis.replies import (
     ZRangeReply,
 )
 
+from asyncio_redis_ha.admission import AdmissionController, AdmissionPolicy, request_size
+from asyncio_redis_ha.cache import NearCache
+from asyncio_redis_ha.commands import CommandFlags, command_flags
 from asyncio_redis_ha.connection import SentinelConnection, RedisConnection
+from asyncio_redis_ha.exceptions import CommandTimeoutError, ConsumerClosedError, NoScriptError, NotReplicatedError, \
+    OverloadedError, TopologyBusyError
+from asyncio_redis_ha.durability import WaitPolicy
+from asyncio_redis_ha.group import SentinelGroup
+from asyncio_redis_ha.hedging import HedgePolicy
+from asyncio_redis_ha.topology import SharedTopology, _HEADER, _MAGIC
+from asyncio_redis_ha.pubsub import OverflowPolicy
 from asyncio_redis_ha.manager import ConnectionManager
-from asyncio_redis_ha.protocol import ExtendedProtocol, SentinelProtocol
-from asyncio_redis_ha.replies import NestedDictReply, NestedListReply
+from asyncio_redis_ha import pipeline as ha_pipeline
+from asyncio_redis_ha import protocol as ha_protocol
+from asyncio_redis_ha.manager import HighAvailabilityConfig
+from asyncio_redis_ha.protocol import ExtendedProtocol, SentinelProtocol, HiRedisExtendedProtocol, \
+    HiRedisSentinelProtocol, _HEADERS
+from asyncio_redis_ha.replication import ReplicationLag
+from asyncio_redis_ha.replies import NestedDictReply, NestedListReply, NodeFlags, ReplicaInfo, ReplicaListReply, \
+    SentinelInfo, SentinelListReply
+from failover import Error as FakeError, FakeCluster, FakeRedis, FailoverReport, LoadGenerator, simulate_failover
 
 try:
     import hiredis
@@ -2490,6 +2513,231 @@ class ExtendedRedisProtocolTest(RedisProtocolTest):
         print(data)
 
 
+class NestedReplyTest(TestCase):
+    """ Decoding of nested replies, fed by hand instead of by a server. """
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.protocol = ExtendedProtocol(loop=self.loop)
+
+    def role_reply(self, replicas):
+        reply = MultiBulkReply(self.protocol, 3, loop=self.loop)
+        nested = MultiBulkReply(self.protocol, len(replicas), loop=self.loop)
+        reply._feed_received(b'master')
+        reply._feed_received(42)
+        reply._feed_received(nested)
+        return reply, nested
+
+    def feed_replicas(self, nested, replicas):
+        for host, port in replicas:
+            replica = MultiBulkReply(self.protocol, 2, loop=self.loop)
+            nested._feed_received(replica)
+            replica._feed_received(host)
+            replica._feed_received(port)
+
+    def test_buffered_nested_list(self):
+        replicas = [(b'10.0.0.1', b'6379'), (b'10.0.0.2', b'6380')]
+        reply, nested = self.role_reply(replicas)
+        self.feed_replicas(nested, replicas)
+
+        data = self.loop.run_until_complete(NestedListReply(reply).aslist())
+        self.assertEqual(data, ['master', 42, [['10.0.0.1', '6379'], ['10.0.0.2', '6380']]])
+
+    def test_streaming_nested_list(self):
+        replicas = [(b'10.0.0.1', b'6379'), (b'10.0.0.2', b'6380')]
+        reply, nested = self.role_reply(replicas)
+
+        f = ensure_future(NestedListReply(reply).aslist(), loop=self.loop)
+        run_briefly(self.loop)
+        self.assertFalse(f.done())
+
+        self.feed_replicas(nested, replicas)
+        data = self.loop.run_until_complete(f)
+        self.assertEqual(data, ['master', 42, [['10.0.0.1', '6379'], ['10.0.0.2', '6380']]])
+
+    def test_nested_dict(self):
+        reply = MultiBulkReply(self.protocol, 2, loop=self.loop)
+        for name in (b'a', b'b'):
+            node = MultiBulkReply(self.protocol, 4, loop=self.loop)
+            reply._feed_received(node)
+            for item in (b'name', name, b'port', b'6379'):
+                node._feed_received(item)
+
+        data = self.loop.run_until_complete(NestedDictReply(reply).aslist())
+        self.assertEqual(data, [{'name': 'a', 'port': '6379'}, {'name': 'b', 'port': '6379'}])
+
+
+class NodeInfoTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_flags(self):
+        self.assertEqual(NodeFlags.parse('slave'), NodeFlags.SLAVE)
+        self.assertEqual(NodeFlags.parse('slave,s_down,disconnected'),
+                         NodeFlags.SLAVE | NodeFlags.S_DOWN | NodeFlags.DISCONNECTED)
+        self.assertEqual(NodeFlags.parse('slave,unknown'), NodeFlags.SLAVE)
+
+    def test_replica_from_pairs(self):
+        replica = ReplicaInfo.from_pairs([
+            'name', '10.0.0.1:6379', 'ip', '10.0.0.1', 'port', '6379', 'flags', 'slave,s_down',
+            'master-link-down-time', '0', 'slave-priority', '100', 'slave-repl-offset', '123456',
+            'not-a-field', 'ignored',
+        ])
+        self.assertEqual(replica.address, ('10.0.0.1', 6379))
+        self.assertEqual(replica.slave_repl_offset, 123456)
+        self.assertEqual(replica.slave_priority, 100)
+        self.assertTrue(replica.is_down)
+        self.assertIsNone(replica.master_host)
+        self.assertEqual(replica, ReplicaInfo(
+            name='10.0.0.1:6379', ip='10.0.0.1', port=6379, flags=NodeFlags.SLAVE | NodeFlags.S_DOWN,
+            master_link_down_time=0, slave_priority=100, slave_repl_offset=123456))
+        with self.assertRaises(AttributeError):
+            replica.extra = 1
+
+    def test_bytes_fields(self):
+        sentinel = SentinelInfo.from_pairs([b'ip', b'10.0.0.2', b'port', b'26379', b'flags', b'sentinel'])
+        self.assertEqual(sentinel.address, ('10.0.0.2', 26379))
+        self.assertFalse(sentinel.is_down)
+
+    def test_fake_sentinel_records(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            connection = yield from SentinelConnection.create(*cluster.sentinels[0].address, loop=self.loop)
+
+            reply = yield from connection.slaves('mymaster')
+            self.assertIsInstance(reply, ReplicaListReply)
+            replicas = yield from reply.asrecords()
+            self.assertEqual([r.address for r in replicas], [n.address for n in cluster.nodes[1:]])
+
+            sentinels = yield from connection.sentinels_asrecords('mymaster')
+            self.assertEqual(len(sentinels), 2)
+            self.assertTrue(all(s.flags == NodeFlags.SENTINEL for s in sentinels))
+
+            reply = yield from connection.sentinels('mymaster')
+            self.assertIsInstance(reply, SentinelListReply)
+            self.assertEqual(len((yield from reply.aslist())), 2)
+
+            connection.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class CommandMethodTest(TestCase):
+    def test_lazy_docstring(self):
+        method = SentinelProtocol.__dict__['get_master_addr_by_name_aslist']
+        self.assertIsNone(method._doc)
+
+        doc = SentinelProtocol.get_master_addr_by_name_aslist.__doc__
+        self.assertTrue(doc.startswith('get_master_addr_by_name_aslist(self, tr, name)\n'))
+        self.assertIn('sentinel get master command', doc)
+        self.assertIn(':returns: (Future of) list', doc)
+        self.assertIs(method._doc, doc)
+
+    def test_bound_method(self):
+        protocol = SentinelProtocol(loop=asyncio.get_event_loop())
+        self.assertEqual(protocol.slaves.__name__, 'slaves')
+        self.assertIs(protocol.slaves.__self__, protocol)
+
+        # Generating the docstring also updates the one of bound methods.
+        SentinelProtocol.slaves.__doc__
+        self.assertIn(':returns: (Future of) :class:`ReplicaListReply', protocol.slaves.__doc__)
+
+    def test_import(self):
+        script = '\n'.join([
+            'import sys',
+            'import asyncio_redis_ha',
+            'print(asyncio_redis_ha.ExtendedProtocol.__dict__["evalsha"]._doc is None)',
+            'print(sorted(m for m in sys.modules if m in ("asyncio_redis_ha.bulk", "asyncio_redis_ha.topology")))',
+            'print(asyncio_redis_ha.SharedTopology.__module__)',
+        ])
+        root = os.path.dirname(os.path.dirname(ha_protocol.__file__))
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=root).decode().splitlines()
+
+        # The manager proxies copy the names of the commands, not their docstrings.
+        self.assertEqual(output[0], 'True')
+        self.assertEqual(ConnectionManager.evalsha.__name__, 'evalsha')
+        if sys.version_info >= (3, 7):
+            # optional features are imported on first use
+            self.assertEqual(output[1], '[]')
+        self.assertEqual(output[2], 'asyncio_redis_ha.topology')
+
+
+class CommandRegistryTest(TestCase):
+    def test_flags(self):
+        commands = ExtendedProtocol.commands
+        self.assertEqual(commands['get'].flags, CommandFlags.READONLY)
+        self.assertTrue(commands['hgetall_asdict'].is_readonly)
+        self.assertEqual(commands['hgetall_asdict'].command, 'hgetall')
+        self.assertEqual(commands['set'].flags, CommandFlags.WRITE)
+        self.assertTrue(commands['blpop'].is_blocking)
+        self.assertTrue(commands['blpop'].is_write)
+        self.assertTrue(commands['publish'].is_pubsub)
+        self.assertTrue(commands['role'].is_admin)
+        self.assertTrue(commands['flushdb'].is_write)
+
+    #: Commands flagged ``readonly`` by ``COMMAND`` (Redis 7.2), but for
+    #: XREAD, which blocks. Container commands (OBJECT, XINFO) by their name.
+    REDIS_READONLY = frozenset('''
+        bitcount bitfield_ro bitpos dbsize dump eval_ro evalsha_ro exists expiretime fcall_ro geodist geohash
+        geopos georadius_ro georadiusbymember_ro geosearch get getbit getrange hexists hget hgetall hkeys hlen
+        hmget hrandfield hscan hstrlen hvals keys lcs lindex llen lpos lrange mget object pexpiretime pfcount
+        pttl randomkey scan scard sdiff sinter sintercard sismember smembers smismember sort_ro srandmember sscan
+        strlen substr sunion touch ttl type xinfo xlen xpending xrange xrevrange zcard zcount zdiff zinter
+        zintercard zlexcount zmscore zrandmember zrange zrangebylex zrangebyscore zrank zrevrange zrevrangebylex
+        zrevrangebyscore zrevrank zscan zscore zunion
+    '''.split())
+
+    def test_readonly_table(self):
+        # every read Redis allows on a replica is known, even if not exposed yet
+        for command in self.REDIS_READONLY:
+            self.assertEqual(command_flags(command), CommandFlags.READONLY, command)
+
+        # and the registry agrees with Redis, but for a few harmless extras
+        extras = {'echo', 'ping', '_scan', '_do_scan'}
+        for info in ExtendedProtocol.commands.values():
+            if info.command in self.REDIS_READONLY or info.command in extras:
+                self.assertTrue(info.is_readonly, info.name)
+            else:
+                self.assertFalse(info.is_readonly, info.name)
+
+    def test_keys(self):
+        commands = ExtendedProtocol.commands
+        self.assertEqual(commands['get'].keys(('key',), {}), ['key'])
+        self.assertEqual(commands['mget'].keys((['a', 'b'],), {}), ['a', 'b'])
+        self.assertEqual(commands['rename'].keys(('a',), {'newkey': 'b'}), ['a', 'b'])
+        self.assertEqual(commands['ping'].keys((), {}), [])
+
+    def test_per_class(self):
+        self.assertIn('role', ExtendedProtocol.commands)
+        self.assertNotIn('slaves', ExtendedProtocol.commands)
+        self.assertIn('slaves', SentinelProtocol.commands)
+        self.assertIn('slaves_asrecords', SentinelProtocol.commands)
+        self.assertIn('get', SentinelProtocol.commands)
+        with self.assertRaises(TypeError):
+            ExtendedProtocol.commands['foo'] = None
+
+    def test_connection_proxy(self):
+        connection = RedisConnection()
+        connection.protocol = ExtendedProtocol(loop=asyncio.get_event_loop())
+        self.assertEqual(connection.role.__name__, 'role')
+        with self.assertRaises(AttributeError):
+            connection.slaves
+
+        connection = SentinelConnection()
+        connection.protocol = SentinelProtocol(loop=asyncio.get_event_loop())
+        self.assertEqual(connection.slaves.__name__, 'slaves')
+
+
+@unittest.skipIf(hiredis == None, 'Hiredis not found.')
+class HiRedisExtendedProtocolTest(ExtendedRedisProtocolTest):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.protocol_class = HiRedisExtendedProtocol
+
+
 class SentinelProtocolTest(TestCase):
     def setUp(self):
         self.loop = asyncio.get_event_loop()
@@ -2522,6 +2770,51 @@ class SentinelProtocolTest(TestCase):
         data = yield from reply.aslist()
         self.assertIsInstance(data, list)
 
+    @redis_test
+    def test_slaves_asrecords(self, transport, protocol):
+        data = yield from protocol.slaves_asrecords('mymaster')
+        self.assertIsInstance(data, list)
+        for replica in data:
+            self.assertIsInstance(replica, ReplicaInfo)
+            self.assertTrue(replica.flags & NodeFlags.SLAVE)
+            self.assertIsInstance(replica.port, int)
+
+    @redis_test
+    def test_sentinels_asrecords(self, transport, protocol):
+        data = yield from protocol.sentinels_asrecords('mymaster')
+        for sentinel in data:
+            self.assertIsInstance(sentinel, SentinelInfo)
+            self.assertTrue(sentinel.flags & NodeFlags.SENTINEL)
+
+
+@unittest.skipIf(hiredis == None, 'Hiredis not found.')
+class HiRedisSentinelProtocolTest(SentinelProtocolTest):
+    def setUp(self):
+        super().setUp()
+        self.protocol_class = HiRedisSentinelProtocol
+
+
+class HighAvailabilityConfigTest(TestCase):
+    def test_default_protocols(self):
+        config = HighAvailabilityConfig('mymaster', [])
+        self.assertIs(config.protocol_class, ExtendedProtocol)
+        self.assertIs(config.sentinel_protocol_class, SentinelProtocol)
+
+    @unittest.skipIf(hiredis == None, 'Hiredis not found.')
+    def test_hiredis_protocols(self):
+        config = HighAvailabilityConfig('mymaster', [], protocol_class=HiRedisExtendedProtocol)
+        self.assertIs(config.protocol_class, HiRedisExtendedProtocol)
+        self.assertIs(config.sentinel_protocol_class, HiRedisSentinelProtocol)
+
+    def test_hiredis_fallback(self):
+        original, ha_protocol.hiredis = ha_protocol.hiredis, None
+        try:
+            config = HighAvailabilityConfig('mymaster', [], protocol_class=HiRedisExtendedProtocol)
+            self.assertIs(config.protocol_class, ExtendedProtocol)
+            self.assertIs(config.sentinel_protocol_class, SentinelProtocol)
+        finally:
+            ha_protocol.hiredis = original
+
 
 class ConnectionManagerTest(RedisPoolTest):
     """ Test connection pooling. """
@@ -2604,7 +2897,8 @@ class ConnectionManagerTest(RedisPoolTest):
             for s in connection._sentinels:
                 s.close()
             # Ruin configuration to prevent reopenning of sentinel connections
-            connection.config.sentinels = []
+            # (the sentinel group keeps the addresses, not the config)
+            connection._group.sentinels = []
 
             # Close transport
             c = connection._connections[0]
@@ -2623,6 +2917,2029 @@ class ConnectionManagerTest(RedisPoolTest):
         self.loop.run_until_complete(test())
 
 
+class FailoverSimulationTest(TestCase):
+    """
+    Failover scenarios against the fake cluster from `failover.py`.
+    The thresholds below are regression bounds, not targets.
+    """
+    MAX_RECOVERY_OVERHEAD = .5
+    MAX_PEAK_RECONNECT_RATE = 2000
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def create_manager(self, cluster, poolsize=4):
+        return (yield from ConnectionManager.create(
+            cluster_name=cluster.name,
+            sentinels=cluster.sentinel_addresses,
+            poolsize=poolsize,
+            loop=self.loop))
+
+    def test_fake_cluster(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from self.create_manager(cluster)
+
+            yield from manager.set('key', 'value')
+            self.assertEqual((yield from manager.get('key')), 'value')
+            # writes are propagated to replicas
+            for replica in cluster.nodes[1:]:
+                self.assertEqual(replica.data[b'key'], b'value')
+
+            role = yield from (yield from manager.role()).aslist()
+            self.assertEqual(role[0], 'master')
+            self.assertEqual(len(role[2]), 2)
+
+            manager.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_fake_arity(self):
+        node = FakeRedis(loop=self.loop)
+        reply = node.execute(None, [b'echo'])
+        self.assertIsInstance(reply, FakeError)
+        self.assertEqual(reply.value, "ERR wrong number of arguments for 'echo' command")
+
+        # a bug in a handler is not mistaken for a wrong number of arguments
+        node.cmd_echo = lambda client, value: value + 1
+        with self.assertRaises(TypeError):
+            node.execute(None, [b'echo', b'value'])
+
+    def test_switch_master_published(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+
+            connection = yield from Connection.create(*cluster.sentinels[0].address, loop=self.loop)
+            subscription = yield from connection.start_subscribe()
+            yield from subscription.subscribe(['+switch-master'])
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            old, new = cluster.nodes
+            yield from cluster.failover()
+            message = yield from subscription.next_published()
+            self.assertEqual(message.channel, '+switch-master')
+            self.assertEqual(message.value, 'mymaster %s %s %s %s' % (old.host, old.port, new.host, new.port))
+            self.assertIs(cluster.master, new)
+
+            connection.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_stalled_node(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from self.create_manager(cluster, poolsize=1)
+
+            cluster.master.stall()
+            f = ensure_future(manager.set('key', 'value'), loop=self.loop)
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertFalse(f.done())
+
+            cluster.master.resume()
+            self.assertEqual((yield from f), StatusReply('OK'))
+
+            manager.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_failover_under_load(self):
+        @asyncio.coroutine
+        def test():
+            report = yield from simulate_failover(self.create_manager, concurrency=20, loop=self.loop)
+            self.assertIsInstance(report, FailoverReport)
+            self.assertIsNotNone(report.recovery_time)
+            self.assertLess(report.recovery_time, self.MAX_RECOVERY_OVERHEAD)
+            self.assertGreater(report.succeeded_commands, 0)
+            self.assertLessEqual(report.peak_reconnect_rate, self.MAX_PEAK_RECONNECT_RATE)
+
+        self.loop.run_until_complete(test())
+
+    @unittest.skipIf(hiredis == None, 'Hiredis not found.')
+    def test_hiredis_manager(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses,
+                protocol_class=HiRedisExtendedProtocol, loop=self.loop)
+            self.assertIsInstance(manager._sentinels[0].protocol, HiRedisSentinelProtocol)
+            self.assertIsInstance(manager._connections[0].protocol, HiRedisExtendedProtocol)
+
+            yield from manager.set('key', 'value')
+            self.assertEqual((yield from manager.get('key')), 'value')
+            role = yield from (yield from manager.role()).aslist()
+            self.assertEqual(role[0], 'master')
+            self.assertEqual(len(role[2]), 2)
+
+            manager.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_delayed_promotion(self):
+        @asyncio.coroutine
+        def test():
+            delay = .3
+            report = yield from simulate_failover(self.create_manager, concurrency=10, failover_delay=delay,
+                                                  loop=self.loop)
+            self.assertIsNotNone(report.recovery_time)
+            self.assertGreaterEqual(report.recovery_time, delay)
+            self.assertLess(report.recovery_time, delay + self.MAX_RECOVERY_OVERHEAD)
+            # every worker fails at least once while there is no master
+            self.assertGreaterEqual(report.failed_commands, 10)
+
+        self.loop.run_until_complete(test())
+
+    def test_read_from_replicas(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses,
+                poolsize=2, read_from_replicas=True, loop=self.loop)
+            self.assertEqual(manager.replicas_connected, 4)
+
+            master, replicas = cluster.master, cluster.nodes[1:]
+            yield from manager.set('key', 'value')
+            executed = master.commands_executed
+            for i in range(4):
+                self.assertEqual((yield from manager.get('key')), 'value')
+            self.assertEqual(master.commands_executed, executed)
+            self.assertTrue(all(r.commands_executed > 2 for r in replicas))
+
+            # writes never go to a replica
+            yield from manager.delete(['key'])
+            self.assertEqual(master.commands_executed, executed + 1)
+
+            # replicas are rediscovered together with the master
+            yield from cluster.failover()
+            yield from asyncio.sleep(.05, loop=self.loop)
+            yield from manager.set('key', 'value')
+            self.assertIs(cluster.master, replicas[0])
+            self.assertEqual(manager.replicas_connected, 2)
+            executed = replicas[1].commands_executed
+            self.assertEqual((yield from manager.get('key')), 'value')
+            self.assertEqual(replicas[1].commands_executed, executed + 1)
+
+            manager.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class ScriptRegistryTest(TestCase):
+    CODE = 'return 1'
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, poolsize=2, loop=self.loop,
+                **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_noscript_error(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            connection = yield from RedisConnection.create(*cluster.master.address, loop=self.loop)
+            with self.assertRaises(NoScriptError):
+                yield from connection.evalsha('0' * 40)
+            # still what asyncio_redis raises
+            with self.assertRaises(ScriptKilledError):
+                yield from connection.evalsha('0' * 40)
+            connection.close()
+
+        self.run_with_manager(test)
+
+    def test_reload_on_noscript(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            script = yield from manager.register_script(self.CODE)
+            self.assertIn(script.sha, manager.scripts)
+
+            cluster.master.scripts.clear()
+            reply = yield from script.run()
+            self.assertEqual((yield from reply.return_value()), self.CODE)
+            self.assertIn(script.sha, cluster.master.scripts)
+
+            # unknown scripts are not retried
+            with self.assertRaises(NoScriptError):
+                yield from manager.evalsha('0' * 40)
+
+        self.run_with_manager(test)
+
+    def test_preload_after_failover(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            scripts = []
+            for i in range(3):
+                scripts.append((yield from manager.register_script('return %i' % i)))
+            self.assertEqual(len(manager.scripts), 3)
+            for replica in cluster.nodes[1:]:
+                self.assertEqual(replica.scripts, {})
+
+            yield from cluster.failover()
+            yield from asyncio.sleep(.05, loop=self.loop)
+            yield from manager.discover()
+            # loaded on the new master (and the replicas) before the first evalsha
+            self.assertEqual(set(cluster.master.scripts), {s.sha for s in scripts})
+            self.assertEqual(set(cluster.nodes[2].scripts), {s.sha for s in scripts})
+
+            reply = yield from scripts[2].run()
+            self.assertEqual((yield from reply.return_value()), 'return 2')
+
+        self.run_with_manager(test, read_from_replicas=True)
+
+
+class PipelineTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, poolsize=2, loop=self.loop,
+                **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def count_writes(self, manager):
+        writes = []
+        for c in manager._connections:
+            write = c.protocol.transport.write
+
+            def counting_write(data, write=write):
+                writes.append(data)
+                write(data)
+            c.protocol.transport.write = counting_write
+        return writes
+
+    def test_pipeline(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            writes = self.count_writes(manager)
+            pipeline = manager.pipeline()
+            pipeline.set('key', 'value').get('key')
+            pipeline.incr('counter')
+            pipeline.incr('counter')
+            pipeline.hgetall_asdict('missing')
+            self.assertEqual(len(pipeline), 5)
+
+            results = yield from pipeline.execute()
+            self.assertEqual(results, [StatusReply('OK'), 'value', 1, 2, {}])
+            self.assertEqual(len(writes), 1)
+            self.assertEqual(len(pipeline), 0)
+            self.assertEqual((yield from pipeline.execute()), [])
+
+        self.run_with_manager(test)
+
+    def test_errors(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            pipeline = manager.pipeline()
+            with self.assertRaises(AttributeError):
+                pipeline.no_such_command
+            with self.assertRaises(Error):
+                pipeline.blpop
+
+            yield from manager.set('key', 'value')
+            pipeline.incr('key').get('key')
+            with self.assertRaises(ErrorReply):
+                yield from pipeline.execute()
+
+            pipeline.incr('key').get('key')
+            results = yield from pipeline.execute(raise_on_error=False)
+            self.assertIsInstance(results[0], ErrorReply)
+            self.assertEqual(results[1], 'value')
+
+            # the connections are usable again
+            self.assertEqual(manager.connections_in_use, 0)
+            self.assertEqual((yield from manager.get('key')), 'value')
+
+        self.run_with_manager(test)
+
+    def test_chunks(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            writes = self.count_writes(manager)
+            pipeline = manager.pipeline(max_commands=10)
+            for i in range(25):
+                pipeline.incr('counter')
+            self.assertEqual((yield from pipeline.execute()), list(range(1, 26)))
+            self.assertEqual(len(writes), 3)
+
+        self.run_with_manager(test)
+
+    def test_transaction(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            writes = self.count_writes(manager)
+            pipeline = manager.pipeline(transaction=True, max_commands=2)
+            pipeline.set('key', 'value').incr('counter').incr('counter').get('key')
+            results = yield from pipeline.execute()
+            self.assertEqual(results, [StatusReply('OK'), 1, 2, 'value'])
+            # MULTI, commands and EXEC in one write, never split
+            self.assertEqual(len(writes), 1)
+            self.assertEqual(manager.connections_in_use, 0)
+
+            # commands run inside the transaction can still fail on their own
+            pipeline.incr('key').get('key')
+            results = yield from pipeline.execute(raise_on_error=False)
+            self.assertIsInstance(results[0], ErrorReply)
+            self.assertEqual(results[1], 'value')
+
+            # plain transactions keep the behaviour of asyncio_redis
+            transaction = yield from manager.multi()
+            f = yield from transaction.incr('counter')
+            self.assertIsNone((yield from transaction.exec()))
+            self.assertEqual((yield from f), 3)
+
+        self.run_with_manager(test)
+
+    def test_private_api(self):
+        # pipeline._exec is a copy of RedisProtocol._exec, using the same internals
+        source = inspect.getsource(RedisProtocol._exec)
+        for name in ('_transaction', '_transaction_response_queue', '_pipelined_calls', '_transaction_lock',
+                     '_query'):
+            self.assertIn('self.%s' % name, source)
+            self.assertIn('protocol.%s' % name, inspect.getsource(ha_pipeline._exec))
+
+    def test_not_connected(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            pipeline = manager.pipeline()
+            pipeline.set('key', 'value')
+            yield from cluster.failover()
+            yield from asyncio.sleep(.05, loop=self.loop)
+            # the master is rediscovered like for any other command
+            self.assertEqual((yield from pipeline.execute()), [StatusReply('OK')])
+            self.assertEqual(cluster.master.data[b'key'], b'value')
+
+        self.run_with_manager(test)
+
+    def test_admission(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            pipeline = manager.pipeline()
+            for i in range(4):
+                pipeline.set('key:%s' % i, 'value')
+            first = ensure_future(pipeline.execute(), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(admission.in_flight, 4)
+            self.assertEqual(admission.bytes_in_flight, 4 * len('key:0value'))
+
+            # counted with the pipeline
+            single = ensure_future(manager.set('key', 'value'), loop=self.loop)
+            transaction = manager.pipeline(transaction=True)
+            transaction.incr('counter').incr('counter')
+            second = ensure_future(transaction.execute(), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(admission.in_flight, 5)
+            self.assertEqual(admission.waiting, 1)
+
+            cluster.master.resume()
+            yield from asyncio.gather(first, single, loop=self.loop)
+            self.assertEqual((yield from second), [1, 2])
+            self.assertEqual(admission.in_flight, 0)
+            self.assertEqual(admission.admitted, 7)
+
+            # larger than max_in_flight: admitted alone
+            pipeline = manager.pipeline()
+            for i in range(10):
+                pipeline.incr('other')
+            self.assertEqual((yield from pipeline.execute())[-1], 10)
+
+        self.run_with_manager(test, admission=AdmissionController(max_in_flight=5, loop=self.loop))
+
+
+class BlockingPoolTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop, **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_blocking_pool(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            self.assertEqual(manager.blocking_connections_connected, 2)
+            pops = [ensure_future(manager.blpop(['queue']), loop=self.loop) for i in range(2)]
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(manager.blocking_connections_in_use, 2)
+
+            # the pool stays available for everything else
+            self.assertEqual(manager.connections_in_use, 0)
+            yield from manager.set('key', 'value')
+
+            # the blocking sub-pool is bounded
+            with self.assertRaises(NoAvailableConnectionsInPoolError):
+                yield from manager.brpop(['queue'])
+
+            yield from manager.rpush('queue', ['a', 'b'])
+            replies = yield from gather(*pops, loop=self.loop)
+            self.assertEqual(sorted(r.value for r in replies), ['a', 'b'])
+            self.assertEqual(manager.blocking_connections_in_use, 0)
+
+        self.run_with_manager(test, poolsize=1, blocking_poolsize=2)
+
+    def test_shared_pool(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            self.assertEqual(manager.blocking_connections_connected, 0)
+            pop = ensure_future(manager.blpop(['queue']), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(manager.connections_in_use, 1)
+            yield from manager.rpush('queue', ['a'])
+            self.assertEqual((yield from pop).value, 'a')
+
+        self.run_with_manager(test, poolsize=2)
+
+    def test_rebuilt_on_failover(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            pop = ensure_future(manager.blpop(['queue']), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            yield from cluster.failover()
+            with self.assertRaises(ConnectionLostError):
+                yield from pop
+
+            # a blocking command rediscovers both pools
+            pop = ensure_future(manager.blpop(['queue'], timeout=1), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(manager.connections_connected, 2)
+            self.assertEqual(manager.blocking_connections_connected, 2)
+            self.assertEqual(len(cluster.master.clients), 4)
+            yield from manager.rpush('queue', ['a'])
+            self.assertEqual((yield from pop).value, 'a')
+
+        self.run_with_manager(test, poolsize=2, blocking_poolsize=2)
+
+
+class PubSubManagerTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_pubsub(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, poolsize=2, loop=self.loop,
+                **kwargs)
+            pubsub = yield from manager.pubsub()
+            pubsub.retry_interval = .05
+            try:
+                yield from test(cluster, manager, pubsub)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def subscribers(self, node):
+        return [c for c in node.clients if c.subscribed or c.psubscribed]
+
+    def test_shared_subscription(self):
+        @asyncio.coroutine
+        def test(cluster, manager, pubsub):
+            self.assertIs((yield from manager.pubsub()), pubsub)
+            consumers = [pubsub.consumer() for i in range(5)]
+            for consumer in consumers:
+                yield from consumer.subscribe(['channel'])
+            yield from consumers[0].psubscribe(['chan*'])
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            # one connection, subscribed once
+            self.assertEqual(len(self.subscribers(cluster.master)), 1)
+            self.assertEqual(pubsub.channels, {'channel'})
+            self.assertEqual((yield from manager.publish('channel', 'message')), 2)
+
+            for consumer in consumers:
+                message = yield from consumer.next_published()
+                self.assertEqual((message.channel, message.value), ('channel', 'message'))
+            message = yield from consumers[0].next_published()
+            self.assertEqual(message.pattern, 'chan*')
+
+            for consumer in consumers[1:]:
+                yield from consumer.close()
+            self.assertEqual(pubsub.channels, {'channel'})
+            yield from consumers[0].unsubscribe(['channel'])
+            self.assertEqual(pubsub.channels, set())
+            with self.assertRaises(ConsumerClosedError):
+                yield from consumers[1].next_published()
+
+        self.run_with_pubsub(test)
+
+    def test_bytes_encoder(self):
+        @asyncio.coroutine
+        def test(cluster, manager, pubsub):
+            consumer = pubsub.consumer()
+            other = pubsub.consumer()
+            yield from consumer.subscribe([b'channel'])
+            yield from other.subscribe(['channel'])
+            yield from consumer.psubscribe(['chan*'])
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(pubsub.channels, {'channel'})
+            self.assertEqual(self.subscribers(cluster.master)[0].subscribed, {b'channel'})
+
+            self.assertEqual((yield from manager.publish('channel', 'message')), 2)
+            message = yield from consumer.next_published()
+            self.assertEqual((message.channel, message.value), (b'channel', b'message'))
+            message = yield from other.next_published()
+            self.assertEqual(message.channel, b'channel')
+            message = yield from consumer.next_published()
+            self.assertEqual(message.pattern, b'chan*')
+
+            yield from consumer.unsubscribe([b'channel'])
+            self.assertEqual(pubsub.channels, {'channel'})
+            yield from other.unsubscribe(['channel'])
+            self.assertEqual(pubsub.channels, set())
+
+        self.run_with_pubsub(test, encoder=BytesEncoder())
+
+    def test_overflow(self):
+        @asyncio.coroutine
+        def test(cluster, manager, pubsub):
+            newest = pubsub.consumer(maxsize=2, overflow=OverflowPolicy.DROP_NEWEST)
+            oldest = pubsub.consumer(maxsize=2, overflow=OverflowPolicy.DROP_OLDEST)
+            disconnect = pubsub.consumer(maxsize=2, overflow=OverflowPolicy.DISCONNECT)
+            for consumer in (newest, oldest, disconnect):
+                yield from consumer.subscribe(['channel'])
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            for i in range(4):
+                yield from manager.publish('channel', str(i))
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            @asyncio.coroutine
+            def values(consumer):
+                result = []
+                while consumer.queued:
+                    result.append((yield from consumer.next_published()).value)
+                return result
+
+            self.assertEqual((yield from values(newest)), ['0', '1'])
+            self.assertEqual((yield from values(oldest)), ['2', '3'])
+            self.assertEqual((newest.dropped, oldest.dropped), (2, 2))
+
+            # the queued messages are still delivered
+            self.assertTrue(disconnect.closed)
+            self.assertEqual((yield from values(disconnect)), ['0', '1'])
+            with self.assertRaises(ConsumerClosedError):
+                yield from disconnect.next_published()
+
+        self.run_with_pubsub(test)
+
+    def test_resubscribe_after_failover(self):
+        @asyncio.coroutine
+        def test(cluster, manager, pubsub):
+            consumer = pubsub.consumer()
+            yield from consumer.subscribe(['channel'])
+            yield from consumer.psubscribe(['other*'])
+
+            yield from cluster.failover()
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertFalse(pubsub.is_active)
+            self.assertEqual(consumer.interruptions, 1)
+
+            # rediscovery (here triggered by a command) moves the subscriptions
+            yield from manager.set('key', 'value')
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertTrue(pubsub.is_active)
+            subscriber, = self.subscribers(cluster.master)
+            self.assertEqual(subscriber.subscribed, {b'channel'})
+            self.assertEqual(subscriber.psubscribed, {b'other*'})
+
+            yield from manager.publish('channel', 'after')
+            self.assertEqual((yield from consumer.next_published()).value, 'after')
+
+        self.run_with_pubsub(test)
+
+
+class NearCacheTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_cache(self, test, replicas=1, read_from_replicas=False, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(replicas=replicas, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, poolsize=2,
+                read_from_replicas=read_from_replicas, loop=self.loop)
+            cache = yield from NearCache.create(manager, configure_server=True, **kwargs)
+            try:
+                yield from test(cluster, manager, cache)
+            finally:
+                cache.close()
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_hits(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            self.assertTrue(cache.is_active)
+            yield from cache.set('key', 'value')
+            yield from cache.hset('hash', 'field', 'value')
+            # let the notifications of the writes arrive
+            yield from asyncio.sleep(.05, loop=self.loop)
+            executed = cluster.master.commands_executed
+            for i in range(10):
+                self.assertEqual((yield from cache.get('key')), 'value')
+            self.assertEqual(cluster.master.commands_executed, executed + 1)
+            self.assertEqual((cache.hits, cache.misses), (9, 1))
+
+            self.assertEqual((yield from cache.hget('hash', 'field')), 'value')
+            self.assertEqual((yield from cache.hgetall_asdict('hash')), {'field': 'value'})
+            self.assertEqual((yield from cache.hgetall_asdict('hash')), {'field': 'value'})
+            self.assertEqual(len(cache), 3)
+
+            # own writes are visible immediately
+            yield from cache.set('key', 'other')
+            self.assertEqual((yield from cache.get('key')), 'other')
+
+        self.run_with_cache(test)
+
+    def test_invalidation(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            yield from manager.set('key', 'value')
+            self.assertEqual((yield from cache.get('key')), 'value')
+
+            # a write through another client is announced by keyspace notifications
+            yield from manager.set('key', 'other')
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual((yield from cache.get('key')), 'other')
+            yield from manager.delete(['key'])
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertIsNone((yield from cache.get('key')))
+
+        self.run_with_cache(test)
+
+    def test_bounds(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            for key in 'abc':
+                yield from manager.set(key, key)
+            yield from manager.set('big', 'x' * 2000)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            for key in 'abc':
+                yield from cache.get(key)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.evictions, 1)
+
+            # 'a' was evicted, 'c' is the most recently used
+            executed = cluster.master.commands_executed
+            yield from cache.get('c')
+            self.assertEqual(cluster.master.commands_executed, executed)
+            yield from cache.get('a')
+            self.assertEqual(cluster.master.commands_executed, executed + 1)
+
+            yield from cache.get('big')
+            self.assertNotIn('big', cache._by_key)
+            self.assertLessEqual(cache.bytes, cache.max_bytes)
+
+        self.run_with_cache(test, max_entries=2, max_bytes=1000)
+
+    def test_invalidation_connection_lost(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            yield from manager.set('key', 'value')
+            yield from cache.get('key')
+
+            for client in list(cluster.master.clients):
+                if client.psubscribed:
+                    client.transport.abort()
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(len(cache), 0)
+
+            # resubscribed and caching again
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertTrue(cache.is_active)
+            yield from cache.get('key')
+            self.assertEqual(len(cache), 1)
+
+        self.run_with_cache(test, retry_interval=.05)
+
+    def test_failover(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            yield from manager.set('key', 'value')
+            yield from cache.get('key')
+            old = cluster.master
+
+            yield from cluster.failover()
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(len(cache), 0)
+            self.assertFalse(cache.is_active)
+
+            yield from manager.set('key', 'other')
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertTrue(cache.is_active)
+            self.assertIsNot(cluster.master, old)
+            self.assertTrue(any(c.psubscribed for c in cluster.master.clients))
+            self.assertEqual((yield from cache.get('key')), 'other')
+
+        self.run_with_cache(test, retry_interval=.05)
+
+    def test_replica_reads(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            replica = cluster.nodes[1]
+            yield from manager.set('key', 'old')
+            yield from asyncio.sleep(.05, loop=self.loop)
+            replica.pause_replication()
+            yield from manager.set('key', 'new')
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            # the replica still has the old value, the cache is populated from the master
+            executed = replica.commands_executed
+            self.assertEqual((yield from cache.get('key')), 'new')
+            self.assertEqual((yield from cache.get('key')), 'new')
+            self.assertEqual(replica.commands_executed, executed)
+            replica.resume_replication()
+
+        self.run_with_cache(test, read_from_replicas=True)
+
+    def test_copies(self):
+        @asyncio.coroutine
+        def test(cluster, manager, cache):
+            yield from cache.hset('hash', 'field', 'value')
+            yield from asyncio.sleep(.05, loop=self.loop)
+            (yield from cache.hgetall_asdict('hash'))['field'] = 'changed'
+            (yield from cache.hgetall_asdict('hash'))['other'] = 'added'
+            self.assertEqual((yield from cache.hgetall_asdict('hash')), {'field': 'value'})
+            self.assertEqual(cache.hits, 2)
+
+        self.run_with_cache(test)
+
+    def test_subscribe_timeout(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop)
+            published = []
+
+            @asyncio.coroutine
+            def publish(channel, message):
+                # the subscription is never counted as a receiver
+                published.append(self.loop.time())
+                return 0
+
+            manager.publish = publish
+            try:
+                with self.assertRaises(ConnectionError):
+                    yield from NearCache.create(manager, subscribe_timeout=.3, retry_interval=.1)
+                # backing off, bounded by the timeout
+                self.assertLess(len(published), 10)
+                self.assertGreater(published[-1] - published[-2], .05)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class SentinelGroupTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_shared_sentinels(self):
+        @asyncio.coroutine
+        def test():
+            users = FakeCluster(name='users', loop=self.loop)
+            sessions = FakeCluster(name='sessions', sentinels=users.sentinels, loop=self.loop)
+            yield from users.start()
+            yield from sessions.start()
+
+            group = yield from SentinelGroup.create(users.sentinel_addresses, watch_events=False, loop=self.loop)
+            self.assertEqual(group.sentinels_connected, 3)
+            accepted = sum(len(s.accepted) for s in users.sentinels)
+
+            users_manager = yield from group.manager('users', poolsize=2)
+            sessions_manager = yield from group.manager('sessions', poolsize=2)
+            self.assertEqual(users_manager.master_address, users.master.address)
+            self.assertEqual(sessions_manager.master_address, sessions.master.address)
+            # no sentinel connections of their own
+            self.assertEqual(sum(len(s.accepted) for s in users.sentinels), accepted)
+            self.assertIs(users_manager.group, group)
+
+            yield from users_manager.set('key', 'users')
+            yield from sessions_manager.set('key', 'sessions')
+            self.assertEqual(users.master.data[b'key'], b'users')
+            self.assertEqual(sessions.master.data[b'key'], b'sessions')
+
+            # closing a manager leaves the group to the others
+            users_manager.close()
+            self.assertEqual(group.sentinels_connected, 3)
+            self.assertEqual((yield from sessions_manager.get('key')), 'sessions')
+
+            sessions_manager.close()
+            group.close()
+            yield from users.stop()
+            yield from sessions.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_concurrent_lookups(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            group = yield from SentinelGroup.create(cluster.sentinel_addresses, watch_events=False, loop=self.loop)
+            executed = sum(s.commands_executed for s in cluster.sentinels)
+
+            addresses = yield from gather(*[group.master_address('mymaster') for i in range(10)], loop=self.loop)
+            self.assertEqual(addresses, [[cluster.master.host, str(cluster.master.port)]] * 10)
+            self.assertEqual(sum(s.commands_executed for s in cluster.sentinels), executed + 1)
+
+            group.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_switch_master(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=1, loop=self.loop)
+            yield from cluster.start()
+            group = yield from SentinelGroup.create(cluster.sentinel_addresses, retry_interval=.05, loop=self.loop)
+            manager = yield from group.manager('mymaster', poolsize=2)
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            switches = []
+            group.add_switch_listener('mymaster', lambda name, address: switches.append(address))
+
+            # the pool moves before any command fails
+            yield from cluster.failover()
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertEqual(switches, [cluster.master.address])
+            self.assertEqual(manager.master_address, cluster.master.address)
+            self.assertEqual(manager.connections_connected, 2)
+
+            # the events connection moves to another sentinel
+            events_sentinel = next(s for s in cluster.sentinels if any(c.subscribed for c in s.clients))
+            yield from events_sentinel.kill()
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertTrue(any(c.subscribed for s in cluster.sentinels for c in s.clients))
+
+            manager.close()
+            group.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class SharedTopologyTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'topology')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_versioned_updates(self):
+        # (two instances on one file behave like two processes)
+        writer, reader = SharedTopology(self.path, size=4096), SharedTopology(self.path, size=4096)
+        self.assertEqual(reader.read(), (0, {}))
+        self.assertIsNone(reader.master('mymaster'))
+
+        self.assertTrue(writer.acquire_publisher())
+        self.assertFalse(reader.acquire_publisher())
+
+        replica = ReplicaInfo(name='r', ip='127.0.0.1', port=6380, flags=NodeFlags.SLAVE, slave_repl_offset=10)
+        self.assertEqual(writer.update('mymaster', master=('127.0.0.1', '6379')), 2)
+        self.assertEqual(writer.update('mymaster', replicas=[replica]), 4)
+        self.assertEqual(reader.version, 4)
+        self.assertEqual(reader.master('mymaster'), ('127.0.0.1', 6379))
+        self.assertEqual(reader.replicas('mymaster'), [replica])
+
+        # a write interrupted by the death of the publisher
+        _HEADER.pack_into(writer._map, 0, _MAGIC, 5, 0)
+        with self.assertRaises(TopologyBusyError):
+            reader.read(retries=3)
+        self.assertEqual(writer.update('mymaster', master=('127.0.0.1', 6381)), 8)
+        self.assertEqual(reader.master('mymaster'), ('127.0.0.1', 6381))
+
+        with self.assertRaises(ValueError):
+            writer.update('big', master=('x' * 5000, 1))
+
+        writer.close()
+        self.assertTrue(reader.acquire_publisher())
+        reader.close()
+
+    def test_follower(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+
+            publisher = yield from SentinelGroup.create(
+                cluster.sentinel_addresses, topology=SharedTopology(self.path), poll_interval=.02, loop=self.loop)
+            manager = yield from publisher.manager('mymaster', read_from_replicas=True)
+            self.assertTrue(publisher.is_publisher)
+            accepted = sum(len(s.accepted) for s in cluster.sentinels)
+
+            follower = yield from SentinelGroup.create(
+                cluster.sentinel_addresses, topology=SharedTopology(self.path), poll_interval=.02, loop=self.loop)
+            follower_manager = yield from follower.manager('mymaster', read_from_replicas=True)
+            self.assertFalse(follower.is_publisher)
+            self.assertEqual(follower.sentinels_connected, 0)
+            self.assertEqual(sum(len(s.accepted) for s in cluster.sentinels), accepted)
+            self.assertEqual(follower_manager.master_address, cluster.master.address)
+            self.assertEqual(follower_manager.replicas_connected, 2)
+            yield from follower_manager.set('key', 'value')
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            # the failover announced to the publisher reaches the follower through the file
+            yield from cluster.failover()
+            yield from asyncio.sleep(.2, loop=self.loop)
+            self.assertEqual(manager.master_address, cluster.master.address)
+            self.assertEqual(follower_manager.master_address, cluster.master.address)
+            self.assertEqual(follower.sentinels_connected, 0)
+            # so do the replicas found by the publisher after the failover
+            replicas = sorted((c.host, c.port) for c in manager._replicas)
+            self.assertTrue(replicas)
+            self.assertEqual(sorted((c.host, c.port) for c in follower_manager._replicas), replicas)
+
+            # and replicas published later
+            changed = []
+            follower.add_replicas_listener('mymaster', lambda name: changed.append(name))
+            publisher.topology.update('mymaster', replicas=[])
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertEqual(changed, ['mymaster'])
+            self.assertEqual(follower_manager.replicas_connected, 0)
+
+            # the follower takes over when the publisher is gone
+            manager.close()
+            publisher.close()
+            publisher.topology.close()
+            yield from asyncio.sleep(.1, loop=self.loop)
+            self.assertTrue(follower.is_publisher)
+            self.assertEqual((yield from follower_manager.get('key')), 'value')
+
+            follower_manager.close()
+            follower.close()
+            follower.topology.close()
+            yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class OffloadTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run(protocol_class):
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop,
+                protocol_class=protocol_class, **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        for protocol_class in (ExtendedProtocol, HiRedisExtendedProtocol):
+            self.loop.run_until_complete(run(protocol_class))
+
+    def test_large_replies(self):
+        executor = ThreadPoolExecutor(1)
+
+        @asyncio.coroutine
+        def test(cluster, manager):
+            cluster.master.data[b'big'] = {('%s' % i).encode(): b'x' * 100 for i in range(1000)}
+            cluster.master.data[b'small'] = {b'a': b'b'}
+
+            self.assertEqual((yield from manager.hgetall_asdict('small')), {'a': 'b'})
+            self.assertEqual(manager.stats.offloaded_replies, 0)
+
+            result = yield from manager.hgetall_asdict('big')
+            self.assertEqual(len(result), 1000)
+            self.assertEqual(result['999'], 'x' * 100)
+            self.assertEqual(manager.stats.offloaded_replies, 1)
+            self.assertGreater(manager.stats.offloaded_bytes, 100000)
+            self.assertGreater(manager.stats.offload_time, 0)
+
+            # reading the items one by one stays in the loop
+            reply = yield from manager.hgetall('big')
+            for f in reply:
+                yield from f
+            self.assertEqual(manager.stats.offloaded_replies, 1)
+            self.assertEqual(manager.stats.asdict()['offloaded_replies'], 1)
+
+        self.run_with_manager(test, offload_threshold=10000, executor=executor)
+        executor.shutdown()
+
+    def test_disabled(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            cluster.master.data[b'big'] = {('%s' % i).encode(): b'x' * 100 for i in range(1000)}
+            self.assertEqual(len((yield from manager.hgetall_asdict('big'))), 1000)
+            self.assertEqual(manager.stats.offloaded_replies, 0)
+
+        self.run_with_manager(test)
+
+
+class ScanIteratorTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, replicas=0, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(replicas=replicas, loop=self.loop)
+            yield from cluster.start()
+            for node in cluster.nodes:
+                for i in range(250):
+                    node.data[('key:%s' % i).encode()] = b'value'
+                node.data[b'other'] = b'value'
+                node.data[b'hash'] = {('field:%s' % i).encode(): b'value' for i in range(50)}
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop, **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_scan(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            keys = manager.scan_iter(match='key:*', count=20)
+            first = yield from keys.fetchone()
+            self.assertTrue(first.startswith('key:'))
+            # the second page is on its way
+            yield from asyncio.sleep(.01, loop=self.loop)
+            self.assertEqual(keys.pages, 2)
+
+            result = [first]
+            while True:
+                key = yield from keys.fetchone()
+                if key is None:
+                    break
+                result.append(key)
+            self.assertEqual(sorted(result), sorted('key:%s' % i for i in range(250)))
+            self.assertEqual(keys.pages, 13)
+            self.assertTrue(keys.done)
+            self.assertIsNone((yield from keys.fetchpage()))
+
+            # (async iteration protocol)
+            keys = manager.scan_iter(match='other', prefetch=False)
+            self.assertEqual((yield from keys.__anext__()), 'other')
+            with self.assertRaises(StopAsyncIteration):
+                yield from keys.__anext__()
+
+        self.run_with_manager(test)
+
+    def test_hscan(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            fields = yield from manager.hscan_iter('hash', count=7).fetchall()
+            self.assertEqual(sorted(fields), sorted(('field:%s' % i, 'value') for i in range(50)))
+
+            with self.assertRaises(ValueError):
+                manager.hscan_iter(None)
+
+        self.run_with_manager(test)
+
+    def test_failover(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            keys = manager.scan_iter(match='key:*', count=20)
+            keys.retry_interval = .05
+            result = []
+            for i in range(50):
+                result.append((yield from keys.fetchone()))
+
+            yield from cluster.failover()
+            result.extend((yield from keys.fetchall()))
+
+            # (the order differs between nodes, resuming the old cursor would lose keys)
+            self.assertEqual(keys.restarts, 1)
+            self.assertEqual(set(result), set('key:%s' % i for i in range(250)))
+            self.assertGreater(len(result), 250)
+
+        self.run_with_manager(test, replicas=1)
+
+
+class BulkLoaderTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop, **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_bulk_set(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            items = [('key:%s' % i, 'value:%s' % i) for i in range(2000)]
+            items += [('ttl:%s' % i, 'value', 60) for i in range(50)]
+            items.append(('bad-ttl', 'value', 0))
+
+            loader = yield from manager.bulk_set(items, chunk_size=100)
+            self.assertEqual(loader.queued, 2051)
+            self.assertEqual(loader.written, 2050)
+            self.assertEqual(loader.batches, 21)
+            self.assertEqual([key for key, e in loader.failed], ['bad-ttl'])
+            self.assertIsInstance(loader.failed[0][1], ErrorReply)
+            self.assertGreater(loader.rate, 0)
+
+            self.assertEqual(cluster.master.data[b'key:1999'], b'value:1999')
+            self.assertEqual(cluster.master.data[b'ttl:49'], b'value')
+            self.assertNotIn(b'bad-ttl', cluster.master.data)
+
+        self.run_with_manager(test, poolsize=4)
+
+    def test_batch_errors(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            pipeline = manager.pipeline
+            attempts = []
+
+            def failing_pipeline(**kwargs):
+                p = pipeline(**kwargs)
+                execute = p.execute
+
+                @asyncio.coroutine
+                def failing_execute(**kwargs):
+                    attempts.append(1)
+                    if len(attempts) == 2:
+                        raise OverloadedError('Overloaded')
+                    return (yield from execute(**kwargs))
+
+                p.execute = failing_execute
+                return p
+
+            manager.pipeline = failing_pipeline
+            items = [('key:%s' % i, 'value') for i in range(30)] + [('ttl', 'value', 60)]
+            loader = yield from manager.bulk_set(items, chunk_size=10, max_in_flight=1)
+            # the second batch is reported item by item, not retried
+            self.assertEqual(len(attempts), 4)
+            self.assertEqual(loader.written, 21)
+            self.assertEqual([key for key, e in loader.failed], ['key:%s' % i for i in range(10, 20)])
+            self.assertTrue(all(isinstance(e, OverloadedError) for key, e in loader.failed))
+            self.assertEqual(loader.batches, 4)
+
+        self.run_with_manager(test)
+
+    def test_backpressure(self):
+        class Source:
+            """ Async iterable, counting the items read. """
+            def __init__(self):
+                self.read = 0
+
+            def __aiter__(self):
+                return self
+
+            @asyncio.coroutine
+            def __anext__(self):
+                if self.read == 1000:
+                    raise StopAsyncIteration
+                self.read += 1
+                return 'key:%s' % self.read, 'value'
+
+        @asyncio.coroutine
+        def test(cluster, manager):
+            source = Source()
+            loader = manager.bulk_loader(chunk_size=10, max_in_flight=2)
+            cluster.master.stall()
+            f = ensure_future(loader.load(source), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            # two batches in flight, and one waiting for them
+            self.assertEqual(loader.in_flight, 2)
+            self.assertEqual(source.read, 30)
+
+            cluster.master.resume()
+            yield from f
+            self.assertEqual(loader.written, 1000)
+            self.assertEqual(len(cluster.master.data), 1000)
+
+        self.run_with_manager(test, poolsize=2)
+
+    def test_bulk_get(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            for i in range(0, 2500, 2):
+                cluster.master.data[('key:%s' % i).encode()] = ('value:%s' % i).encode()
+            keys = ['key:%s' % i for i in range(2500)]
+
+            values = yield from manager.bulk_get(keys, chunk_size=100)
+            self.assertEqual(values, [('value:%s' % i) if i % 2 == 0 else None for i in range(2500)])
+            self.assertEqual((yield from manager.bulk_get([])), [])
+
+        self.run_with_manager(test, poolsize=4)
+
+    def test_bulk_reader(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            for i in range(100):
+                cluster.master.data[('key:%s' % i).encode()] = b'value'
+            reader = manager.bulk_reader(['key:%s' % i for i in range(100)], chunk_size=10, max_in_flight=3)
+
+            cluster.master.stall()
+            f = ensure_future(reader.fetchone(), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            # the first chunk and the next two requested at once
+            self.assertEqual(len(reader._pending), 3)
+            cluster.master.resume()
+            self.assertEqual((yield from f), ('key:0', 'value'))
+
+            chunk = yield from reader.fetchchunk()
+            self.assertEqual(chunk, [('key:%s' % i, 'value') for i in range(1, 10)])
+            chunk = yield from reader.fetchchunk()
+            self.assertEqual(chunk, [('key:%s' % i, 'value') for i in range(10, 20)])
+            rest = yield from reader.fetchall()
+            self.assertEqual(len(rest), 80)
+            self.assertIsNone((yield from reader.fetchone()))
+            self.assertEqual(reader.chunks, 10)
+
+        self.run_with_manager(test, poolsize=3)
+
+
+
+class AdmissionTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop, **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_request_size(self):
+        self.assertEqual(request_size(('key', b'value')), 8)
+        self.assertEqual(request_size((['a', 'bb'], {'c': 'ddd'}), {'expire': 10}), 15)
+
+    def test_wait(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            tasks = [ensure_future(manager.set('key:%s' % i, 'value'), loop=self.loop) for i in range(10)]
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(admission.in_flight, 3)
+            self.assertEqual(admission.waiting, 7)
+
+            cluster.master.resume()
+            yield from asyncio.gather(*tasks, loop=self.loop)
+            self.assertEqual(admission.in_flight, 0)
+            self.assertEqual(admission.admitted, 10)
+            self.assertEqual(len(cluster.master.data), 10)
+
+        self.run_with_manager(test, admission=AdmissionController(max_in_flight=3, loop=self.loop))
+
+    def test_fail_fast(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            tasks = [ensure_future(manager.set('key:%s' % i, 'value'), loop=self.loop) for i in range(2)]
+            yield from asyncio.sleep(.05, loop=self.loop)
+            with self.assertRaises(OverloadedError):
+                yield from manager.get('key:0')
+            self.assertEqual(admission.rejected, 1)
+
+            cluster.master.resume()
+            yield from asyncio.gather(*tasks, loop=self.loop)
+            self.assertEqual((yield from manager.get('key:0')), 'value')
+
+        self.run_with_manager(test, admission=AdmissionController(
+            max_in_flight=2, policy=AdmissionPolicy.FAIL_FAST, loop=self.loop))
+
+    def test_shed_lowest_priority(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            running = ensure_future(manager.set('running', 'value'), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+
+            low = ensure_future(manager.with_options(priority=-1).set('low', 'value'), loop=self.loop)
+            normal = ensure_future(manager.set('normal', 'value'), loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            # the queue is full, the lowest priority goes
+            high = ensure_future(manager.with_options(priority=1).set('high', 'value'), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertTrue(low.done())
+            self.assertIsInstance(low.exception(), OverloadedError)
+            # a newcomer with the lowest priority is refused
+            with self.assertRaises(OverloadedError):
+                yield from manager.set('normal2', 'value')
+            self.assertEqual(admission.shed, 2)
+
+            cluster.master.resume()
+            yield from asyncio.gather(running, normal, high, loop=self.loop)
+            self.assertEqual(sorted(cluster.master.data), [b'high', b'normal', b'running'])
+
+        self.run_with_manager(test, admission=AdmissionController(
+            max_in_flight=1, max_waiting=2, policy=AdmissionPolicy.SHED, loop=self.loop))
+
+    def test_max_bytes(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            first = ensure_future(manager.set('a', 'x' * 60), loop=self.loop)
+            second = ensure_future(manager.set('b', 'x' * 60), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual((admission.in_flight, admission.bytes_in_flight, admission.waiting), (1, 61, 1))
+
+            cluster.master.resume()
+            yield from asyncio.gather(first, second, loop=self.loop)
+            self.assertEqual(admission.bytes_in_flight, 0)
+
+        self.run_with_manager(test, admission=AdmissionController(max_bytes=100, loop=self.loop))
+
+    def test_per_connection_limit(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            cluster.master.stall()
+            tasks = [ensure_future(manager.set('key:%s' % i, 'value'), loop=self.loop) for i in range(5)]
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(sorted(manager._in_flight.values()), [2, 2])
+
+            cluster.master.resume()
+            yield from asyncio.gather(*tasks, loop=self.loop)
+            self.assertEqual(len(cluster.master.data), 5)
+            self.assertFalse(manager._in_flight)
+
+        self.run_with_manager(test, poolsize=2, admission=AdmissionController(
+            max_in_flight_per_connection=2, loop=self.loop))
+
+    def test_per_connection_fail_fast(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            # pipelined commands count on their connection too
+            pipeline = manager.pipeline()
+            pipeline.set('a', 'value').set('b', 'value')
+            task = ensure_future(pipeline.execute(), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(list(manager._in_flight.values()), [2])
+
+            with self.assertRaises(OverloadedError):
+                yield from manager.get('a')
+            self.assertEqual(admission.rejected, 1)
+
+            cluster.master.resume()
+            yield from task
+            self.assertFalse(manager._in_flight)
+
+        self.run_with_manager(test, admission=AdmissionController(
+            max_in_flight_per_connection=2, policy=AdmissionPolicy.FAIL_FAST, loop=self.loop))
+
+    def test_cancelled_waiter(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            admission = manager.config.admission
+            cluster.master.stall()
+            running = ensure_future(manager.set('a', 'value'), loop=self.loop)
+            waiting = ensure_future(manager.set('b', 'value'), loop=self.loop)
+            yield from asyncio.sleep(.05, loop=self.loop)
+            waiting.cancel()
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(admission.waiting, 0)
+
+            cluster.master.resume()
+            yield from running
+            self.assertEqual(admission.in_flight, 0)
+
+        self.run_with_manager(test, admission=AdmissionController(max_in_flight=1, loop=self.loop))
+
+
+
+class DeadlineTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_with_manager(self, test, **kwargs):
+        @asyncio.coroutine
+        def run():
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop, **kwargs)
+            try:
+                yield from test(cluster, manager)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(run())
+
+    def test_default_timeouts(self):
+        config = HighAvailabilityConfig('mymaster', [], command_timeouts={
+            CommandFlags.READONLY: .5, CommandFlags.WRITE: 2, 'hgetall': 5})
+        manager = ConnectionManager(config, loop=self.loop)
+        self.assertEqual(manager._default_timeout('get'), .5)
+        self.assertEqual(manager._default_timeout('set'), 2)
+        self.assertEqual(manager._default_timeout('hgetall_asdict'), 5)
+        # blocking commands have timeouts of their own
+        self.assertIsNone(manager._default_timeout('blpop'))
+        config.command_timeouts[CommandFlags.BLOCKING] = 30
+        self.assertEqual(manager._default_timeout('blpop'), 30)
+        manager.close()
+
+    def test_timeout(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            yield from manager.set('key', 'old')
+            cluster.master.stall()
+            start = self.loop.time()
+            with self.assertRaises(CommandTimeoutError):
+                yield from manager.get('key')
+            self.assertLess(self.loop.time() - start, .5)
+            self.assertEqual(manager.stats.timeouts, 1)
+            self.assertEqual(manager.stats.suspect_connections, 1)
+
+            # the suspect connection is replaced
+            yield from asyncio.sleep(.05, loop=self.loop)
+            self.assertEqual(manager.connections_connected, 2)
+
+            # the late reply of the first get is not taken for this one
+            cluster.master.resume()
+            cluster.master.data[b'key'] = b'new'
+            self.assertEqual((yield from manager.get('key')), 'new')
+
+        self.run_with_manager(test, poolsize=2, command_timeouts={CommandFlags.READONLY: .1})
+
+    def test_per_call_timeout(self):
+        @asyncio.coroutine
+        def test(cluster, manager):
+            cluster.master.stall()
+            with self.assertRaises(asyncio.TimeoutError):
+                yield from manager.with_options(timeout=.05).set('key', 'value')
+
+            # an expired deadline fails before anything is sent
+            with self.assertRaises(CommandTimeoutError):
+                yield from manager.with_options(deadline=self.loop.time() - 1).get('key')
+            self.assertEqual(manager.stats.timeouts, 2)
+            self.assertEqual(manager.stats.suspect_connections, 1)
+            cluster.master.resume()
+
+        self.run_with_manager(test)
+
+
+
+class HedgingTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_delay(self):
+        policy = HedgePolicy(percentile=90, initial_delay=.05, min_samples=10, window=100)
+        self.assertEqual(policy.delay, .05)
+        for i in range(100):
+            policy.record(i / 1000.)
+        self.assertAlmostEqual(policy.delay, .09)
+        # recomputed once a tenth of the window changed
+        for i in range(5):
+            policy.record(1.)
+        self.assertAlmostEqual(policy.delay, .09)
+        for i in range(5):
+            policy.record(1.)
+        self.assertEqual(policy.delay, 1.)
+
+    def test_budget(self):
+        policy = HedgePolicy(budget=.1, burst=2)
+        for i in range(9):
+            policy.start()
+        self.assertFalse(policy.allow())
+        policy.start()
+        self.assertTrue(policy.allow())
+        self.assertFalse(policy.allow())
+        for i in range(100):
+            policy.start()
+        # saved up hedges are capped
+        self.assertTrue(policy.allow())
+        self.assertTrue(policy.allow())
+        self.assertFalse(policy.allow())
+        self.assertEqual((policy.hedged, policy.over_budget), (3, 3))
+
+    def test_hedged_reads(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            hedging = HedgePolicy(initial_delay=.02, budget=1)
+            admission = AdmissionController(loop=self.loop)
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses,
+                read_from_replicas=True, hedging=hedging, admission=admission, loop=self.loop)
+            try:
+                yield from manager.set('key', 'value')
+                slow = cluster.nodes[1]
+                slow.stall()
+
+                start = self.loop.time()
+                for i in range(4):
+                    self.assertEqual((yield from manager.get('key')), 'value')
+                self.assertLess(self.loop.time() - start, .4)
+                self.assertEqual(hedging.reads, 4)
+                # the reads sent to the slow replica first were answered by another node
+                self.assertGreaterEqual(hedging.hedge_wins, 1)
+                self.assertEqual(hedging.hedge_wins, hedging.hedged)
+                # the losing attempts are cancelled, not left running outside the admission control
+                yield from asyncio.sleep(.01, loop=self.loop)
+                self.assertEqual(admission.in_flight, 0)
+                self.assertFalse(manager._in_flight)
+                self.assertEqual(manager.stats.suspect_connections, hedging.hedged)
+
+                slow.resume()
+                yield from asyncio.sleep(.01, loop=self.loop)
+                self.assertFalse(manager._in_flight)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+
+class ReplicationLagTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_lag(self):
+        lag = ReplicationLag(max_bytes=100, max_seconds=2)
+        a, b, c = ('10.0.0.1', 6379), ('10.0.0.2', 6379), ('10.0.0.3', 6379)
+        self.assertTrue(lag.is_lagging(a))
+
+        lag.update(10., 1000, {a: 1000, b: 1000})
+        lag.update(11., 1050, {a: 1050, b: 1000})
+        lag.update(12., 1080, {a: 1080, b: 1000})
+        self.assertEqual(lag.lag(a), (0, 0.))
+        self.assertEqual(lag.lag(b), (80, 2.))
+        self.assertFalse(lag.is_lagging(b))
+        # link down
+        self.assertTrue(lag.is_lagging(c))
+
+        lag.update(13., 1090, {a: 1090, b: 1000})
+        self.assertEqual(lag.lag(b), (90, 3.))
+        self.assertTrue(lag.is_lagging(b))
+        lag.update(13.5, 1200, {a: 1090, b: 1200})
+        self.assertEqual(lag.lag(a), (110, .5))
+        self.assertTrue(lag.is_lagging(a))
+        self.assertFalse(lag.is_lagging(b))
+
+        # the offsets of a new master
+        lag.update(14., 10, {a: 10})
+        self.assertEqual(lag.lag(a), (0, 0.))
+
+    def test_lag_before_history(self):
+        # right after the discovery, how long a replica is behind is unknown
+        lag = ReplicationLag(max_bytes=10000, max_seconds=2)
+        a = ('10.0.0.1', 6379)
+        lag.update(10., 5000, {a: 1000})
+        self.assertEqual(lag.lag(a), (4000, None))
+        self.assertTrue(lag.is_lagging(a))
+
+        lag.update(11., 5000, {a: 5000})
+        self.assertFalse(lag.is_lagging(a))
+        lag.update(12., 6000, {a: 5000})
+        self.assertEqual(lag.lag(a), (1000, 2.))
+        lag.update(13., 7000, {a: 4000})
+        self.assertEqual(lag.lag(a), (3000, None))
+        self.assertTrue(lag.is_lagging(a))
+
+        # without max_seconds, only the bytes count
+        lag.max_seconds = None
+        self.assertFalse(lag.is_lagging(a))
+
+    def test_watcher_survives_errors(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=1, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, read_from_replicas=True,
+                max_replica_lag=10, replica_check_interval=.02, loop=self.loop)
+            check = manager._check_replication
+            calls = []
+
+            @asyncio.coroutine
+            def failing_check():
+                calls.append(1)
+                if len(calls) == 1:
+                    raise IndexError('malformed ROLE reply')
+                yield from check()
+
+            manager._check_replication = failing_check
+            try:
+                yield from asyncio.sleep(.1, loop=self.loop)
+                self.assertGreater(len(calls), 1)
+                self.assertFalse(manager._replication_watcher.done())
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+    def test_lagging_replicas_excluded(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, read_from_replicas=True,
+                max_replica_lag=10, replica_check_interval=.02, loop=self.loop)
+            try:
+                master, fresh, stale = cluster.nodes
+                yield from manager.set('key', 'old')
+                stale.pause_replication()
+                yield from manager.set('key', 'new value')
+                yield from asyncio.sleep(.05, loop=self.loop)
+
+                self.assertTrue(manager.replication.is_lagging(stale.address))
+                self.assertFalse(manager.replication.is_lagging(fresh.address))
+                executed = stale.commands_executed
+                for i in range(6):
+                    self.assertEqual((yield from manager.get('key')), 'new value')
+                self.assertEqual(stale.commands_executed, executed)
+
+                stale.resume_replication()
+                yield from asyncio.sleep(.05, loop=self.loop)
+                self.assertFalse(manager.replication.is_lagging(stale.address))
+                for i in range(6):
+                    yield from manager.get('key')
+                self.assertGreater(stale.commands_executed, executed)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+
+class SessionTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_read_your_writes(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, read_from_replicas=True,
+                loop=self.loop)
+            try:
+                master, replicas = cluster.master, cluster.nodes[1:]
+                yield from manager.set('key', 'old')
+                session = manager.session()
+                # no write yet, reads are routed as usual
+                self.assertEqual((yield from session.get('key')), 'old')
+                self.assertEqual(session.master_reads, 0)
+
+                for replica in replicas:
+                    replica.pause_replication()
+                yield from session.set('key', 'new')
+                self.assertEqual(session.offset, master.repl_offset)
+                for i in range(4):
+                    self.assertEqual((yield from session.get('key')), 'new')
+                self.assertEqual(session.master_reads, 4)
+                # other clients may still read stale data
+                self.assertEqual((yield from manager.get('key')), 'old')
+
+                replicas[0].resume_replication()
+                for i in range(4):
+                    self.assertEqual((yield from session.get('key')), 'new')
+                self.assertEqual(session.replica_reads, 2)
+
+                replicas[1].resume_replication()
+                executed = master.commands_executed
+                for i in range(4):
+                    self.assertEqual((yield from session.get('key')), 'new')
+                self.assertEqual(master.commands_executed, executed)
+                self.assertEqual(session.replica_reads, 6)
+
+                # after a failover, reads go to the master until the next write
+                yield from cluster.failover()
+                yield from manager.discover()
+                yield from session.get('key')
+                self.assertEqual(session.master_reads, 7)
+                yield from session.set('key', 'newer')
+                self.assertEqual((yield from session.get('key')), 'newer')
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+
+class WaitPolicyTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_selects(self):
+        commands = ExtendedProtocol.commands
+        policy = WaitPolicy(keys=['order:*'])
+        self.assertTrue(policy.selects(commands['set'], ('order:1', 'value'), {}))
+        self.assertTrue(policy.selects(commands['delete'], (['other', 'order:1'],), {}))
+        self.assertTrue(policy.selects(commands['mset'], ({'order:1': 'value'},), {}))
+        self.assertFalse(policy.selects(commands['set'], ('other', 'value'), {}))
+        self.assertFalse(policy.selects(commands['get'], ('order:1',), {}))
+        self.assertFalse(policy.selects(commands['wait'], (1, 100), {}))
+
+        policy = WaitPolicy(commands=['hset'])
+        self.assertTrue(policy.selects(commands['hset'], ('hash', 'field', 'value'), {}))
+        self.assertFalse(policy.selects(commands['set'], ('key', 'value'), {}))
+
+        # WAIT blocks its connection, never forever
+        with self.assertRaises(ValueError):
+            WaitPolicy(timeout=0)
+
+    def test_wait(self):
+        @asyncio.coroutine
+        def test():
+            cluster = FakeCluster(replicas=2, loop=self.loop)
+            yield from cluster.start()
+            policy = WaitPolicy(numreplicas=2, keys=['order:*'])
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, write_policy=policy,
+                loop=self.loop)
+            try:
+                master = cluster.master
+                yield from manager.set('other', 'value')
+                self.assertEqual(master.wait_calls, 0)
+
+                # concurrent writes share a WAIT
+                yield from asyncio.gather(*[manager.set('order:%s' % i, 'value') for i in range(10)],
+                                          loop=self.loop)
+                self.assertEqual(policy.writes, 10)
+                self.assertEqual(master.wait_calls, policy.waits)
+                self.assertLess(policy.waits, 10)
+
+                cluster.nodes[2].pause_replication()
+                with self.assertRaises(NotReplicatedError) as cm:
+                    yield from manager.set('order:x', 'value')
+                self.assertEqual(cm.exception.replicas, 1)
+                self.assertEqual(policy.not_replicated, 1)
+                # executed by the master anyway
+                self.assertEqual(master.data[b'order:x'], b'value')
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class RecordingTransport(asyncio.Transport):
+    """ Transport keeping the chunks written to it. """
+
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append([data])
+
+    def writelines(self, data):
+        self.writes.append(list(data))
+
+    def close(self):
+        pass
+
+
+class ZeroCopyEncodingTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def make_protocol(self, **kwargs):
+        protocol = ExtendedProtocol(loop=self.loop, **kwargs)
+        protocol.zero_copy_threshold = 1024
+        transport = RecordingTransport()
+        protocol.connection_made(transport)
+        return protocol, transport
+
+    def test_encoding(self):
+        protocol, transport = self.make_protocol()
+        value = bytearray(b'x' * 2048)
+
+        chunks = protocol._encode_command([b'set', b'key', value])
+        self.assertEqual(len(chunks), 3)
+        self.assertIsInstance(chunks[1], memoryview)
+        self.assertEqual(b''.join(chunks), b'*3\r\n$3\r\nset\r\n$3\r\nkey\r\n$2048\r\n' + value + b'\r\n')
+
+        # small arguments are joined
+        self.assertEqual(protocol._encode_command([b'get', b'key']), [b'*2\r\n$3\r\nget\r\n$3\r\nkey\r\n'])
+
+        # the length of a memoryview is in bytes
+        array = protocol.encode_from_native(memoryview(bytearray(4096)).cast('I'))
+        chunks = protocol._encode_command([b'set', b'key', array])
+        self.assertEqual(chunks[0], b'*3\r\n$3\r\nset\r\n$3\r\nkey\r\n$4096\r\n')
+        self.assertEqual(chunks[1].nbytes, 4096)
+
+        protocol.zero_copy_threshold = None
+        self.assertEqual(len(protocol._encode_command([b'set', b'key', value])), 1)
+        protocol.connection_lost(None)
+
+    def test_headers(self):
+        protocol, transport = self.make_protocol()
+        requests = [
+            [b'get', b'key'],
+            [b'mget', b'a', b'b', b'c'],
+            [b'set', b'key', b'x' * 1500],
+            [b'sentinel', b'get-master-addr-by-name', b'mymaster'],
+            [b'config', b'get', b'maxmemory'],
+            [b'ping'],
+        ]
+        for args in requests * 2:
+            expected = ('*%d\r\n' % len(args)).encode() + b''.join(
+                ('$%d\r\n' % len(a)).encode() + a + b'\r\n' for a in args)
+            self.assertEqual(b''.join(protocol._encode_command(args)), expected)
+
+        self.assertEqual(_HEADERS[(2, b'get')], (b'*2\r\n$3\r\nget\r\n', 1))
+        self.assertEqual(_HEADERS[(3, b'sentinel', b'get-master-addr-by-name')],
+                         (b'*3\r\n$8\r\nsentinel\r\n$23\r\nget-master-addr-by-name\r\n', 2))
+        self.assertNotIn((3, b'set', b'key'), _HEADERS)
+        protocol.connection_lost(None)
+
+    def test_key_cache(self):
+        protocol, transport = self.make_protocol()
+        self.assertEqual(protocol.encode_from_native('key'), b'key')
+        self.assertEqual(protocol.key_cache_misses, 0)
+
+        protocol.key_cache_size = 2
+        encoded = protocol.encode_from_native('a')
+        self.assertIs(protocol.encode_from_native('a'), encoded)
+        protocol.encode_from_native('b')
+        protocol.encode_from_native('a')
+        protocol.encode_from_native('c')  # evicts 'b'
+        self.assertEqual(list(protocol._key_cache), ['a', 'c'])
+        self.assertEqual((protocol.key_cache_hits, protocol.key_cache_misses), (2, 3))
+
+        # long strings and buffers are not kept
+        protocol.encode_from_native('x' * 1000)
+        protocol.encode_from_native(b'bytes')
+        self.assertEqual(list(protocol._key_cache), ['a', 'c'])
+        protocol.connection_lost(None)
+
+    def test_send(self):
+        @asyncio.coroutine
+        def test():
+            # (bytes-like values of another type than the native one of the
+            # encoder are accepted without typechecking only)
+            for kwargs in ({'enable_typechecking': False}, {'encoder': BytesEncoder(), 'enable_typechecking': False}):
+                protocol, transport = self.make_protocol(**kwargs)
+                yield from asyncio.sleep(0, loop=self.loop)
+                payload = os.urandom(4096)
+                key = 'key' if 'encoder' not in kwargs else b'key'
+
+                for value in (payload, bytearray(payload), memoryview(payload)):
+                    transport.writes = []
+                    f = ensure_future(protocol.set(key, value), loop=self.loop)
+                    yield from asyncio.sleep(0, loop=self.loop)
+                    protocol.data_received(b'+OK\r\n')
+                    self.assertIsInstance((yield from f), StatusReply)
+
+                    [chunks] = transport.writes
+                    self.assertEqual(len(chunks), 3)
+                    # not copied
+                    self.assertIs(chunks[1].obj, value.obj if isinstance(value, memoryview) else value)
+                    self.assertEqual(b''.join(chunks),
+                                     b'*3\r\n$3\r\nset\r\n$3\r\nkey\r\n$4096\r\n' + payload + b'\r\n')
+
+                # corked commands are written at once
+                transport.writes = []
+                protocol.cork()
+                f1 = ensure_future(protocol.set(key, payload), loop=self.loop)
+                f2 = ensure_future(protocol.get(key), loop=self.loop)
+                yield from asyncio.sleep(0, loop=self.loop)
+                self.assertEqual(protocol.buffered_commands, 2)
+                protocol.uncork()
+                [chunks] = transport.writes
+                self.assertEqual(len(chunks), 4)
+                protocol.data_received(b'+OK\r\n$3\r\nabc\r\n')
+                yield from f1
+                self.assertEqual((yield from f2), 'abc' if 'encoder' not in kwargs else b'abc')
+
+                protocol.connection_lost(None)
+
+        self.loop.run_until_complete(test())
+
+    def test_disabled(self):
+        self.assertIsNone(ExtendedProtocol.zero_copy_threshold)
+        protocol = ExtendedProtocol(loop=self.loop)
+        self.assertIs(protocol.native_type, str)
+        self.assertEqual(protocol._encode_command([b'set', b'key', b'x' * 200000]),
+                         [b'*3\r\n$3\r\nset\r\n$3\r\nkey\r\n$200000\r\n' + b'x' * 200000 + b'\r\n'])
+
+    def test_manager(self):
+        class Protocol(ExtendedProtocol):
+            zero_copy_threshold = 1024
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, enable_typechecking=False, **kwargs)
+
+        @asyncio.coroutine
+        def test(protocol_class):
+            cluster = FakeCluster(loop=self.loop)
+            yield from cluster.start()
+            manager = yield from ConnectionManager.create(
+                cluster_name=cluster.name, sentinels=cluster.sentinel_addresses, loop=self.loop,
+                protocol_class=protocol_class)
+            try:
+                value = bytearray(b'x' * 200000)
+                if protocol_class is ExtendedProtocol:
+                    # typechecking expects the native type of the encoder
+                    with self.assertRaises(TypeError):
+                        yield from manager.set('big', value)
+                    return
+                yield from manager.set('big', memoryview(value))
+                self.assertEqual(cluster.master.data[b'big'], bytes(value))
+                yield from manager.set('big2', value)
+                self.assertEqual((yield from manager.get('big2')), 'x' * 200000)
+            finally:
+                manager.close()
+                yield from cluster.stop()
+
+        self.loop.run_until_complete(test(ExtendedProtocol))
+        self.loop.run_until_complete(test(Protocol))
+
+
 if __name__ == '__main__':
     if START_REDIS_SERVER:
         redis_srv = _start_redis_server(asyncio.get_event_loop())